@@ -0,0 +1,168 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+
+Re-runnable checks for the work queue behind --coordinator and --worker. Local processes stand in for the machines,
+all sharing one queue database, so no model or audio is needed. Run from the repository root:
+
+    python -m scripts.check_work_queue
+"""
+
+import multiprocessing
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from src.messaging import CliOutput
+from src.work_queue import WorkQueue
+
+# What every check's files are queued under
+VARIANT = "check"
+
+# Kept short so that lapsed leases are noticed within a few seconds rather than minutes
+LEASE_SECONDS = 2
+
+
+def __work(queue_path: Path, worker: str, lease_seconds: float, work_seconds: float, claimed: multiprocessing.SimpleQueue) -> None:
+    """Runs as a stand-in worker: claims files until none are left, "converting" each by sleeping for `work_seconds`,
+    and reports every claim as (worker, path, attempt)"""
+    queue = WorkQueue(queue_path, VARIANT, worker, lease_seconds)
+    with queue:
+        for job in queue.claims(threading.Event()):
+            claimed.put((worker, str(job.path), job.attempt))
+            time.sleep(work_seconds)
+            queue.complete(job.path)
+    queue.close()
+
+
+def __publish(queue_path: Path, count: int, **kwargs) -> Tuple[WorkQueue, List[Path]]:
+    """Queues `count` made-up files, as the coordinator would. The files needn't exist for the queue to hand them out"""
+    queue = WorkQueue(queue_path, VARIANT, "coordinator", **kwargs)
+    paths = [queue_path.parent.joinpath(f"track {idx:02}.mp3") for idx in range(count)]
+    queue.publish([(path, 60.0) for path in paths])
+    return queue, paths
+
+
+def __drain(claimed: multiprocessing.SimpleQueue) -> List[Tuple[str, str, int]]:
+    """Collects every claim reported so far. The workers write them straight to the pipe, so once they've exited every
+    claim is there to be read"""
+    claims = []
+    while not claimed.empty():
+        claims.append(claimed.get())
+    return claims
+
+
+def check_no_double_claims(workdir: Path) -> None:
+    """Three workers drain ten files between them, each file claimed once and only once"""
+    queue, paths = __publish(workdir.joinpath("queue.sqlite"), 10)
+    context = multiprocessing.get_context("spawn")
+    claimed = context.SimpleQueue()
+    workers = [
+        context.Process(target=__work, daemon=True, args=(queue.path, f"worker-{idx}", LEASE_SECONDS, 0.2, claimed)) for idx in range(3)
+    ]
+    [worker.start() for worker in workers]
+    [worker.join(60) for worker in workers]
+
+    claims = __drain(claimed)
+    per_file = Counter(path for _, path, _ in claims)
+    assert all(worker.exitcode == 0 for worker in workers), f"A worker exited with {[worker.exitcode for worker in workers]}"
+    assert sorted(per_file) == sorted(str(path) for path in paths), f"Expected every file claimed, got {sorted(per_file)}"
+    assert max(per_file.values()) == 1, f"Files claimed more than once: {[path for path, count in per_file.items() if count > 1]}"
+    assert queue.counts().done == len(paths), f"Expected {len(paths)} files done, got {queue.counts()}"
+    queue.close()
+
+
+def check_lease_takeover(workdir: Path) -> None:
+    """A worker killed outright while holding a file has it taken over by another once its lease runs out"""
+    queue, paths = __publish(workdir.joinpath("queue.sqlite"), 3)
+    context = multiprocessing.get_context("spawn")
+    # Each gets its own pipe, since killing a process can leave a shared one locked
+    doomed_claimed, claimed = context.SimpleQueue(), context.SimpleQueue()
+
+    # Holds its first file for far longer than the check takes, then is killed without any chance to hand it back
+    doomed = context.Process(target=__work, daemon=True, args=(queue.path, "doomed", LEASE_SECONDS, 600, doomed_claimed))
+    doomed.start()
+    _, held_path, _ = doomed_claimed.get()
+    doomed.kill()
+    doomed.join()
+
+    survivor = context.Process(target=__work, daemon=True, args=(queue.path, "survivor", LEASE_SECONDS, 0.1, claimed))
+    survivor.start()
+    survivor.join(60)
+
+    claims = __drain(claimed)
+    taken_over = [(worker, attempt) for worker, path, attempt in claims if path == held_path]
+    assert taken_over == [("survivor", 2)], f"Expected the survivor to take over {held_path} as attempt 2, got {taken_over}"
+    assert queue.counts().done == len(paths), f"Expected {len(paths)} files done, got {queue.counts()}"
+    queue.close()
+
+
+def check_heartbeat(workdir: Path) -> None:
+    """A worker that holds a file for several leases' worth of time keeps it, since its heartbeat renews the lease"""
+    queue, _ = __publish(workdir.joinpath("queue.sqlite"), 1)
+    context = multiprocessing.get_context("spawn")
+    claimed = context.SimpleQueue()
+
+    slow = context.Process(target=__work, daemon=True, args=(queue.path, "slow", LEASE_SECONDS, 3 * LEASE_SECONDS, claimed))
+    slow.start()
+    claimed.get()
+    # Anyone else asking while the slow worker is still going gets nothing, even well past the first lease
+    other = WorkQueue(queue.path, VARIANT, "other", LEASE_SECONDS)
+    deadline = time.time() + 2 * LEASE_SECONDS
+    while time.time() < deadline:
+        job = other.claim()
+        assert job is None, f"{job.path.name} was claimed from under a worker still renewing its lease"
+        time.sleep(0.25)
+    slow.join(60)
+
+    assert queue.counts().done == 1, f"Expected the file done, got {queue.counts()}"
+    other.close()
+    queue.close()
+
+
+def check_retries(workdir: Path) -> None:
+    """A file that keeps failing is tried again until it's used up its attempts, then given up on"""
+    queue, paths = __publish(workdir.joinpath("queue.sqlite"), 1, max_attempts=2)
+
+    first = queue.claim()
+    assert first and first.attempt == 1, f"Expected a first attempt, got {first}"
+    assert queue.fail(first.path, "broken"), "Expected the file to be tried again after its first failure"
+
+    second = queue.claim()
+    assert second and second.attempt == 2, f"Expected a second attempt, got {second}"
+    assert not queue.fail(second.path, "still broken"), "Expected the file to be given up on after its last attempt"
+
+    assert queue.claim() is None, "Expected nothing left to claim"
+    counts = queue.counts()
+    assert counts.failed == 1 and not counts.pending, f"Expected the file failed, got {counts}"
+
+    # Publishing it again, as the coordinator would on its next run, starts it over with fresh attempts
+    queue.publish([(paths[0], 60.0)])
+    again = queue.claim()
+    assert again and again.attempt == 1, f"Expected the republished file to start over, got {again}"
+    queue.close()
+
+
+CHECKS: List[Callable[[Path], None]] = [check_no_double_claims, check_lease_takeover, check_heartbeat, check_retries]
+
+
+if __name__ == "__main__":
+    logger = CliOutput()
+    failures = 0
+    for check in CHECKS:
+        started = time.perf_counter()
+        with tempfile.TemporaryDirectory(prefix="dtc-queue-check-") as workdir:
+            try:
+                check(Path(workdir))
+            except AssertionError as e:
+                failures += 1
+                logger.error(f"{check.__name__} failed: {e}")
+                continue
+        logger.info(f"{check.__name__} passed in {time.perf_counter() - started:.1f}s")
+
+    if failures:
+        logger.error(f"{failures} of {len(CHECKS)} work queue check(s) failed")
+    sys.exit(1 if failures else 0)
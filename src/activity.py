@@ -0,0 +1,125 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+# The analysis frames, in samples at the model's sample rate: ~46 ms frames every ~23 ms at 44.1 kHz
+FRAME = 2048
+HOP = 1024
+
+# Frames quieter than this, in dBFS, count as silence. Low enough that fades and reverb tails aren't cut into
+SILENCE_DBFS = -60
+
+# A drum hit raises the level across most of the spectrum at once, where a note's onset only raises its own harmonics.
+# A frame is a hit when at least this fraction of the bins between ONSET_BAND_HZ rose by ONSET_RISE_DB or more
+ONSET_RISE_DB = 9
+ONSET_BAND_HZ = (150, 15000)
+ONSET_FRACTION = 0.25
+
+# How far either side of a hit the audio still counts as having drums. Drums rarely go a few seconds without a hit,
+# so this keeps the gaps between fills and sparse patterns from being mistaken for drumless passages
+DRUM_HOLD_SECONDS = 4
+
+# The shortest stretch worth skipping. The model still has to be run a little way into either side of it for context
+MIN_SPAN_SECONDS = 4
+
+# How many frames are measured or transformed at once. The frames overlap, so a long track's are never copied out whole
+FRAMES_PER_CHUNK = 2048
+
+
+@dataclass
+class InactiveSpan:
+    """A stretch of a track with nothing for the model to do, in samples"""
+
+    start: int
+    end: int
+    kind: str  # "silence" or "drumless"
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start
+
+
+def find_inactive(
+    wav: np.ndarray, samplerate: int, silence: bool = True, drumless: bool = False, min_seconds: float = MIN_SPAN_SECONDS
+) -> List[InactiveSpan]:
+    """Finds the stretches of a track the model can be skipped over: silence, and (if asked) passages without any
+        drum hits. Silence is found by each frame's RMS level, and drum hits by broadband spectral flux. Both are
+        cheap next to running the model; a minute of audio takes around a tenth of a second. Anything struck hard
+        enough to click across the whole spectrum (plucked strings, piano, consonants) looks like a hit too, so
+        drumless passages are mostly ambient, sustained or very soft ones
+
+    Args:
+        wav (np.ndarray): The decoded waveform, shaped (channels, samples) or (samples,)
+        samplerate (int): The waveform's sample rate
+        silence (bool): Whether to look for silence
+        drumless (bool): Whether to look for passages without drums. Anything with hits, or too quiet to tell, is kept
+        min_seconds (float): The shortest stretch to report
+
+    Returns:
+        List[InactiveSpan]: The stretches found, in order and never overlapping
+    """
+    mono = wav.mean(0) if wav.ndim > 1 else wav
+    if not (silence or drumless) or len(mono) < max(FRAME, min_seconds * samplerate):
+        return []
+
+    frames = np.lib.stride_tricks.sliding_window_view(mono.astype(np.float32, copy=False), FRAME)[::HOP]
+    silent = __frame_levels(frames) < SILENCE_DBFS
+    inactive = silent.copy() if silence else np.zeros(len(frames), dtype=bool)
+    if drumless:
+        hits = __find_hits(frames, samplerate)
+        hold = int(DRUM_HOLD_SECONDS * samplerate / HOP)
+        # Counting the hits within `hold` frames of each frame marks everywhere near a hit as having drums
+        near_hit = np.convolve(hits, np.ones(2 * hold + 1), mode="same") > 0
+        inactive |= ~near_hit
+
+    spans = []
+    min_frames = max(1, int(min_seconds * samplerate / HOP))
+    for start, end in __runs(inactive):
+        if end - start < min_frames:
+            continue
+        kind = "silence" if silent[start:end].all() else "drumless"
+        # Frames overlap, so a run only covers the samples that every one of its frames saw in full
+        span_start = 0 if start == 0 else start * HOP + FRAME - HOP
+        span_end = len(mono) if end == len(frames) else end * HOP
+        if span_end > span_start:
+            spans.append(InactiveSpan(int(span_start), int(span_end), kind))
+    return spans
+
+
+def __frame_levels(frames: np.ndarray) -> np.ndarray:
+    """Gets each frame's RMS level in dBFS"""
+    levels = np.empty(len(frames), dtype=np.float32)
+    for start in range(0, len(frames), FRAMES_PER_CHUNK):
+        chunk = frames[start : start + FRAMES_PER_CHUNK]
+        levels[start : start + FRAMES_PER_CHUNK] = np.sqrt(np.mean(np.square(chunk, dtype=np.float32), axis=1))
+    return 20 * np.log10(levels + 1e-10)
+
+
+def __find_hits(frames: np.ndarray, samplerate: int) -> np.ndarray:
+    """Marks the frames where the level rises sharply across most of the spectrum at once, as a drum hit does"""
+    window = np.hanning(FRAME).astype(np.float32)
+    freqs = np.fft.rfftfreq(FRAME, 1 / samplerate)
+    band = (freqs >= ONSET_BAND_HZ[0]) & (freqs <= ONSET_BAND_HZ[1])
+
+    # Levels are floored well under silence so that noise in near-empty bins can't look like a rise
+    floor = SILENCE_DBFS - 30
+    levels = np.empty((len(frames), int(band.sum())), dtype=np.float32)
+    for start in range(0, len(frames), FRAMES_PER_CHUNK):
+        spectrum = np.abs(np.fft.rfft(frames[start : start + FRAMES_PER_CHUNK] * window, axis=1))[:, band]
+        levels[start : start + FRAMES_PER_CHUNK] = np.maximum(20 * np.log10(spectrum / (FRAME / 4) + 1e-10), floor)
+
+    # An attack lands across two overlapping frames, so each frame is compared with the one two hops back
+    rise = np.zeros_like(levels)
+    rise[2:] = levels[2:] - levels[:-2]
+    return np.mean(rise >= ONSET_RISE_DB, axis=1) >= ONSET_FRACTION
+
+
+def __runs(mask: np.ndarray) -> List[tuple]:
+    """Gets the (start, end) of each run of True in a mask"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
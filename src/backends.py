@@ -0,0 +1,146 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import os
+import threading
+import warnings
+from pathlib import Path
+from typing import Dict, Tuple
+
+import demucs
+import torch
+from demucs.apply import BagOfModels
+
+from src.common import BACKENDS
+
+# Where traced graphs are kept between runs, next to the Demucs checkpoints themselves
+DEFAULT_TRACE_DIR = Path(torch.hub.get_dir()).joinpath("dtc_torchscript")
+
+
+def prepare_model(model: torch.nn.Module, backend: str, model_name: str, trace_dir: Path = DEFAULT_TRACE_DIR) -> torch.nn.Module:
+    """Readies a freshly loaded model to run on the given backend. The result is still the same kind of model
+        (or bag of models), with the same attributes, so nothing that runs it needs to know the difference
+
+    Args:
+        model (torch.nn.Module): The float32 model (or bag) as loaded by Demucs
+        backend (str): One of BACKENDS
+        model_name (str): The name the model was loaded under, which traced graphs are cached by
+        trace_dir (Path): Where to cache traced graphs for the torchscript backend
+
+    Raises:
+        ValueError: Thrown if the backend isn't one of BACKENDS
+
+    Returns:
+        torch.nn.Module: The model to run
+    """
+    if backend == "float32":
+        return model
+    if backend == "bfloat16":
+        for sub_model in model.models if isinstance(model, BagOfModels) else [model]:
+            sub_model.forward = AutocastForward(sub_model)
+        return model
+    if backend == "int8":
+        # In place, since the float model was loaded for this alone. Copying it would also give up the sharing of any
+        # weights mapped from SharedWeights, for the layers that aren't quantized
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8, inplace=True)
+    if backend == "torchscript":
+        sub_models = model.models if isinstance(model, BagOfModels) else [model]
+        for idx, sub_model in enumerate(sub_models):
+            sub_model.forward = TracedForward(sub_model, trace_dir, f"{model_name}-{idx}")
+        return model
+    raise ValueError(f"Unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+
+
+def supports_bfloat16(device: str) -> bool:
+    """Determines if a device does bfloat16 math natively. Elsewhere it's emulated, and slower than float32
+
+    Args:
+        device (str): "cuda" or "cpu"
+
+    Returns:
+        bool: True if bfloat16 should be faster than float32 on the device
+    """
+    if device == "cuda":
+        return torch.cuda.is_bf16_supported()
+    # These checks aren't public, and not every build of torch has them
+    checks = [getattr(torch.cpu, name, None) for name in ("_is_avx512_bf16_supported", "_is_amx_tile_supported")]
+    return any(check() for check in checks if check)
+
+
+class AutocastForward:
+    def __init__(self, model: torch.nn.Module):
+        """Stands in for a model's forward, running it under bfloat16 autocasting. The convolutions and matrix
+            multiplications run at half precision while the rest (the STFT, normalization) stays float32, as does
+            what goes in and comes out
+
+        Args:
+            model (torch.nn.Module): The single (non-bag) model to run
+        """
+        self.eager = EagerForward(model)
+
+    def __call__(self, mix: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(mix.device.type, dtype=torch.bfloat16):
+            return self.eager(mix).float()
+
+
+class EagerForward(torch.nn.Module):
+    def __init__(self, model: torch.nn.Module):
+        """Calls a model's own forward, even once TracedForward has taken its place, so that it can be traced"""
+        super().__init__()
+        self.model = model
+
+    def forward(self, mix: torch.Tensor) -> torch.Tensor:
+        return type(self.model).forward(self.model, mix)
+
+
+class TracedForward:
+    def __init__(self, model: torch.nn.Module, trace_dir: Path, key: str):
+        """Stands in for a model's forward, running a TorchScript graph traced from it instead. A traced graph only
+            holds for the input shape it was traced with, so one is traced (or loaded from disk) per shape. Demucs
+            pads every segment to the same length, so in practice that's one or two per model. Models that can't be
+            traced (the older Demucs models' resampling can't) just keep running their own forward
+
+        Args:
+            model (torch.nn.Module): The single (non-bag) model to trace
+            trace_dir (Path): Where traced graphs are cached between runs
+            key (str): Identifies the model's weights within the cache
+        """
+        self.eager = EagerForward(model)
+        self.trace_dir = trace_dir
+        # The traced graph has the weights baked in, and depends on how this version of torch lowers the model
+        self.key = f"{key}-torch{torch.__version__}-demucs{demucs.__version__}".replace("+", "_")
+        self.graphs: Dict[Tuple[int, ...], torch.jit.ScriptModule] = {}
+        self.traceable = True
+        self.lock = threading.Lock()
+
+    def __call__(self, mix: torch.Tensor) -> torch.Tensor:
+        shape = tuple(mix.shape)
+        if shape not in self.graphs and self.traceable:
+            with self.lock:
+                if shape not in self.graphs and self.traceable:
+                    try:
+                        self.graphs[shape] = self.__load_or_trace(mix)
+                    except RuntimeError:
+                        self.traceable = False
+        return self.graphs[shape](mix) if shape in self.graphs else self.eager(mix)
+
+    def __load_or_trace(self, mix: torch.Tensor) -> torch.jit.ScriptModule:
+        """Loads the graph for the mix's shape from disk, tracing and saving it first if it isn't there yet"""
+        path = self.trace_dir.joinpath(f"{self.key}-{'x'.join(str(size) for size in mix.shape)}.pt")
+        if path.exists():
+            try:
+                return torch.jit.load(str(path), map_location=mix.device)
+            except RuntimeError:
+                pass  # Unreadable for whatever reason, so trace it again and replace it
+
+        with torch.no_grad(), warnings.catch_warnings():
+            # Tracing warns about every Python-side shape calculation, which is exactly what pinning the shape covers
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+            graph = torch.jit.trace(self.eager, mix, check_trace=False)
+
+        os.makedirs(self.trace_dir, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        torch.jit.save(graph, str(tmp))
+        os.replace(tmp, path)
+        return graph
@@ -0,0 +1,415 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, RawTextHelpFormatter
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import torch
+
+from src.common import BACKENDS, MODEL_CHOICES
+from src.engine import SeparationEngine
+from src.presets import InferenceSettings
+from src.instrumentation import peak_rss_mb
+from src.messaging import CliOutput, NoPrintStatements
+
+SAMPLERATE = 44100
+
+# How long, in seconds, the CLI may take to show its help or to finish a run with nothing to do, from a fresh interpreter
+DEFAULT_STARTUP_BUDGET = 1.0
+
+# Packages that take seconds to import between them, and that neither of those should need
+HEAVY_PACKAGES = ["torch", "torchaudio", "demucs", "julius", "numpy", "lameenc", "eyed3", "wavinfo"]
+
+
+@dataclass
+class BenchResult:
+    """How a single model + configuration fared on the synthetic test tracks"""
+
+    model: str
+    workers: int
+    jobs: int
+    segment: Optional[float]
+    shifts: int
+    backend: str = "float32"
+    realtime_factor: float = 0
+    peak_rss_mb: float = 0
+    sdr: float = 0
+    error: str = ""
+
+
+@dataclass
+class BackendCheck:
+    """How a backend's output and speed compare to float32's on the same audio"""
+
+    backend: str
+    sdr: float  # Of the backend's drumless output, taking float32's as the ground truth; higher is closer
+    float32_seconds: float
+    backend_seconds: float
+
+
+@dataclass
+class StartupCheck:
+    """How quickly the CLI gets going from a fresh interpreter"""
+
+    command: str
+    seconds: float  # The median across every run
+    heavy_imports: List[str]  # Which of HEAVY_PACKAGES it imported
+
+
+def make_track(seed: int, seconds: float, samplerate: int = SAMPLERATE) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Synthesizes a test track: a kick/snare/hat pattern over a tonal chord bed. Since the parts are
+        generated separately, the bed is the exact ground truth for what the drumless output should be
+
+    Args:
+        seed (int): Seeds the tempo, chords and noise so the same seed always makes the same track
+        seconds (float): How long the track should be
+        samplerate (int): The sample rate to synthesize at
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The stereo mix and the stereo drumless ground truth, both (2, samples)
+    """
+    gen = torch.Generator().manual_seed(seed)
+    length = int(seconds * samplerate)
+    t = torch.arange(length) / samplerate
+
+    # Drums: one hit per eighth note, alternating kick and snare on the beats with hats throughout
+    tempo = 80 + int(torch.randint(0, 80, (1,), generator=gen))
+    eighth = 30 / tempo
+    drums = torch.zeros(length)
+    for idx in range(int(seconds / eighth)):
+        start = int(idx * eighth * samplerate)
+        hit_t = t[: min(int(0.3 * samplerate), length - start)]
+        noise = torch.rand(len(hit_t), generator=gen) * 2 - 1
+
+        hit = 0.15 * noise * torch.exp(-hit_t * 80)  # Hat
+        if idx % 4 == 0:  # Kick
+            hit += 0.8 * torch.sin(2 * math.pi * 55 * hit_t * (1 + torch.exp(-hit_t * 30))) * torch.exp(-hit_t * 12)
+        elif idx % 4 == 2:  # Snare
+            hit += (0.4 * noise + 0.3 * torch.sin(2 * math.pi * 185 * hit_t)) * torch.exp(-hit_t * 20)
+        drums[start : start + len(hit_t)] += hit
+
+    # Bed: a triad that changes every two bars, with a few harmonics and a slow swell on each chord
+    bed = torch.zeros(2, length)
+    chord_seconds = 16 * eighth
+    for idx in range(math.ceil(seconds / chord_seconds)):
+        start, end = int(idx * chord_seconds * samplerate), min(int((idx + 1) * chord_seconds * samplerate), length)
+        chord_t = t[: end - start]
+        root = 110 * 2 ** (int(torch.randint(0, 12, (1,), generator=gen)) / 12)
+        envelope = torch.sin(math.pi * chord_t / chord_seconds) ** 0.5
+        for channel, detune in enumerate((1.0, 1.003)):
+            for ratio in (1, 1.26, 1.5):
+                for harmonic in (1, 2, 3):
+                    freq = root * ratio * harmonic * detune
+                    bed[channel, start:end] += 0.08 / harmonic * torch.sin(2 * math.pi * freq * chord_t) * envelope
+
+    mix = drums[None] + bed
+    scale = 0.9 / mix.abs().max()
+    return mix * scale, bed * scale
+
+
+def sdr(reference: torch.Tensor, estimate: torch.Tensor) -> float:
+    """Computes the signal-to-distortion ratio of an estimate against its ground truth
+
+    Args:
+        reference (torch.Tensor): The ground truth
+        estimate (torch.Tensor): The estimate, the same shape as the reference
+
+    Returns:
+        float: The SDR in dB; higher is better
+    """
+    signal = reference.pow(2).sum()
+    distortion = (reference - estimate).pow(2).sum()
+    return float(10 * torch.log10((signal + 1e-8) / (distortion + 1e-8)))
+
+
+def check_backend(model_name: str, backend: str, seconds: float = 20) -> BackendCheck:
+    """Splits the same synthetic track with float32 and another backend, to see how far the backend's output drifts
+        from float32's and how much faster it gets there. One-off work like tracing is done before the timing starts
+
+    Args:
+        model_name (str): The name of the Demucs model to check
+        backend (str): The backend to compare against float32, one of BACKENDS
+        seconds (float): How long the synthetic track should be
+
+    Returns:
+        BackendCheck: The comparison
+    """
+    timings, outputs = [], []
+    for name in ("float32", backend):
+        engine = SeparationEngine(model_name, backend=name)
+        mix, _ = make_track(0, seconds, engine.samplerate)
+        engine.split_drums(mix[:, : engine.samplerate])
+
+        # Shifts are random, and both runs should shift the same way
+        random.seed(0)
+        start = time.perf_counter()
+        _, no_drums = engine.split_drums(mix)
+        timings.append(time.perf_counter() - start)
+        outputs.append(no_drums)
+        del engine
+
+    return BackendCheck(backend, sdr(outputs[0], outputs[1]), timings[0], timings[1])
+
+
+def run_config(config: BenchResult, tracks: int, seconds: float) -> BenchResult:
+    """Benchmarks a single configuration. Worker processes each load the model and wait at a barrier
+        so that model loading isn't counted against throughput
+
+    Args:
+        config (BenchResult): The configuration to run, which gets filled in with the results
+        tracks (int): How many synthetic tracks to split in total
+        seconds (float): How long each synthetic track is
+
+    Returns:
+        BenchResult: The filled-in result
+    """
+    threads = max(1, (os.cpu_count() or 2) // config.workers)
+    barrier = multiprocessing.Barrier(config.workers + 1)
+    results = multiprocessing.Queue()
+
+    procs = [
+        multiprocessing.Process(
+            target=__bench_worker,
+            args=(config, threads, list(range(idx, tracks, config.workers)), seconds, barrier, results),
+        )
+        for idx in range(config.workers)
+    ]
+    [proc.start() for proc in procs]
+
+    try:
+        barrier.wait()
+        start = time.perf_counter()
+        worker_results = [results.get() for _ in procs]
+        wall_seconds = time.perf_counter() - start
+    except threading.BrokenBarrierError:
+        # A worker failed to load the model; it leaves the reason on the queue before breaking the barrier
+        worker_results = [results.get()]
+    finally:
+        [proc.join() for proc in procs]
+
+    errors = [error for _, _, _, error in worker_results if error]
+    if errors:
+        config.error = errors[0]
+        return config
+
+    sdrs = [value for _, values, _, _ in worker_results for value in values]
+    config.realtime_factor = sum(audio for audio, _, _, _ in worker_results) / wall_seconds
+    config.peak_rss_mb = max(rss for _, _, rss, _ in worker_results)
+    config.sdr = sum(sdrs) / len(sdrs) if sdrs else 0
+    return config
+
+
+def __bench_worker(
+    config: BenchResult,
+    threads: int,
+    seeds: List[int],
+    seconds: float,
+    barrier: multiprocessing.Barrier,
+    results: multiprocessing.Queue,
+) -> None:
+    """Runs in each benchmark worker process: loads the model, then splits its share of the synthetic tracks
+
+    Args:
+        config (BenchResult): The configuration being benchmarked
+        threads (int): How many intra-op threads torch may use in this worker
+        seeds (List[int]): The seeds of the tracks this worker should split
+        seconds (float): How long each synthetic track is
+        barrier (multiprocessing.Barrier): Waited on once the model is loaded, so that timing starts together
+        results (multiprocessing.Queue): Where to put (audio seconds, SDRs, peak RSS, error) when done
+    """
+    torch.set_num_threads(threads)
+    try:
+        with NoPrintStatements(False):
+            settings = InferenceSettings(config.shifts, segment=config.segment)
+            engine = SeparationEngine(config.model, jobs=config.jobs, backend=config.backend, settings=settings)
+        # Synthesize up-front so that only separation is timed
+        tracks = [make_track(seed, seconds, engine.samplerate) for seed in seeds]
+    except Exception as e:
+        results.put((0, [], 0, str(e)))
+        barrier.abort()
+        return
+
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        return  # Another worker failed to start, so this configuration is being abandoned
+
+    try:
+        sdrs = []
+        for mix, bed in tracks:
+            _, no_drums = engine.split_drums(mix)
+            sdrs.append(sdr(bed, no_drums))
+        results.put((len(tracks) * seconds, sdrs, peak_rss_mb(), ""))
+    except Exception as e:
+        results.put((0, [], 0, str(e)))
+
+
+def check_startup(cli_args: List[str], runs: int = 5) -> StartupCheck:
+    """Times `python -m src.cli` in fresh interpreters, so every run pays for its imports the way a user's would, and
+        notes any heavy packages it imported that it could've gone without
+
+    Args:
+        cli_args (List[str]): The arguments to run the CLI with
+        runs (int): How many times to run it. The median is kept so one slow run doesn't fail the check
+
+    Returns:
+        StartupCheck: How long it took
+    """
+    command = [sys.executable, "-m", "src.cli", *cli_args]
+    repo_root = Path(__file__).resolve().parent.parent
+
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=repo_root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - start)
+
+    # Run once more listing every import, which is too slow to time but says exactly where the time would've gone
+    importtime = subprocess.run(
+        [sys.executable, "-X", "importtime", *command[1:]], cwd=repo_root, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    imported = {line.rpartition("|")[2].strip().partition(".")[0] for line in importtime.stderr.splitlines() if line.startswith("import time:")}
+
+    return StartupCheck(" ".join(["src.cli", *cli_args]), statistics.median(durations), [name for name in HEAVY_PACKAGES if name in imported])
+
+
+def __check_startup(logger: CliOutput, budget: float) -> bool:
+    """Checks that the CLI shows its help, and finishes a run over an empty library, within the budget
+
+    Args:
+        logger (CliOutput): Where to report each check
+        budget (float): The most seconds either may take
+
+    Returns:
+        bool: True if both were within the budget without importing any of HEAVY_PACKAGES
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.makedirs(Path(tmp_dir).joinpath("in"))
+        checks = [check_startup(["--help"]), check_startup([str(Path(tmp_dir).joinpath("in")), str(Path(tmp_dir).joinpath("out"))])]
+
+    passed = True
+    for check in checks:
+        if check.heavy_imports:
+            logger.error(f"{check.command} imported {', '.join(check.heavy_imports)}, which it shouldn't need")
+        if check.seconds > budget:
+            logger.error(f"{check.command} took {check.seconds:.2f}s, over the {budget:.2f}s budget")
+        if check.heavy_imports or check.seconds > budget:
+            passed = False
+        else:
+            logger.info(f"{check.command} took {check.seconds:.2f}s, within the {budget:.2f}s budget")
+    return passed
+
+
+def __get_parser() -> ArgumentParser:
+    """Creates an arg parser for the benchmark
+
+    Returns:
+        ArgumentParser: The created and configured arg parser.
+    """
+    parser = ArgumentParser(
+        prog="Drum Track Converter Benchmark",
+        description="Measures the speed, memory use and quality of each model across a grid of settings,\n"
+        "using synthetic tracks with a known drumless ground truth",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    parser.add_argument("-m", "--models", nargs="+", default=list(MODEL_CHOICES.values()), help="Which models to benchmark")
+    parser.add_argument("-j", "--jobs", nargs="+", type=int, default=[0], help="Values of Demucs' --jobs to try")
+    parser.add_argument("-w", "--workers", nargs="+", type=int, default=[1], help="Worker process counts to try")
+    parser.add_argument(
+        "-s",
+        "--segments",
+        nargs="+",
+        type=float,
+        default=[0],
+        help="Segment lengths in seconds to try. 0 uses each model's own",
+    )
+    parser.add_argument("--shifts", nargs="+", type=int, default=[1], help="Shift counts to try")
+    parser.add_argument("-b", "--backends", nargs="+", choices=BACKENDS, default=["float32"], help="Inference backends to try")
+    parser.add_argument("-t", "--tracks", type=int, default=4, help="How many synthetic tracks to split per configuration")
+    parser.add_argument("-d", "--duration", type=float, default=30, help="How long each synthetic track is, in seconds")
+    parser.add_argument("--min-sdr", type=float, default=None, help="Recommend the fastest configuration with at least this SDR")
+    parser.add_argument("-o", "--output", default=None, help="Where to write the results. .csv for CSV, otherwise JSON")
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        nargs="?",
+        const=DEFAULT_STARTUP_BUDGET,
+        default=None,
+        metavar="SECONDS",
+        help="Instead of benchmarking, check that the CLI's --help and a run over an empty library each finish within\n"
+        f"SECONDS (default {DEFAULT_STARTUP_BUDGET}) without importing torch and the like. Exits with 1 if either doesn't",
+    )
+
+    return parser
+
+
+if __name__ == "__main__":
+    logger = CliOutput()
+    args = __get_parser().parse_args()
+
+    if args.startup_budget is not None:
+        sys.exit(0 if __check_startup(logger, args.startup_budget) else 1)
+
+    configs = [
+        BenchResult(model, workers, jobs, segment or None, shifts, backend)
+        for model, workers, jobs, segment, shifts, backend in itertools.product(
+            args.models, args.workers, args.jobs, args.segments, args.shifts, args.backends
+        )
+    ]
+
+    results: List[BenchResult] = []
+    try:
+        for idx, config in enumerate(configs, start=1):
+            logger.info(
+                f"[{idx}/{len(configs)}] {config.model}: {config.workers} worker(s), jobs={config.jobs}, segment={config.segment}, "
+                f"shifts={config.shifts}, backend={config.backend}"
+            )
+            result = run_config(config, args.tracks, args.duration)
+            results.append(result)
+
+            if result.error:
+                logger.warning(f"Failed: {result.error}")
+            else:
+                logger.info(f"{result.realtime_factor:.2f}x realtime, {result.peak_rss_mb:.0f} MB peak, {result.sdr:.2f} dB SDR")
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+    if args.output:
+        if Path(args.output).suffix.lower() == ".csv":
+            with open(args.output, "w", newline="") as fh:
+                writer = csv.DictWriter(fh, fieldnames=[field.name for field in fields(BenchResult)])
+                writer.writeheader()
+                [writer.writerow(asdict(result)) for result in results]
+        else:
+            with open(args.output, "w") as fh:
+                json.dump([asdict(result) for result in results], fh, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+    if args.min_sdr is not None:
+        passing = [result for result in results if not result.error and result.sdr >= args.min_sdr]
+        if passing:
+            best = max(passing, key=lambda result: result.realtime_factor)
+            logger.info(
+                f"Fastest with at least {args.min_sdr} dB SDR: {best.model} with {best.workers} worker(s), jobs={best.jobs}, "
+                f"segment={best.segment}, shifts={best.shifts}, backend={best.backend} "
+                f"({best.realtime_factor:.2f}x realtime, {best.sdr:.2f} dB)"
+            )
+        else:
+            logger.warning(f"No configuration reached {args.min_sdr} dB SDR")
@@ -0,0 +1,105 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from uuid import uuid4
+
+import torch
+
+
+class SeparationCache:
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        """A content-addressed store of drumless outputs, so that the same audio appearing more than once
+            in a library (album + compilation + "best of", etc.) is only ever split once.
+            Entries are evicted least-recently-used first once the cache grows past max_bytes
+
+        Args:
+            cache_dir (Path): Where to keep cached outputs. Ideally a fast local disk
+            max_bytes (int): The most the cache may hold on disk before evicting entries
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(wav: torch.Tensor, model_name: str) -> str:
+        """Creates a cache key from decoded audio, so identical audio matches regardless of its file's tags or path
+
+        Args:
+            wav (torch.Tensor): The decoded waveform
+            model_name (str): The name of the Demucs model the output is split with, or the engine's `variant` of it
+                if it's split with other than the default settings
+
+        Returns:
+            str: The cache key
+        """
+        digest = hashlib.sha256(model_name.encode())
+        digest.update(wav.contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str, dest: Path) -> bool:
+        """Copies a cached output to the destination if one exists, marking it as recently used.
+            It's appended after whatever the destination already holds, such as the output's tag
+
+        Args:
+            key (str): The cache key from `fingerprint`
+            dest (Path): Where to copy the cached output to
+
+        Returns:
+            bool: True if the output was cached and copied, False otherwise
+        """
+        entry = self.__entry(key, Path(dest).suffix)
+        try:
+            with open(entry, "rb") as src, open(dest, "ab") as dst:
+                shutil.copyfileobj(src, dst)
+        except FileNotFoundError:
+            return False
+
+        # The modification time doubles as the last-used time for LRU eviction
+        os.utime(entry)
+        return True
+
+    def put(self, key: str, source: Path, offset: int = 0) -> None:
+        """Stores a copy of a freshly split output, evicting old entries if the cache is now too large
+
+        Args:
+            key (str): The cache key from `fingerprint`
+            source (Path): The drumless output to cache
+            offset (int): Where the audio starts in the source. Anything before it (its tag) isn't cached,
+                since the same audio can belong to tracks with entirely different tags
+        """
+        # Copy under a temporary name first so other processes never see a half-written entry
+        tmp = self.cache_dir.joinpath(f".{uuid4().hex}.tmp")
+        with open(source, "rb") as src, open(tmp, "wb") as dst:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp, self.__entry(key, Path(source).suffix))
+        self.__evict()
+
+    def __entry(self, key: str, extension: str) -> Path:
+        """Gets the path a given key's output is stored at. The key already accounts for the format, so the
+            extension only keeps the entries recognizable"""
+        return self.cache_dir.joinpath(f"{key}{extension}")
+
+    def __evict(self) -> None:
+        """Removes the least-recently-used entries until the cache fits within max_bytes"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            # Anything hidden is an entry still being written
+            if not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass  # Another process got to it first
+            total -= size
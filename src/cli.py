@@ -3,13 +3,25 @@
 """
 
 import sys
-from argparse import ArgumentParser, RawTextHelpFormatter
 
-from colorama import Fore
+from src.import_profiler import ImportProfiler
 
-from src.common import MODEL_CHOICES
-from src.messaging import CliOutput
-from src.processor import FolderProcessor
+# Started ahead of every other import, this module's own included, so that --startup-profile covers all that a run
+# imports. It's looked for in the raw arguments since parsing them takes imports of its own
+__profiler = ImportProfiler().start() if __name__ == "__main__" and "--startup-profile" in sys.argv[1:] else None
+
+from argparse import ArgumentParser, RawTextHelpFormatter  # noqa: E402
+
+from colorama import Fore  # noqa: E402
+
+from src.common import BACKENDS, MODEL_CHOICES  # noqa: E402
+from src.formats import DEFAULT_BITRATES, OUTPUT_FORMATS  # noqa: E402
+from src.presets import PRESETS  # noqa: E402
+from src.messaging import CliOutput  # noqa: E402
+from src.work_queue import DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS  # noqa: E402
+
+# Only this many of the most expensive packages are listed by --startup-profile
+STARTUP_PROFILE_PACKAGES = 15
 
 
 def __get_parser() -> ArgumentParser:
@@ -44,6 +56,245 @@ def __get_parser() -> ArgumentParser:
         default=list(MODEL_CHOICES.values())[0],
     )
 
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="How many files to split at once. The workers share one copy of the model's weights and get an even share of the CPU cores",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--keep-drums",
+        help="Also output the isolated drum track next to each drumless track",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "-f",
+        "--force",
+        help="Reprocess every file, even ones that were already converted by a previous run and haven't changed",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        help="Where to cache split tracks so that duplicate audio across the library is only split once. Disabled by default",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        help="The most disk space the cache may use, in GB. The least recently used tracks are evicted first",
+        type=float,
+        default=5,
+    )
+
+    parser.add_argument(
+        "--queue-depth",
+        help="How many files may wait between the decode, separate and encode stages. Higher uses more memory",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--batch-segments",
+        help="How many audio segments to run through the model at once, gathered across queued tracks.\n"
+        "Helps CPU throughput on libraries of short tracks; pair with a higher --queue-depth. 0 disables batching",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--report",
+        help="Where to write the per-file, per-stage timing report. Use a .csv extension for CSV, otherwise it's JSON.\n"
+        "Defaults to .dtc_report.json in the output directory",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Keep cProfile and torch profiler traces for the N slowest tracks, written to .dtc_profiles in the output directory",
+        type=int,
+        default=0,
+        metavar="N",
+    )
+
+    parser.add_argument(
+        "--scratch-dir",
+        help="Where to write intermediate files while converting. Each run and each file gets its own directory within it,\n"
+        "removed even if the run fails or is interrupted. Defaults to .dtc_scratch in the output directory so that\n"
+        "finished tracks are moved with a cheap rename; a tmpfs mount also works well",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--stream-above",
+        help="Tracks longer than this many minutes are decoded, split and encoded a window at a time, so that memory use\n"
+        "stays flat however long they are (DJ mixes, live recordings, etc.). 0 disables streaming",
+        type=float,
+        default=20,
+        metavar="MINUTES",
+    )
+
+    parser.add_argument(
+        "--stream-window",
+        help="How many seconds of audio to work on at a time when streaming. Smaller uses less memory",
+        type=float,
+        default=30,
+        metavar="SECONDS",
+    )
+
+    parser.add_argument(
+        "--format",
+        help="What to encode the outputs to. mp3 for the widest support, m4a (AAC) for iPods and Apple devices,\n"
+        "flac for lossless copies to load into a DAW",
+        choices=OUTPUT_FORMATS,
+        default="mp3",
+    )
+
+    parser.add_argument(
+        "--bitrate",
+        help="The output bitrate in kbps: constant for mp3, the target for m4a, ignored for flac.\n"
+        f"Defaults to {DEFAULT_BITRATES['mp3']} for mp3 and {DEFAULT_BITRATES['m4a']} for m4a",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--vbr",
+        help="Encode variable bitrate MP3s at this LAME quality instead (0 is best, 9 is smallest; 2 is ~190 kbps)",
+        type=int,
+        choices=range(10),
+        default=None,
+        metavar="QUALITY",
+    )
+
+    parser.add_argument(
+        "--encode-workers",
+        help="How many tracks may be encoded at once, each in a process of its own so encoding doesn't hold up the model.\n"
+        "Only applies without --workers, whose workers each encode their own tracks",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--preset",
+        help="How much work to put into each track, from a quick pass for bulk library runs to the most accurate split:\n"
+        + "\n".join(f"  • {name} - shifts={preset.shifts}, overlap={preset.overlap}" for name, preset in PRESETS.items())
+        + "\n--shifts, --overlap and --segment override the preset's values",
+        choices=list(PRESETS),
+        default="balanced",
+    )
+
+    parser.add_argument(
+        "--shifts",
+        help="How many passes to average over, each at a random offset. Every shift is a full extra pass over the track.\n"
+        "0 makes a single unshifted pass",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--overlap",
+        help="How much neighbouring segments overlap, from 0 to just under 1. More overlap means more segments to run",
+        type=float,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--segment",
+        help="How many seconds of audio the model sees at once. Defaults to what the model was trained with,\n"
+        "which is also the most the transformer models (htdemucs*) can take",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+    )
+
+    parser.add_argument(
+        "--skip-drumless",
+        help="Don't run the model over stretches without any drum hits (spoken word, ambient intros, quiet interludes),\n"
+        "passing them through as they are. Only clearly drumless stretches of several seconds are skipped",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--keep-silence",
+        help="Run the model over silent stretches too, rather than passing them through as they are",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--backend",
+        help="How to run the model. All but float32 and bfloat16 run on the CPU:\n"
+        "  • float32 - The model as Demucs ships it\n"
+        "  • bfloat16 - Runs the convolutions and matrix math at half precision. Only faster on hardware with native bfloat16\n"
+        "  • int8 - Dynamically quantizes the model's linear and LSTM layers. Faster, slightly less accurate\n"
+        "  • torchscript - Runs graphs traced from the model, cached alongside the Demucs checkpoints",
+        choices=BACKENDS,
+        default="float32",
+    )
+
+    parser.add_argument(
+        "--check-backend",
+        help="Before converting anything, split a synthetic track with both float32 and --backend and report how far\n"
+        "apart they are, in dB SDR, and the speedup. Stops without converting if the SDR is under MIN_SDR (default 30)",
+        type=float,
+        nargs="?",
+        const=30,
+        default=None,
+        metavar="MIN_SDR",
+    )
+
+    parser.add_argument(
+        "--coordinator",
+        help="Rather than converting anything, queue the files that need converting in a work queue for --worker\n"
+        "processes to share, on this machine or any other with the same directories mounted at the same paths",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--worker",
+        help="Convert files from the work queue until none are left, alongside any other workers. Needs the same\n"
+        "directories and model settings as the coordinator. With --coordinator too, queues the files first",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--queue",
+        help="Where the work queue for --coordinator and --worker lives. Defaults to .dtc_queue.sqlite in the output\n"
+        "directory. Needs a filesystem with working locks, such as a local disk or NFSv4",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--lease",
+        help="How long a worker may go without checking in before its files are handed to another worker",
+        type=float,
+        default=DEFAULT_LEASE_SECONDS,
+        metavar="SECONDS",
+    )
+
+    parser.add_argument(
+        "--max-attempts",
+        help="How many times a queued file is tried, counting workers that went missing, before it's given up on",
+        type=int,
+        default=DEFAULT_MAX_ATTEMPTS,
+    )
+
+    parser.add_argument(
+        "--startup-profile",
+        help="Time every import made by the run, and list the most expensive packages once it's done (or --help is shown)",
+        action="store_true",
+        default=False,
+    )
+
     parser.add_argument(
         "-v",
         "--verbose",
@@ -55,14 +306,70 @@ def __get_parser() -> ArgumentParser:
     return parser
 
 
-if __name__ == "__main__":
-    logger = CliOutput()
+def __log_startup_profile(logger: CliOutput, profiler: ImportProfiler) -> None:
+    """Lists where the run's import time went, most expensive package first
+
+    Args:
+        logger (CliOutput): Where to list it
+        profiler (ImportProfiler): The finished profiler
+    """
+    summary = profiler.summary()
+    import_seconds = sum(seconds for _, seconds, _ in summary)
+    logger.info(f"Spent {import_seconds:.2f}s of {profiler.wall_seconds:.2f}s importing {sum(count for _, _, count in summary)} module(s):")
+    for name, seconds, count in summary[:STARTUP_PROFILE_PACKAGES]:
+        logger.info(f"  {name}: {seconds:.3f}s ({count} module(s))")
+
+
+def __run(logger: CliOutput) -> None:
+    """Parses the arguments and runs the conversion they ask for
+
+    Args:
+        logger (CliOutput): The handler for displaying output to the user
+    """
     args = __get_parser().parse_args()
 
     try:
+        if args.backend == "bfloat16":
+            import torch
+
+            from src.backends import supports_bfloat16
+
+            if not supports_bfloat16("cuda" if torch.cuda.is_available() else "cpu"):
+                logger.warning("This machine doesn't do bfloat16 natively, so the bfloat16 backend will likely be slower than float32")
+
+        if args.check_backend is not None and args.backend != "float32":
+            from src.bench import check_backend
+
+            logger.info(f"Checking the {args.backend} backend against float32..")
+            check = check_backend(args.model, args.backend)
+            logger.info(
+                f"{args.backend}: {check.sdr:.2f} dB SDR against float32, "
+                f"{check.float32_seconds / check.backend_seconds:.2f}x the speed ({check.backend_seconds:.2f}s vs {check.float32_seconds:.2f}s)"
+            )
+            if check.sdr < args.check_backend:
+                logger.error(f"The {args.backend} backend is under {args.check_backend} dB SDR, not converting anything")
+                sys.exit(1)
+
+        from src.processor import FolderProcessor
+
         processor = FolderProcessor.from_args(args, logger)
-        processor.process_directory()
+        if args.coordinator:
+            processor.publish_directory()
+        if args.worker:
+            processor.process_queue()
+        elif not args.coordinator:
+            processor.process_directory()
     except KeyboardInterrupt:
         sys.exit(0)
     except Exception as e:
         logger.error(e)
+
+
+if __name__ == "__main__":
+    logger = CliOutput()
+    try:
+        __run(logger)
+    finally:
+        if __profiler:
+            __profiler.stop()
+            __log_startup_profile(logger, __profiler)
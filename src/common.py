@@ -1,3 +1,6 @@
+import subprocess
+from functools import lru_cache
+
 SUPPORTED_EXTS = [".mp3", ".m4a", ".wav"]
 
 MODEL_CHOICES = {
@@ -9,3 +12,25 @@ MODEL_CHOICES = {
     "Model Trained with MusDB HQ (Quantized)": "mdx_q",
     "Model Trained with MusDB HQ (Extra Quantized)": "mdx_extra_q",
 }
+
+# float32 runs the model as Demucs ships it. bfloat16 runs its matrix-heavy layers at half precision. int8 swaps the
+# linear and recurrent layers (the transformer in htdemucs, the LSTMs in the older models) for dynamically quantized
+# ones. torchscript runs traced graphs
+BACKENDS = ["float32", "bfloat16", "int8", "torchscript"]
+
+# The backends that can run on a GPU. The rest always run on the CPU
+GPU_BACKENDS = ["float32", "bfloat16"]
+
+
+@lru_cache(maxsize=None)
+def is_ffmpeg_present() -> bool:
+    """Determines if ffmpeg is installed and accessible. Only checked once per process
+
+    Returns:
+        bool: True if ffmpeg is installed and accessible, false otherwise
+    """
+    try:
+        exit_code = subprocess.call(["ffmpeg"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return exit_code == 1
+    except FileNotFoundError:
+        return False
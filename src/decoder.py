@@ -0,0 +1,219 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import io
+import struct
+import subprocess
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from demucs.audio import convert_audio_channels
+
+# WAVE format tags (and the leading bytes of WAVE_FORMAT_EXTENSIBLE's sub-format GUID) that can be mapped as-is
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# (format tag, bits per sample) -> (numpy dtype, scale to [-1, 1]). The scales match what ffmpeg's conversion to f32 does
+WAV_SAMPLE_TYPES = {
+    (WAVE_FORMAT_PCM, 16): (np.dtype("<i2"), 1 / 2**15),
+    (WAVE_FORMAT_PCM, 32): (np.dtype("<i4"), 1 / 2**31),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): (np.dtype("<f4"), None),
+}
+
+
+class AudioDecoder:
+    def __init__(self, samplerate: int, channels: int):
+        """Decodes audio files straight into memory at a fixed sample rate and channel count.
+            WAVs that are already at the right sample rate are memory-mapped rather than read; everything
+            else is decoded by a single ffmpeg process per file, piped back without probing or temp files
+
+        Args:
+            samplerate (int): The sample rate to decode to
+            channels (int): The channel count to decode to
+        """
+        self.samplerate = samplerate
+        self.channels = channels
+
+    def decode(self, path: Path) -> torch.Tensor:
+        """Decodes an audio file
+
+        Args:
+            path (Path): The path of the audio file to decode
+
+        Returns:
+            torch.Tensor: The decoded float32 waveform, shaped (channels, samples)
+        """
+        mapped = self.__map_wav(Path(path))
+        if mapped:
+            samples, scale = mapped
+            return self.__to_waveform(samples, scale)
+        return self.__decode_ffmpeg(Path(path))
+
+    def stream(self, path: Path, block_frames: int) -> Iterator[torch.Tensor]:
+        """Decodes an audio file a block at a time, so that only one block is ever in memory
+
+        Args:
+            path (Path): The path of the audio file to decode
+            block_frames (int): How many samples (per channel) each block should hold. The last may hold fewer
+
+        Raises:
+            RuntimeError: Thrown if ffmpeg fails to decode the file
+
+        Yields:
+            torch.Tensor: Each decoded float32 block, shaped (channels, samples), identical to the matching
+                slice of what `decode` returns
+        """
+        mapped = self.__map_wav(Path(path))
+        if mapped:
+            samples, scale = mapped
+            for start in range(0, len(samples), block_frames):
+                yield self.__to_waveform(samples[start : start + block_frames], scale)
+            return
+
+        proc = subprocess.Popen(self.__ffmpeg_command(Path(path)), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            header = self.__read_wav_header(proc.stdout)
+            if not header:
+                raise RuntimeError(f"ffmpeg returned unreadable audio for {Path(path).name}: {self.__stderr(proc)}")
+
+            channels = header[1]
+            frame_size = 4 * channels
+            # A piped WAV's header can't be rewound to fill in its sizes, so read until ffmpeg stops writing
+            while data := proc.stdout.read(block_frames * frame_size):
+                frames = len(data) // frame_size
+                block = torch.frombuffer(bytearray(data[: frames * frame_size]), dtype=torch.float32)
+                yield convert_audio_channels(block.view(frames, channels).t(), self.channels)
+
+            if proc.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed to decode {Path(path).name}: {self.__stderr(proc)}")
+        finally:
+            # Also covers the consumer giving up part way through
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+
+    def __decode_ffmpeg(self, path: Path) -> torch.Tensor:
+        """Decodes a file of any format ffmpeg understands, reading the raw samples from its stdout
+
+        Args:
+            path (Path): The path of the audio file to decode
+
+        Raises:
+            RuntimeError: Thrown if ffmpeg fails to decode the file
+
+        Returns:
+            torch.Tensor: The decoded waveform, shaped (channels, samples)
+        """
+        proc = subprocess.run(self.__ffmpeg_command(path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {path.name}: {proc.stderr.decode(errors='replace').strip()}")
+
+        header = self.__read_wav_header(io.BytesIO(proc.stdout))
+        if not header:
+            raise RuntimeError(f"ffmpeg returned unreadable audio for {path.name}")
+
+        _, channels, _, _, data_offset, data_size = header
+        # A piped WAV's header can't be rewound to fill in its sizes, so go by how much was actually written
+        frames = min(data_size, len(proc.stdout) - data_offset) // (4 * channels)
+
+        # A bytearray is writable, so torch can take it over without copying again
+        samples = torch.frombuffer(bytearray(proc.stdout), dtype=torch.float32, offset=data_offset, count=frames * channels)
+        # Channels are converted here rather than by ffmpeg, which would also change the volume when up/down-mixing
+        return convert_audio_channels(samples.view(frames, channels).t(), self.channels)
+
+    def __ffmpeg_command(self, path: Path) -> List[str]:
+        """Builds the ffmpeg command that decodes a file to a float32 WAV on stdout. It's the same conversion Demucs'
+            own loader asks ffmpeg for, minus the probe beforehand and the temp file after. The WAV header means the
+            channel count comes back with the samples instead of from a probe"""
+        command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", str(path), "-map", "0:a:0", "-threads", "1"]
+        return command + ["-ar", str(self.samplerate), "-c:a", "pcm_f32le", "-f", "wav", "-"]
+
+    def __stderr(self, proc: subprocess.Popen) -> str:
+        """Reads what a finished (or killed) ffmpeg process had to say for itself"""
+        proc.wait()
+        return proc.stderr.read().decode(errors="replace").strip()
+
+    def __to_waveform(self, samples: np.ndarray, scale: Optional[float]) -> torch.Tensor:
+        """Turns mapped WAV samples, shaped (samples, channels), into a float waveform shaped (channels, samples)"""
+        wav = torch.from_numpy(samples).t()
+        if scale:
+            wav = wav.float() * scale
+        return convert_audio_channels(wav, self.channels)
+
+    def __map_wav(self, path: Path) -> Optional[Tuple[np.ndarray, Optional[float]]]:
+        """Memory-maps a WAV's samples. Float WAVs come back as a zero-copy view of the file; integer ones
+            only pay for the conversion to float
+
+        Args:
+            path (Path): The path of the WAV to map
+
+        Returns:
+            Optional[Tuple[np.ndarray, Optional[float]]]: The mapped samples, shaped (samples, channels), and what
+                to scale them by to get floats in [-1, 1]. None if the file isn't a WAV, or its layout or sample rate
+                needs ffmpeg to convert it
+        """
+        if path.suffix.lower() != ".wav":
+            return None
+
+        with open(path, "rb") as fh:
+            header = self.__read_wav_header(fh)
+        if not header:
+            return None
+
+        format_tag, channels, samplerate, bits, data_offset, data_size = header
+        sample_type = WAV_SAMPLE_TYPES.get((format_tag, bits))
+        if not sample_type or samplerate != self.samplerate or channels not in (1, self.channels):
+            return None
+
+        dtype, scale = sample_type
+        # Streamed WAVs can leave the data size unset (or wrong), so never map past the end of the file
+        frame_size = dtype.itemsize * channels
+        frames = min(data_size, path.stat().st_size - data_offset) // frame_size
+        if frames <= 0:
+            return np.zeros((0, channels), dtype=dtype), scale
+
+        # Copy-on-write, so nothing downstream can ever modify the original through the mapping
+        return np.memmap(path, dtype=dtype, mode="c", offset=data_offset, shape=(frames, channels)), scale
+
+    def __read_wav_header(self, fh: BinaryIO) -> Optional[tuple]:
+        """Walks a WAV's RIFF chunks to find its format and where its samples are. Only ever reads forwards,
+            so it works on pipes as well as files
+
+        Args:
+            fh (BinaryIO): The WAV to read, positioned at its start. Left positioned at the start of the samples
+
+        Returns:
+            Optional[tuple]: (format tag, channels, sample rate, bits per sample, data offset, data size),
+                or None if the file isn't a WAV this can make sense of
+        """
+        riff = fh.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:] != b"WAVE":
+            return None
+
+        fmt = None
+        position = 12
+        while len(chunk := fh.read(8)) == 8:
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+            position += 8
+
+            if chunk_id == b"data":
+                return (*fmt, position, chunk_size) if fmt else None
+
+            # Chunks are padded to an even length
+            body = fh.read(chunk_size + chunk_size % 2)
+            position += len(body)
+            if chunk_id == b"fmt ":
+                if len(body) < 16:
+                    return None
+                format_tag, channels, samplerate, _, _, bits = struct.unpack("<HHIIHH", body[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    # The real format is the first two bytes of the sub-format GUID
+                    format_tag = struct.unpack("<H", body[24:26])[0]
+                fmt = (format_tag, channels, samplerate, bits)
+        return None
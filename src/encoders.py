@@ -0,0 +1,262 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import multiprocessing
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import lameenc
+import numpy as np
+
+from src.formats import OutputFormat
+from src.tags import ContainerTags
+
+# The same encoder preset as `demucs.separate --mp3`
+MP3_PRESET = 2
+
+# LAME's own default VBR mode (vbr_mtrh), which is what `lame -V` uses
+LAME_VBR_MODE = 4
+
+# How many samples (per channel) are converted and handed to the encoder at a time
+BLOCK_FRAMES = 1024 * 1024
+
+
+class AudioEncoder:
+    def __init__(self, samplerate: int, channels: int, output_format: OutputFormat = OutputFormat(), workers: int = 0):
+        """Encodes separated stems to the chosen output format. MP3s are encoded in-process with the same encoder
+            Demucs uses; AAC and FLAC are piped through ffmpeg. With workers, the encoding itself happens in a pool of
+            processes of its own, so that several tracks can be encoded at once without competing with inference for
+            the GIL. Each call still waits for its own track to finish
+
+        Args:
+            samplerate (int): The stems' sample rate
+            channels (int): The stems' channel count
+            output_format (OutputFormat): What to encode to
+            workers (int): How many encoder processes to run. 0 encodes in the calling thread
+        """
+        self.samplerate = samplerate
+        self.channels = channels
+        self.output_format = output_format
+        # Spawned, since forking a process that's running torch's thread pools can leave the children deadlocked
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) if workers else None
+
+    def __enter__(self) -> "AudioEncoder":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stops the encoder processes, if there are any"""
+        if self.pool:
+            self.pool.shutdown()
+
+    def encode(self, wav: np.ndarray, path: Path, append: bool = False, tags: Optional[ContainerTags] = None) -> None:
+        """Encodes a whole waveform. MP3s come out byte-for-byte the same as `demucs.separate --mp3` makes them,
+            down to its "rescale" clipping prevention
+
+        Args:
+            wav (np.ndarray): The float32 waveform to encode, shaped (channels, samples)
+            path (Path): The destination path
+            append (bool): Write after whatever the file already holds (e.g. its tag) instead of replacing it.
+                Only MP3s can be appended to; other formats are always written from scratch
+            tags (Optional[ContainerTags]): The tags for formats the encoder tags itself. MP3s are tagged ahead of
+                time with `tags.write_tag_header` instead, so they're ignored for them
+        """
+        self.__run(encode_waveform, wav, Path(path), self.samplerate, self.output_format, append, tags)
+
+    def encode_spilled(
+        self, samples: Path, frames: int, peak: float, path: Path, append: bool = False, tags: Optional[ContainerTags] = None
+    ) -> None:
+        """Encodes a stem that was spilled to disk as raw interleaved float32 samples, a block at a time. The result
+            is the same as `encode` makes of the whole waveform
+
+        Args:
+            samples (Path): The spilled samples
+            frames (int): How many samples (per channel) were spilled
+            peak (float): The largest absolute sample in the stem
+            path (Path): The destination path
+            append (bool): See `encode`
+            tags (Optional[ContainerTags]): See `encode`
+        """
+        self.__run(
+            encode_spilled, samples, frames, self.channels, peak, Path(path), self.samplerate, self.output_format, append, tags
+        )
+
+    def retag(self, source: Path, path: Path, tags: Optional[ContainerTags]) -> None:
+        """Copies an already encoded file to the destination with different tags, without re-encoding it. Used for
+            cached outputs of the formats that the encoder tags, which are cached along with another track's tags
+
+        Args:
+            source (Path): The encoded file, in this encoder's format
+            path (Path): The destination path
+            tags (Optional[ContainerTags]): The tags to replace the source's with. None strips them
+        """
+        with CoverFile(tags, path) as cover:
+            command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", str(source)]
+            command += ffmpeg_tag_arguments(tags, cover.path, first_input=1) + ["-c:a", "copy", str(path)]
+            run_ffmpeg(command, path)
+
+    def __run(self, func, *args) -> None:
+        """Runs an encoding function in the pool if there is one, otherwise right here"""
+        if self.pool:
+            self.pool.submit(func, *args).result()
+        else:
+            func(*args)
+
+
+def encode_waveform(
+    wav: np.ndarray, path: Path, samplerate: int, output_format: OutputFormat, append: bool, tags: Optional[ContainerTags]
+) -> None:
+    """Encodes a whole waveform. Module-level so the encoder pool can run it. See `AudioEncoder.encode`"""
+    peak = float(np.abs(wav).max()) if wav.size else 0
+    blocks = (wav[:, start : start + BLOCK_FRAMES].T for start in range(0, wav.shape[-1], BLOCK_FRAMES))
+    encode_blocks(blocks, peak, path, samplerate, wav.shape[0], output_format, append, tags)
+
+
+def encode_spilled(
+    samples: Path,
+    frames: int,
+    channels: int,
+    peak: float,
+    path: Path,
+    samplerate: int,
+    output_format: OutputFormat,
+    append: bool,
+    tags: Optional[ContainerTags],
+) -> None:
+    """Encodes a stem spilled to disk. Module-level so the encoder pool can run it. See `AudioEncoder.encode_spilled`"""
+    mapped = np.memmap(samples, dtype="<f4", mode="r", shape=(frames, channels)) if frames else np.zeros((0, channels), "<f4")
+    blocks = (np.array(mapped[start : start + BLOCK_FRAMES]) for start in range(0, frames, BLOCK_FRAMES))
+    encode_blocks(blocks, peak, path, samplerate, channels, output_format, append, tags)
+    del mapped
+
+
+def encode_blocks(
+    blocks: Iterable[np.ndarray],
+    peak: float,
+    path: Path,
+    samplerate: int,
+    channels: int,
+    output_format: OutputFormat,
+    append: bool,
+    tags: Optional[ContainerTags],
+) -> None:
+    """Encodes a waveform handed over a block at a time, each shaped (samples, channels)
+
+    Args:
+        blocks (Iterable[np.ndarray]): The waveform's consecutive float32 blocks
+        peak (float): The largest absolute sample across every block
+        path (Path): The destination path
+        samplerate (int): The waveform's sample rate
+        channels (int): The waveform's channel count
+        output_format (OutputFormat): What to encode to
+        append (bool): Write after whatever the file already holds. MP3s only
+        tags (Optional[ContainerTags]): The tags for formats the encoder tags itself
+    """
+    # Demucs' "rescale": only quieten the whole track if it would otherwise clip, never make it louder
+    scale = np.float32(max(1.01 * np.float32(peak), 1))
+    pcm = ((np.clip(block / scale, -1, 1) * (2**15 - 1)).astype("<i2").tobytes() for block in blocks)
+
+    if output_format.container == "mp3":
+        encoder = lameenc.Encoder()
+        if output_format.vbr_quality is None:
+            encoder.set_bit_rate(output_format.bitrate)
+        else:
+            encoder.set_vbr(LAME_VBR_MODE)
+            encoder.set_vbr_quality(output_format.vbr_quality)
+        encoder.set_in_sample_rate(samplerate)
+        encoder.set_channels(channels)
+        encoder.set_quality(MP3_PRESET)
+
+        with open(path, "ab" if append else "wb") as fh:
+            for data in pcm:
+                fh.write(encoder.encode(data))
+            fh.write(encoder.flush())
+        return
+
+    with CoverFile(tags, path) as cover:
+        command = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y"]
+        command += ["-f", "s16le", "-ar", str(samplerate), "-ac", str(channels), "-i", "-"]
+        command += ffmpeg_tag_arguments(tags, cover.path, first_input=1)
+        if output_format.container == "m4a":
+            # The index up front lets players (and iPods) start without reading to the end of the file first
+            command += ["-c:a", "aac", "-b:a", f"{output_format.bitrate}k", "-movflags", "+faststart"]
+        else:
+            command += ["-c:a", "flac"]
+        command.append(str(path))
+
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            for data in pcm:
+                proc.stdin.write(data)
+        except BrokenPipeError:
+            pass  # ffmpeg gave up early; its exit code and stderr below say why
+        finally:
+            proc.stdin.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {Path(path).name}: {proc.stderr.read().decode(errors='replace').strip()}")
+        proc.stderr.close()
+
+
+def ffmpeg_tag_arguments(tags: Optional[ContainerTags], cover: Optional[Path], first_input: int) -> List[str]:
+    """Builds the ffmpeg arguments that tag an output with its metadata and cover
+
+    Args:
+        tags (Optional[ContainerTags]): The tags to write. None writes none, and drops any the input had
+        cover (Optional[Path]): The cover written out by `CoverFile`, if there's one to attach
+        first_input (int): Which ffmpeg input the cover will be, i.e. how many inputs come before it
+
+    Returns:
+        List[str]: The arguments, to follow the inputs
+    """
+    arguments = ["-map", "0:a", "-map_metadata", "-1"]
+    if cover:
+        arguments = ["-i", str(cover)] + arguments
+        arguments += ["-map", f"{first_input}:v", "-c:v", "copy", "-disposition:v", "attached_pic"]
+        # FLAC stores a picture type with each picture, which ffmpeg takes from the stream's comment
+        arguments += ["-metadata:s:v", "comment=Cover (front)"]
+    for key, value in (tags.fields if tags else {}).items():
+        arguments += ["-metadata", f"{key}={value}"]
+    return arguments
+
+
+def run_ffmpeg(command: List[str], path: Path) -> None:
+    """Runs an ffmpeg command that writes the given output, raising if it fails"""
+    proc = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to write {Path(path).name}: {proc.stderr.decode(errors='replace').strip()}")
+
+
+class CoverFile:
+    def __init__(self, tags: Optional[ContainerTags], path: Path):
+        """Writes an output's cover next to it for ffmpeg to read, since its only pipe is taken by the audio.
+            Removed again on the way out. Covers ffmpeg can't read are left out rather than failing the whole track
+
+        Args:
+            tags (Optional[ContainerTags]): The output's tags. Nothing is written if they don't have a cover
+            path (Path): The output the cover is for
+        """
+        self.path: Optional[Path] = None
+        if tags and tags.cover:
+            # The extension is how ffmpeg tells JPEGs and PNGs apart
+            extension = ".png" if tags.cover_mime_type == "image/png" else ".jpg"
+            self.path = Path(path).with_name(f"{Path(path).stem}.cover{extension}")
+        self.cover = tags.cover if tags else None
+
+    def __enter__(self) -> "CoverFile":
+        if self.path:
+            self.path.write_bytes(self.cover)
+            try:
+                run_ffmpeg(["ffmpeg", "-nostdin", "-loglevel", "error", "-i", str(self.path), "-f", "null", "-"], self.path)
+            except RuntimeError:
+                self.path.unlink()
+                self.path = None
+        return self
+
+    def __exit__(self, *_) -> None:
+        if self.path:
+            self.path.unlink(missing_ok=True)
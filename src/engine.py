@@ -0,0 +1,447 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import math
+import os
+import random
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import torch
+from demucs.apply import BagOfModels, TensorChunk, apply_model
+from demucs.htdemucs import HTDemucs
+from demucs.pretrained import get_model
+from demucs.utils import center_trim
+
+from src.backends import prepare_model
+from src.common import GPU_BACKENDS
+from src.decoder import AudioDecoder
+from src.presets import InferenceSettings
+from src.progress import ConversionCancelled
+
+if TYPE_CHECKING:
+    from src.activity import InactiveSpan
+    from src.shared_weights import SharedWeights
+
+# How far into a skipped stretch the model still runs on either side of the audio it splits, for context. The outputs
+# are crossfaded from the model's into the untouched audio across it
+SKIP_CONTEXT_SECONDS = 1.0
+
+
+class SeparationEngine:
+    def __init__(
+        self,
+        model_name: str,
+        jobs: int = os.cpu_count() or 2,
+        batch_segments: int = 0,
+        backend: str = "float32",
+        settings: Optional[InferenceSettings] = None,
+        shared_weights: Optional["SharedWeights"] = None,
+    ):
+        """A long-lived wrapper around a loaded Demucs model so that the weights are only read from disk once
+
+        Args:
+            model_name (str): The name of the Demucs model to load
+            jobs (int): How many threads Demucs may use to split a single track
+            batch_segments (int): If set, how many fixed-length segments to run through the model per forward pass,
+                drawn from as many tracks as are passed to `separate_batch`. 0 leaves batching to Demucs (one at a time)
+            backend (str): How to run the model, one of `backends.BACKENDS`. Only float32 and bfloat16 use the GPU
+            settings (Optional[InferenceSettings]): The shifts, overlap and segment length to split with. Defaults to
+                the balanced preset
+            shared_weights (Optional[SharedWeights]): Where to map the model's weights from, shared with every other
+                process doing the same, rather than loading a copy of them for this engine alone
+
+        Raises:
+            ValueError: Thrown if the settings are out of range for the model. See `configure`
+        """
+        self.model_name = model_name
+        self.jobs = jobs
+        self.batch_segments = batch_segments
+        self.shifts = 1
+        self.overlap = 0.25
+        # Overrides the segment length (in seconds) the model was trained with, if set
+        self.segment: Optional[float] = None
+        self.skip_silence = True
+        self.skip_drumless = False
+        self.backend = backend
+        self.variant = model_name
+        # Quantized layers only run on the CPU, and traced graphs are traced there
+        self.device = "cuda" if torch.cuda.is_available() and backend in GPU_BACKENDS else "cpu"
+
+        self.model = shared_weights.load(model_name) if shared_weights else get_model(model_name)
+        self.model.cpu()
+        self.model.eval()
+        self.configure(settings or InferenceSettings())
+
+        self.model = prepare_model(self.model, backend, model_name)
+        self.decoder = AudioDecoder(self.samplerate, self.audio_channels)
+
+        # When set, every forward pass from here on raises ConversionCancelled instead of running, so that a long
+        # track can be abandoned a segment into it rather than only once it's done
+        self.cancel: Optional[threading.Event] = None
+        for sub_model in self.model.models if isinstance(self.model, BagOfModels) else [self.model]:
+            sub_model.register_forward_pre_hook(self.__check_cancelled)
+
+    def configure(self, settings: InferenceSettings) -> None:
+        """Changes how much work the model puts into the tracks split from here on, without reloading it
+
+        Args:
+            settings (InferenceSettings): The shifts, overlap and segment length to split with
+
+        Raises:
+            ValueError: Thrown if the shifts or overlap are out of range, or the segment length is longer than a
+                transformer model can take
+        """
+        if settings.shifts < 0 or not 0 <= settings.overlap < 1:
+            raise ValueError(f"Expected shifts of at least 0 and an overlap from 0 to under 1, got {settings.shifts} and {settings.overlap}")
+
+        # The transformer's positional embeddings only stretch as far as the segments it was trained on
+        sub_models = self.model.models if isinstance(self.model, BagOfModels) else [self.model]
+        longest = min((float(model.segment) for model in sub_models if isinstance(model, HTDemucs)), default=None)
+        if settings.segment and longest and settings.segment > longest:
+            raise ValueError(f"{self.model_name} can't take segments longer than {longest:.2f} seconds")
+
+        self.shifts = settings.shifts
+        self.overlap = settings.overlap
+        self.segment = settings.segment
+        self.skip_silence = settings.skip_silence
+        self.skip_drumless = settings.skip_drumless
+        self.variant = settings.variant(self.model_name, self.backend)
+
+    @property
+    def samplerate(self) -> int:
+        return self.model.samplerate
+
+    @property
+    def audio_channels(self) -> int:
+        return self.model.audio_channels
+
+    def load_audio(self, path: Path) -> torch.Tensor:
+        """Decodes an audio file to a waveform matching the model's sample rate and channel count
+
+        Args:
+            path (Path): The path of the audio file to decode
+
+        Returns:
+            torch.Tensor: The decoded waveform, shaped (channels, samples)
+        """
+        return self.decoder.decode(path)
+
+    def separate(self, wav: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """Runs the loaded model over a decoded waveform
+
+        Args:
+            wav (torch.Tensor): The waveform to split, shaped (channels, samples)
+
+        Returns:
+            Dict[str, torch.Tensor]: Each of the model's sources mapped to its separated waveform
+        """
+        if self.batch_segments:
+            return self.separate_batch([wav])[0]
+
+        # Normalize the same way `demucs.separate` does so the output is identical
+        ref = wav.mean(0)
+        wav = (wav - ref.mean()) / ref.std()
+
+        with torch.no_grad():
+            sources = apply_model(
+                self.model,
+                wav[None],
+                device=self.device,
+                shifts=self.shifts,
+                split=True,
+                overlap=self.overlap,
+                num_workers=self.jobs,
+                segment=self.segment,
+            )[0]
+
+        sources = sources * ref.std() + ref.mean()
+        return dict(zip(self.model.sources, sources))
+
+    def separate_batch(self, wavs: List[torch.Tensor]) -> List[Dict[str, torch.Tensor]]:
+        """Runs the loaded model over several decoded waveforms at once. Every track is cut into the same
+            fixed-length segments Demucs would use, but segments from all of the tracks are stacked into batches
+            of `batch_segments` for each forward pass, then overlap-added back into their own track.
+            Short tracks that would never fill a batch by themselves make much better use of the CPU this way.
+            Without shifts the output matches `apply_model`'s. With shifts it's the same process but not the same
+            draw: every offset is drawn up front, and the transformer models draw from `random` on every forward
+            pass, of which there are fewer here. So even a seeded run shifts differently than `apply_model` would
+
+        Args:
+            wavs (List[torch.Tensor]): The waveforms to split, each shaped (channels, samples)
+
+        Returns:
+            List[Dict[str, torch.Tensor]]: For each waveform, the model's sources mapped to their separated waveforms
+        """
+        refs = [wav.mean(0) for wav in wavs]
+        mixes = [(wav - ref.mean()) / ref.std() for wav, ref in zip(wavs, refs)]
+
+        # A bag's sub-models are each run in full and then blended by their per-source weights, same as `apply_model`
+        if isinstance(self.model, BagOfModels):
+            sub_models = list(zip(self.model.models, self.model.weights))
+        else:
+            sub_models = [(self.model, [1.0] * len(self.model.sources))]
+
+        estimates = [torch.zeros(len(self.model.sources), *mix.shape) for mix in mixes]
+        totals = [0.0] * len(self.model.sources)
+        for sub_model, weights in sub_models:
+            for estimate, out in zip(estimates, self.__apply_shifted(sub_model, mixes)):
+                for k, inst_weight in enumerate(weights):
+                    estimate[k] += out[k] * inst_weight
+            for k, inst_weight in enumerate(weights):
+                totals[k] += inst_weight
+
+        results = []
+        for estimate, ref in zip(estimates, refs):
+            for k, total in enumerate(totals):
+                estimate[k] /= total
+            estimate = estimate * ref.std() + ref.mean()
+            results.append(dict(zip(self.model.sources, estimate)))
+        return results
+
+    def count_segments(self, wav: torch.Tensor, inactive: Sequence["InactiveSpan"] = ()) -> int:
+        """Estimates how many segments a waveform will be cut into per shift when batching
+
+        Args:
+            wav (torch.Tensor): The waveform to be split, shaped (channels, samples)
+            inactive (Sequence[InactiveSpan]): The stretches that'll be skipped over. See `split_drums`
+
+        Returns:
+            int: The number of segments
+        """
+        segment_length = int(self.samplerate * self.segment_seconds(self.model))
+        stride = int((1 - self.overlap) * segment_length)
+        pieces = self.__active_pieces(wav.shape[-1], inactive)
+        return max(1, sum(math.ceil((end - start) / stride) for start, end in pieces)) * max(1, self.shifts)
+
+    def skipped_seconds(self, wav: torch.Tensor, inactive: Sequence["InactiveSpan"]) -> float:
+        """Works out how much of a waveform the model won't have to run over
+
+        Args:
+            wav (torch.Tensor): The waveform to be split, shaped (channels, samples)
+            inactive (Sequence[InactiveSpan]): The stretches that'll be skipped over. See `split_drums`
+
+        Returns:
+            float: The seconds of audio skipped, less the context the model still runs over either side of them
+        """
+        pieces = self.__active_pieces(wav.shape[-1], inactive)
+        return (wav.shape[-1] - sum(end - start for start, end in pieces)) / self.samplerate
+
+    def split_drums(self, wav: torch.Tensor, inactive: Sequence["InactiveSpan"] = ()) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Separates a decoded waveform into just the drums and everything but the drums
+
+        Args:
+            wav (torch.Tensor): The waveform to split, shaped (channels, samples)
+            inactive (Sequence[InactiveSpan]): Stretches with nothing for the model to do, from `MusicFile.find_inactive`.
+                The model only runs over the rest; these are passed through untouched as the drumless mix, with silent drums
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The drum stem and the drumless mix, in that order
+        """
+        return self.__split_active([wav], [inactive], lambda pieces: [self.two_stems(self.separate(piece)) for piece in pieces])[0]
+
+    def split_drums_batch(
+        self, wavs: List[torch.Tensor], inactive: Optional[List[Sequence["InactiveSpan"]]] = None
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """Like `split_drums`, but for several waveforms at once using `separate_batch`. What's left of each waveform
+            once its inactive stretches are skipped is batched together with the rest
+
+        Args:
+            wavs (List[torch.Tensor]): The waveforms to split, each shaped (channels, samples)
+            inactive (Optional[List[Sequence[InactiveSpan]]]): The stretches to skip over in each waveform, if any
+
+        Returns:
+            List[Tuple[torch.Tensor, torch.Tensor]]: The drum stem and the drumless mix for each waveform, in order
+        """
+        return self.__split_active(
+            wavs, inactive or [()] * len(wavs), lambda pieces: [self.two_stems(sources) for sources in self.separate_batch(pieces)]
+        )
+
+    def two_stems(self, sources: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Mirrors `--two-stems drums`: everything that isn't the drums is summed into the other stem
+
+        Args:
+            sources (Dict[str, torch.Tensor]): Each of the model's sources mapped to its separated waveform
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The drum stem and the drumless mix, in that order
+        """
+        drums = sources.pop("drums")
+        no_drums = torch.zeros_like(drums)
+        for source in sources.values():
+            no_drums += source
+
+        return drums, no_drums
+
+    def __active_pieces(self, length: int, inactive: Sequence["InactiveSpan"]) -> List[Tuple[int, int]]:
+        """Gets the (start, end) of each piece of a waveform the model still has to run over, context included.
+            Stretches too short to leave anything skipped once the context is taken out of them are ignored"""
+        context = int(SKIP_CONTEXT_SECONDS * self.samplerate)
+        pieces, position = [], 0
+        for span in sorted(inactive, key=lambda span: span.start):
+            skip_start = 0 if span.start <= 0 else span.start + context
+            skip_end = length if span.end >= length else span.end - context
+            if skip_end <= skip_start or skip_start < position:
+                continue
+            if skip_start > position:
+                pieces.append((position, skip_start))
+            position = skip_end
+        if position < length:
+            pieces.append((position, length))
+        return pieces
+
+    def __split_active(
+        self,
+        wavs: List[torch.Tensor],
+        inactive: List[Sequence["InactiveSpan"]],
+        split: Callable[[List[torch.Tensor]], List[Tuple[torch.Tensor, torch.Tensor]]],
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """Runs `split` over just the pieces of each waveform that aren't skipped, then puts each waveform's outputs
+            back together around the untouched audio. A waveform with nothing skipped is split whole, exactly as before"""
+        context = int(SKIP_CONTEXT_SECONDS * self.samplerate)
+        placements = [(idx, piece) for idx, (wav, spans) in enumerate(zip(wavs, inactive)) for piece in self.__active_pieces(wav.shape[-1], spans)]
+        outputs = split([wavs[idx][:, start:end] for idx, (start, end) in placements]) if placements else []
+
+        results: List[Optional[Tuple[torch.Tensor, torch.Tensor]]] = [None] * len(wavs)
+        for (idx, (start, end)), (drums, no_drums) in zip(placements, outputs):
+            wav = wavs[idx]
+            if start == 0 and end == wav.shape[-1]:
+                results[idx] = (drums, no_drums)
+                continue
+
+            # Skipped stretches are given the mix as it is for the drumless output and silence for the drums. Across
+            # the context either side, the model's outputs fade into them
+            if results[idx] is None:
+                results[idx] = (torch.zeros_like(wav), wav.clone())
+            weight = torch.ones(end - start)
+            if start > 0:
+                weight[:context] = torch.linspace(0, 1, context)
+            if end < wav.shape[-1]:
+                weight[-context:] = torch.linspace(1, 0, context)
+            out_drums, out_no_drums = results[idx]
+            out_drums[:, start:end] = drums * weight
+            out_no_drums[:, start:end] = no_drums * weight + wav[:, start:end] * (1 - weight)
+
+        return [result or (torch.zeros_like(wav), wav.clone()) for result, wav in zip(results, wavs)]
+
+    def __apply_shifted(self, model: torch.nn.Module, mixes: List[torch.Tensor]) -> List[torch.Tensor]:
+        """Applies `shifts` random time shifts to each mix and averages the predictions, as `apply_model` does,
+            though with every offset drawn before any of them are run rather than each just before its own
+
+        Args:
+            model (torch.nn.Module): A single (non-bag) model
+            mixes (List[torch.Tensor]): The normalized mixes, each shaped (channels, samples)
+
+        Returns:
+            List[torch.Tensor]: The predictions for each mix, shaped (sources, channels, samples)
+        """
+        if not self.shifts:
+            return self.__apply_split(model, mixes)
+
+        max_shift = int(0.5 * model.samplerate)
+        units, trims = [], []
+        for mix in mixes:
+            length = mix.shape[-1]
+            padded_mix = TensorChunk(mix).padded(length + 2 * max_shift)
+            for _ in range(self.shifts):
+                offset = random.randint(0, max_shift)
+                units.append(TensorChunk(padded_mix, offset, length + max_shift - offset))
+                trims.append(max_shift - offset)
+
+        outs = self.__apply_split(model, units)
+
+        results = []
+        for idx in range(len(mixes)):
+            shifted = range(idx * self.shifts, (idx + 1) * self.shifts)
+            results.append(sum(outs[i][..., trims[i] :] for i in shifted) / self.shifts)
+        return results
+
+    def __apply_split(self, model: torch.nn.Module, units: List[Union[torch.Tensor, TensorChunk]]) -> List[torch.Tensor]:
+        """Cuts every unit into overlapping segments, runs them through the model in batches of `batch_segments`,
+            then overlap-adds the results back per unit with the same triangular weighting as `apply_model`
+
+        Args:
+            model (torch.nn.Module): A single (non-bag) model
+            units (List[Union[torch.Tensor, TensorChunk]]): The audio to split, each shaped (channels, samples)
+
+        Returns:
+            List[torch.Tensor]: The predictions for each unit, shaped (sources, channels, samples)
+        """
+        model.to(self.device)
+        model.eval()
+
+        segment_length = int(model.samplerate * self.segment_seconds(model))
+        stride = int((1 - self.overlap) * segment_length)
+
+        weight = torch.cat(
+            [
+                torch.arange(1, segment_length // 2 + 1),
+                torch.arange(segment_length - segment_length // 2, 0, -1),
+            ]
+        )
+        weight = weight / weight.max()
+
+        outs = [torch.zeros(len(model.sources), unit.shape[0], unit.shape[-1]) for unit in units]
+        sum_weights = [torch.zeros(unit.shape[-1]) for unit in units]
+
+        # Segments are grouped by the length the model needs them padded to, so that they stack. That's the full
+        # segment length for all but the tail of each unit, which is padded exactly as `apply_model` would pad it
+        groups: Dict[int, List[Tuple[int, int, TensorChunk]]] = {}
+        for idx, unit in enumerate(units):
+            for offset in range(0, unit.shape[-1], stride):
+                chunk = TensorChunk(unit, offset, segment_length)
+                groups.setdefault(self.valid_length(model, chunk.length), []).append((idx, offset, chunk))
+
+        batch_size = self.batch_segments or 1
+        for valid_length, segments in groups.items():
+            for start in range(0, len(segments), batch_size):
+                batch = segments[start : start + batch_size]
+                padded = torch.stack([chunk.padded(valid_length) for _, _, chunk in batch]).to(self.device)
+                with torch.no_grad():
+                    batch_out = model(padded).cpu()
+
+                for (idx, offset, chunk), chunk_out in zip(batch, batch_out):
+                    chunk_out = center_trim(chunk_out, chunk.length)
+                    outs[idx][..., offset : offset + chunk.length] += weight[: chunk.length] * chunk_out
+                    sum_weights[idx][offset : offset + chunk.length] += weight[: chunk.length]
+
+        return [out / sum_weight for out, sum_weight in zip(outs, sum_weights)]
+
+    def __check_cancelled(self, *_) -> None:
+        """Forward pre-hook that abandons the forward pass once `cancel` is set"""
+        if self.cancel and self.cancel.is_set():
+            raise ConversionCancelled("Cancelled")
+
+    def segment_seconds(self, model: torch.nn.Module) -> float:
+        """Gets the segment length to split audio into: the override if set, otherwise what the model was trained
+            with. For a bag, its first sub-model's
+
+        Args:
+            model (torch.nn.Module): The model (or bag) the audio will be split for
+
+        Returns:
+            float: The segment length in seconds
+        """
+        if self.segment:
+            return self.segment
+        if isinstance(model, BagOfModels):
+            return float(model.models[0].segment)
+        return float(model.segment)
+
+    def valid_length(self, model: torch.nn.Module, length: int) -> int:
+        """Gets how long a segment must be padded to before the model can take it, the same way `apply_model` does
+
+        Args:
+            model (torch.nn.Module): A single (non-bag) model
+            length (int): The segment's length in samples
+
+        Returns:
+            int: The padded length in samples
+        """
+        if isinstance(model, HTDemucs) and self.segment:
+            return int(model.samplerate * self.segment)
+        if hasattr(model, "valid_length"):
+            return model.valid_length(length)
+        return length
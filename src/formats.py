@@ -0,0 +1,84 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+from dataclasses import dataclass
+from typing import Optional
+
+OUTPUT_FORMATS = ["mp3", "m4a", "flac"]
+
+MIME_TYPES = {"mp3": "audio/mpeg", "m4a": "audio/mp4", "flac": "audio/flac"}
+
+# The same bitrate as `demucs.separate --mp3`
+MP3_BITRATE = 320
+
+# What each format's bitrate defaults to, in kbps. AAC at 256 is what the iTunes Store sells
+DEFAULT_BITRATES = {"mp3": MP3_BITRATE, "m4a": 256, "flac": 0}
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """What the outputs are encoded to"""
+
+    container: str = "mp3"  # One of OUTPUT_FORMATS
+    bitrate: int = MP3_BITRATE  # In kbps. Constant for MP3s and the target for AAC. FLAC is lossless and ignores it
+    vbr_quality: Optional[int] = None  # LAME's -V, from 0 (best) to 9. Makes MP3s variable bitrate instead
+
+    @staticmethod
+    def for_container(container: str, bitrate: Optional[int] = None, vbr_quality: Optional[int] = None) -> "OutputFormat":
+        """Creates the format for a container, filling in its default bitrate if none is given
+
+        Args:
+            container (str): One of OUTPUT_FORMATS
+            bitrate (Optional[int]): The bitrate in kbps. Defaults to DEFAULT_BITRATES' for the container
+            vbr_quality (Optional[int]): LAME's -V, from 0 (best) to 9, for variable bitrate MP3s
+
+        Raises:
+            ValueError: Thrown if the container isn't supported, or VBR is asked of anything but an MP3
+
+        Returns:
+            OutputFormat: The format
+        """
+        if container not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {container}, expected one of {', '.join(OUTPUT_FORMATS)}")
+        if vbr_quality is not None and (container != "mp3" or not 0 <= vbr_quality <= 9):
+            raise ValueError("Variable bitrate is only for MP3s, with a quality from 0 (best) to 9")
+        if container == "flac":
+            bitrate = 0  # Lossless, so there's no bitrate to pick and nothing to tell two FLACs apart by
+        return OutputFormat(container, bitrate or DEFAULT_BITRATES[container], vbr_quality)
+
+    @property
+    def extension(self) -> str:
+        return f".{self.container}"
+
+    @property
+    def mime_type(self) -> str:
+        return MIME_TYPES[self.container]
+
+    @property
+    def tags_ahead(self) -> bool:
+        """Whether the outputs are tagged by writing an ID3 tag ahead of the audio, rather than by the encoder"""
+        return self.container == "mp3"
+
+    def describe(self) -> str:
+        """Describes the format for people, e.g. "mp3 at 320 kbps" or "mp3 at V2"
+
+        Returns:
+            str: The description
+        """
+        if self.container == "flac":
+            return "flac"
+        if self.container == "mp3" and self.vbr_quality is not None:
+            return f"mp3 at V{self.vbr_quality}"
+        return f"{self.container} at {self.bitrate} kbps"
+
+    def variant(self, variant: str) -> str:
+        """Names what's made of a model's output in this format, so outputs encoded differently aren't mistaken for each other
+
+        Args:
+            variant (str): What the model (and the settings it runs with) are known as
+
+        Returns:
+            str: Just the variant for the default format, so that what was recorded before there were formats still counts
+        """
+        return variant if self == OutputFormat() else f"{variant} as {self.describe()}"
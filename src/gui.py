@@ -3,13 +3,15 @@
 """
 
 import importlib
+import multiprocessing
 import os
 import platform
-import subprocess
 import sys
+from datetime import timedelta
 from pathlib import Path
 from typing import Callable, List, Union
 
+from PySide6.QtCore import QThread, Signal, SignalInstance
 from PySide6.QtGui import QIcon
 from PySide6.QtWidgets import (
     QApplication,
@@ -18,15 +20,103 @@ from PySide6.QtWidgets import (
     QHBoxLayout,
     QLabel,
     QMainWindow,
+    QPlainTextEdit,
+    QProgressBar,
     QPushButton,
     QVBoxLayout,
     QWidget,
 )
 
 from src.common import MODEL_CHOICES
+from src.presets import PRESETS
+from src.progress import ProgressEvent
 
 APP_ID = "com.oitsjustjose.drum-track-converter"
 
+# The progress bar's resolution, so that it moves smoothly through long tracks rather than a file at a time
+PROGRESS_STEPS = 1000
+
+
+class SignalOutput:
+    def __init__(self, signal: SignalInstance):
+        """Stands in for CliOutput, sending each message over a Qt signal instead of printing it, so that it can be
+            shown in the window no matter which thread it came from
+
+        Args:
+            signal (SignalInstance): Emitted with the level's name and the message
+        """
+        self.signal = signal
+
+    def info(self, input):
+        self.signal.emit("info", f"{input}")
+
+    def warning(self, input):
+        self.signal.emit("warning", f"{input}")
+
+    def error(self, input):
+        self.signal.emit("error", f"{input}")
+
+
+class ConversionThread(QThread):
+    # Emitted from the conversion's own threads. Qt queues them over to the window's thread
+    progress = Signal(object)
+    message = Signal(str, str)
+
+    def __init__(self):
+        """Runs conversions off of the UI thread, one at a time. The thread keeps the models it's used loaded between
+        runs, so only the first run with a model has to wait on it loading"""
+        super().__init__()
+        self.arguments: tuple = ()
+        # Both created on the conversion's thread, since creating them means importing torch
+        self.registry = None
+        self.processor = None
+        self.cancel_requested = False
+
+    def convert(self, input_dir: str, output_dir: str, model_name: str, preset: str) -> None:
+        """Starts converting a folder. `finished` is emitted once it's done, fails or is cancelled
+
+        Args:
+            input_dir (str): The source directory to traverse and convert
+            output_dir (str): The destination directory to mirror the source into
+            model_name (str): The name of the Demucs model to use
+            preset (str): One of PRESETS
+        """
+        self.arguments = (input_dir, output_dir, model_name, preset)
+        self.processor = None
+        self.cancel_requested = False
+        self.start()
+
+    def cancel(self) -> None:
+        """Stops the conversion at its soonest convenience. The file being split is abandoned partway through"""
+        # Flagged first, so that a processor that's only just being created still sees it. See `run`
+        self.cancel_requested = True
+        if self.processor:
+            self.processor.cancel()
+
+    def run(self) -> None:
+        output = SignalOutput(self.message)
+        input_dir, output_dir, model_name, preset = self.arguments
+        try:
+            # Imported here rather than up top so that the window doesn't wait on torch to show up
+            from src.processor import FolderProcessor
+            from src.registry import ModelRegistry
+
+            self.registry = self.registry or ModelRegistry()
+            self.processor = FolderProcessor(
+                input_dir,
+                output_dir,
+                model_name,
+                output,
+                settings=PRESETS[preset],
+                registry=self.registry,
+                on_progress=self.progress.emit,
+            )
+            if self.cancel_requested:
+                self.processor.cancel()
+            self.processor.process_directory()
+        except Exception as e:
+            output.error(f"{e}")
+
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -36,11 +126,18 @@ class MainWindow(QMainWindow):
         self.input_dir: str = ""
         self.output_dir: str = ""
         self.model_name: str = list(MODEL_CHOICES.values())[0]
-        # The subprocess used for the internal call to cli.py
-        self.__child_proc: subprocess.Popen = None
+        self.preset: str = "balanced"
+        # Does the converting, keeping the model loaded from one run to the next
+        self.conversion = ConversionThread()
+        self.conversion.progress.connect(self.on_progress)
+        self.conversion.message.connect(self.on_message)
+        self.conversion.finished.connect(self.on_finished)
 
         # Widgets that we'll want to set & mutate throughout the runtime
         self.start_button: QPushButton = None
+        self.progress_bar: QProgressBar = None
+        self.status_label: QLabel = None
+        self.log_pane: QPlainTextEdit = None
         self.interactive_elements: List[QWidget] = list()
 
         self.setWindowTitle("Drum Track Converter by oitsjustjose")
@@ -79,30 +176,70 @@ class MainWindow(QMainWindow):
         """
         self.model_name = MODEL_CHOICES[model_display_name]
 
+    def on_preset_changed(self, preset_display_name: str) -> None:
+        """Sets the preset to the new preset based on the display name
+
+        Args:
+            preset_display_name (str): The display name of the preset
+        """
+        self.preset = preset_display_name.lower()
+
     def on_start_clicked(self):
-        """Passes through basic assertions, spins up thread to process files from the input and output params"""
+        """Passes through basic assertions, spins up thread to process files from the input and output params.
+        While that's running, the Start button becomes a Cancel button"""
+        if self.conversion.isRunning():
+            self.conversion.cancel()
+            self.start_button.setEnabled(False)
+            self.start_button.setText("Cancelling..")
+            return
+
         if not (self.input_dir and self.output_dir):
             return
 
-        # Since wait() is blocking, hide the main window so that the user doesn't get confused by it looking forzen
-        self.setHidden(True)
-        [x.setEnabled(False) for x in self.interactive_elements]
+        [x.setEnabled(False) for x in self.interactive_elements if x is not self.start_button]
+        self.start_button.setText("Cancel")
+        self.progress_bar.setValue(0)
+        self.status_label.setText("Starting..")
+        self.log_pane.clear()
 
-        cli = get_path("dtc_cli.exe") if platform.system() == "Windows" else ""
-        prefix = "start /wait" if platform.system() == "Windows" else ""
-        command = f"{prefix} {cli} {self.input_dir} {self.output_dir} -m {self.model_name}"
+        self.conversion.convert(self.input_dir, self.output_dir, self.model_name, self.preset)
 
-        self.__child_proc = subprocess.Popen(command.split(" "), shell=True, creationflags=subprocess.CREATE_NEW_CONSOLE)
-        self.__child_proc.wait()
+    def on_progress(self, event: ProgressEvent) -> None:
+        """Shows where the conversion has got to
 
-        # Re-enable elements now that everything is done
-        self.setHidden(False)
+        Args:
+            event (ProgressEvent): The latest progress from the conversion
+        """
+        self.progress_bar.setValue(round(event.fraction * PROGRESS_STEPS))
+
+        status = f"File {event.file_index} of {event.total_files} ({event.file_name}): {event.stage}"
+        if event.realtime_factor:
+            status += f" | {event.realtime_factor:.1f}x realtime"
+        if event.eta_seconds is not None:
+            status += f" | {timedelta(seconds=round(event.eta_seconds))} left"
+        self.status_label.setText(status)
+
+    def on_message(self, level: str, message: str) -> None:
+        """Adds a message from the conversion to the log pane
+
+        Args:
+            level (str): "info", "warning" or "error"
+            message (str): The message itself
+        """
+        self.log_pane.appendPlainText(f"[{level.upper()}] - {message}")
+
+    def on_finished(self) -> None:
+        """Re-enables everything once the conversion is done, has failed or was cancelled"""
         [x.setEnabled(True) for x in self.interactive_elements]
+        self.start_button.setText("Start")
+        # The details of the run are in the log pane
+        self.status_label.setText("Cancelled" if self.conversion.cancel_requested else "Finished")
 
     def stop(self):
-        """Stops the working thread (if it's been started) at its soonest convenience..."""
-        if self.__child_proc:
-            self.__child_proc.kill()
+        """Stops the working thread (if it's been started) at its soonest convenience, waiting for it to wrap up"""
+        if self.conversion.isRunning():
+            self.conversion.cancel()
+            self.conversion.wait()
 
     """~~Hidden / private methods~~"""
 
@@ -134,11 +271,23 @@ class MainWindow(QMainWindow):
         self.interactive_elements = [
             self.__make_io_buttons(),
             self.__make_model_combobox(),
+            self.__make_preset_combobox(),
             self.start_button,
         ]
 
         [self.layout.addWidget(x) for x in self.interactive_elements]
 
+        # Progress stays visible (and enabled) throughout, so it isn't part of the elements above
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, PROGRESS_STEPS)
+        self.progress_bar.setTextVisible(False)
+        self.status_label = self.__create_label("")
+        self.log_pane = QPlainTextEdit()
+        self.log_pane.setReadOnly(True)
+        self.log_pane.setMinimumHeight(160)
+
+        [self.layout.addWidget(x) for x in (self.progress_bar, self.status_label, self.log_pane)]
+
     def __make_io_buttons(self) -> QWidget:
         """Makes the Input and Output Folder Buttons
 
@@ -202,6 +351,29 @@ class MainWindow(QMainWindow):
         widget.setLayout(layout)
         return widget
 
+    def __make_preset_combobox(self) -> QWidget:
+        """Makes a Combobox to choose how much work to put into each track
+
+        Returns:
+            QWidget: The HBox widget created
+        """
+        widget = QWidget()
+        layout = QHBoxLayout()
+
+        label = self.__create_label("Quality")
+        label.setToolTip("Fast makes a single pass over each track. Best averages several passes, taking several times as long")
+
+        combo_box = QComboBox()
+        for preset in PRESETS:
+            combo_box.addItem(preset.capitalize())
+        combo_box.setCurrentText(self.preset.capitalize())
+        combo_box.currentTextChanged.connect(self.on_preset_changed)
+
+        layout.addWidget(label)
+        layout.addWidget(combo_box)
+        widget.setLayout(layout)
+        return widget
+
     def __create_label(self, text: str) -> QLabel:
         """Creates a label in a single call that is horizontally centered and automatically sized, with the provided text and pos.
 
@@ -276,6 +448,9 @@ def get_path(path: Union[Path, str]) -> Path:
 
 
 if __name__ == "__main__":
+    # The encoder processes are started by re-running this executable when it's been bundled
+    multiprocessing.freeze_support()
+
     # Set the AppUserModelId so that the proper taskbar icon renders
     if platform.system() == "Windows":
         import ctypes
@@ -0,0 +1,78 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+# Nothing but the standard library's lightest modules, since everything imported before the profiler starts goes unseen
+import builtins
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+
+class ImportProfiler:
+    def __init__(self):
+        """Times every module imported while it's active, totalled by the top-level package each belongs to. A module's
+            time doesn't include the modules it imports in turn, so each package is only charged for its own imports"""
+        self.seconds: Dict[str, float] = {}
+        self.modules: Dict[str, int] = {}
+        self.start_time: float = 0
+        self.wall_seconds: float = 0
+        self.original_import = None
+        # Each thread's imports in progress, innermost last, with how long the imports nested inside each have taken
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "ImportProfiler":
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    def start(self) -> "ImportProfiler":
+        """Starts timing imports, for when they can't all be wrapped in a `with` block, such as a module's own
+
+        Returns:
+            ImportProfiler: This profiler
+        """
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.__import
+        self.start_time = time.perf_counter()
+        return self
+
+    def stop(self) -> None:
+        """Stops timing imports"""
+        builtins.__import__ = self.original_import
+        self.wall_seconds = time.perf_counter() - self.start_time
+
+    def summary(self) -> List[Tuple[str, float, int]]:
+        """Totals up the imports so far, most expensive first
+
+        Returns:
+            List[Tuple[str, float, int]]: Each top-level package with the seconds spent importing it and how many of
+                its modules were timed being imported
+        """
+        with self.lock:
+            return sorted(((name, seconds, self.modules[name]) for name, seconds in self.seconds.items()), key=lambda row: -row[1])
+
+    def __import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        """Stands in for `__import__`, timing imports of modules that haven't been imported yet"""
+        # Relative imports stay within the package doing the importing, so they're left to count towards it
+        if level or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            seconds = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += seconds
+
+            package = name.partition(".")[0]
+            with self.lock:
+                self.seconds[package] = self.seconds.get(package, 0) + seconds - nested
+                self.modules[package] = self.modules.get(package, 0) + 1
@@ -0,0 +1,250 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import cProfile
+import csv
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, where peak RSS just isn't reported
+    resource = None
+
+# Only needed once something's actually profiled, and importing it takes seconds
+if TYPE_CHECKING:
+    import torch
+
+
+@dataclass
+class StageTiming:
+    """What a single stage of converting a single file cost"""
+
+    file: str
+    stage: str
+    wall_seconds: float = 0
+    cpu_seconds: float = 0
+    peak_rss_mb: float = 0
+    audio_seconds: float = 0
+    skipped_seconds: float = 0  # How much of the audio the model didn't have to run over
+
+
+def peak_rss_mb() -> float:
+    """Gets this process' peak resident memory so far
+
+    Returns:
+        float: The peak RSS in megabytes, or 0 if the platform can't report it
+    """
+    if not resource:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+class RunReport:
+    def __init__(self, model_name: str):
+        """Collects per-file, per-stage timings over a run and writes them out as a machine-readable report
+
+        Args:
+            model_name (str): The name of the Demucs model used for the run
+        """
+        self.model_name = model_name
+        self.timings: List[StageTiming] = []
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, path: Path, stage: str, audio_seconds: float = 0) -> Iterator[StageTiming]:
+        """Times the enclosed block as a stage of the given file. CPU time is for the whole process, since torch
+            does its work on its own threads; stages running side-by-side in the pipeline will overlap a little
+
+        Args:
+            path (Path): The file being worked on
+            stage (str): The name of the stage
+            audio_seconds (float): How much audio the stage covers. Can also be set on the yielded timing
+
+        Yields:
+            StageTiming: The timing being recorded, for filling in anything only known part way through
+        """
+        timing = StageTiming(str(path), stage, audio_seconds=audio_seconds)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield timing
+        finally:
+            timing.wall_seconds = time.perf_counter() - wall
+            timing.cpu_seconds = time.process_time() - cpu
+            timing.peak_rss_mb = peak_rss_mb()
+            self.add([timing])
+
+    @contextmanager
+    def measure_batch(self, paths: List[Path], durations: List[float], stage: str, skipped: Optional[List[float]] = None) -> Iterator[None]:
+        """Times the enclosed block as a stage shared by several files, splitting the cost between them by duration
+
+        Args:
+            paths (List[Path]): The files being worked on together
+            durations (List[float]): How many seconds of audio each file has
+            stage (str): The name of the stage
+            skipped (Optional[List[float]]): How many seconds of each file's audio the model skipped over, if any
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            total = sum(durations) or len(durations)
+            shares = [(duration or 1) / total for duration in durations]
+            self.add(
+                [
+                    StageTiming(str(path), stage, wall * share, cpu * share, peak_rss_mb(), duration, skipped_seconds)
+                    for path, duration, share, skipped_seconds in zip(paths, durations, shares, skipped or [0] * len(paths))
+                ]
+            )
+
+    def add(self, timings: List[StageTiming]) -> None:
+        """Adds timings recorded elsewhere, such as in a worker process
+
+        Args:
+            timings (List[StageTiming]): The timings to add
+        """
+        with self.lock:
+            self.timings.extend(timings)
+
+    def summary(self) -> Dict:
+        """Totals the timings up per stage, along with the realtime factor of the run as a whole
+
+        Returns:
+            Dict: The summary, ready to be serialized
+        """
+        wall_seconds = time.perf_counter() - self.started
+        stages: Dict[str, Dict[str, float]] = {}
+        for timing in self.timings:
+            stage = stages.setdefault(
+                timing.stage, {"wall_seconds": 0, "cpu_seconds": 0, "audio_seconds": 0, "skipped_seconds": 0, "peak_rss_mb": 0}
+            )
+            stage["wall_seconds"] += timing.wall_seconds
+            stage["cpu_seconds"] += timing.cpu_seconds
+            stage["audio_seconds"] += timing.audio_seconds
+            stage["skipped_seconds"] += timing.skipped_seconds
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], timing.peak_rss_mb)
+
+        for stage in stages.values():
+            stage["realtime_factor"] = stage["audio_seconds"] / stage["wall_seconds"] if stage["wall_seconds"] else 0
+
+        # Every file is decoded exactly once (even cache hits), so that's what the run's audio total comes from
+        audio_seconds = stages.get("decode", {}).get("audio_seconds", 0)
+        return {
+            "model": self.model_name,
+            "files": len({timing.file for timing in self.timings}),
+            "wall_seconds": wall_seconds,
+            "audio_seconds": audio_seconds,
+            "realtime_factor": audio_seconds / wall_seconds if wall_seconds else 0,
+            # Silent or drumless audio the model was never run over
+            "skipped_seconds": stages.get("separate", {}).get("skipped_seconds", 0),
+            "stages": stages,
+        }
+
+    def write(self, path: Path) -> None:
+        """Writes the report to disk. A `.csv` path gets one row per timing; anything else gets JSON with
+            both the summary and every timing
+
+        Args:
+            path (Path): Where to write the report
+        """
+        os.makedirs(Path(path).parent, exist_ok=True)
+
+        if Path(path).suffix.lower() == ".csv":
+            with open(path, "w", newline="") as fh:
+                writer = csv.DictWriter(fh, fieldnames=["model"] + [field.name for field in fields(StageTiming)])
+                writer.writeheader()
+                for timing in self.timings:
+                    writer.writerow({"model": self.model_name, **asdict(timing)})
+            return
+
+        with open(path, "w") as fh:
+            json.dump({**self.summary(), "timings": [asdict(timing) for timing in self.timings]}, fh, indent=2)
+
+
+class SlowestProfiles:
+    def __init__(self, count: int, out_dir: Path):
+        """Profiles inference with both cProfile and the torch profiler, keeping only the traces for the slowest
+            `count` runs so that memory doesn't grow with the size of the library
+
+        Args:
+            count (int): How many of the slowest traces to keep
+            out_dir (Path): Where to dump the traces at the end of the run
+        """
+        self.count = count
+        self.out_dir = Path(out_dir)
+        # A min-heap of (wall seconds, tiebreaker, label, cProfile, torch profiler), so the fastest is popped first
+        self.slowest: List[Tuple[float, int, str, cProfile.Profile, "torch.profiler.profile"]] = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, label: str) -> Iterator[None]:
+        """Profiles the enclosed block, keeping the traces if it's one of the slowest so far
+
+        Args:
+            label (str): What the traces are for, used to name the dumped files
+        """
+        import torch
+
+        profiler = cProfile.Profile()
+        torch_profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+
+        start = time.perf_counter()
+        with torch_profiler:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+        wall_seconds = time.perf_counter() - start
+
+        with self.lock:
+            entry = (wall_seconds, id(profiler), label, profiler, torch_profiler)
+            if len(self.slowest) < self.count:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def dump(self) -> List[Path]:
+        """Writes out the kept traces, slowest first: a `.prof` for cProfile and a `.json` Chrome trace for torch
+
+        Returns:
+            List[Path]: The paths written to
+        """
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        written = []
+        for rank, (_, _, label, profiler, torch_profiler) in enumerate(sorted(self.slowest, reverse=True), start=1):
+            stem = f"{rank:02d}-{Path(label).stem}"
+            profiler.dump_stats(self.out_dir.joinpath(f"{stem}.prof"))
+            torch_profiler.export_chrome_trace(str(self.out_dir.joinpath(f"{stem}.json")))
+            written += [self.out_dir.joinpath(f"{stem}.prof"), self.out_dir.joinpath(f"{stem}.json")]
+        return written
+
+
+def maybe_measure(report: Optional[RunReport], path: Path, stage: str, audio_seconds: float = 0):
+    """`RunReport.measure` when there's a report to record into, otherwise a no-op context
+
+    Args:
+        report (Optional[RunReport]): The report to record into, if any
+        path (Path): The file being worked on
+        stage (str): The name of the stage
+        audio_seconds (float): How much audio the stage covers
+
+    Returns:
+        ContextManager[Optional[StageTiming]]: The context to time the stage within
+    """
+    return report.measure(path, stage, audio_seconds) if report else nullcontext(StageTiming(str(path), stage))
@@ -0,0 +1,342 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional
+from uuid import uuid4
+
+from tinytag import TinyTag
+
+from src.common import MODEL_CHOICES
+from src.formats import OutputFormat
+from src.presets import InferenceSettings
+from src.registry import DEFAULT_BUDGET_BYTES, RegistryStats
+from src.scratch import ScratchSpace
+from src.shared_weights import SharedWeights
+from src.workers import init_worker, preload_in_worker, separate_in_worker
+
+# The states a queued job moves through, in order. A job ends up either DONE or FAILED
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Uploads are copied to disk this many bytes at a time
+UPLOAD_CHUNK_BYTES = 1024**2
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue already holds as many unfinished jobs as it's allowed"""
+
+
+@dataclass
+class QueuedJob:
+    """A single file's progress through the job queue"""
+
+    id: str
+    name: str
+    model_name: str
+    upload_dir: Optional[Path]  # None if the file isn't the queue's to remove
+    state: str = QUEUED
+    output: Optional[Path] = None
+    error: str = ""
+    submitted: float = field(default_factory=time.time)
+    finished: float = 0
+
+
+class JobQueue:
+    def __init__(
+        self,
+        scratch_dir: Path,
+        workers: int = 1,
+        keep_finished: float = 60 * 60,
+        stream_above: float = 20,
+        stream_window: float = 30,
+        max_pending: int = 0,
+        model_name: str = list(MODEL_CHOICES.values())[0],
+        model_budget: int = DEFAULT_BUDGET_BYTES,
+        backend: str = "float32",
+        settings: Optional[InferenceSettings] = None,
+        output_format: OutputFormat = OutputFormat(),
+    ):
+        """A local queue of files to split, shared by everyone using the same process. Its long-lived worker
+            processes keep the models they've used loaded, within a memory budget, so submitting a file only waits
+            on a model loading if that model hasn't been used lately. The workers map their models' weights from
+            shared files rather than each loading a copy, so extra workers mostly cost the memory they separate with
+
+        Args:
+            scratch_dir (Path): Where to keep uploads and outputs until they're collected
+            workers (int): How many worker processes to run. They share the weights of the models they've loaded
+            keep_finished (float): How many seconds to keep a finished job's output around for before removing it
+            stream_above (float): Files longer than this many minutes are separated a window at a time. 0 disables streaming
+            stream_window (float): How many seconds of audio to work on at a time when streaming
+            max_pending (int): The most unfinished jobs to accept at once, beyond which `submit` turns new ones away
+                rather than letting the wait grow without bound. 0 accepts everything
+            model_name (str): The model each worker loads as soon as it starts
+            model_budget (int): The most memory, in bytes, each worker's resident models' weights may take up
+            backend (str): How to run the models, one of `backends.BACKENDS`
+            settings (Optional[InferenceSettings]): The shifts, overlap and segment length for jobs that don't ask for
+                their own. Defaults to the balanced preset
+            output_format (OutputFormat): What to encode the outputs of jobs that don't ask for a format to
+        """
+        self.scratch = ScratchSpace(scratch_dir)
+        self.workers = max(1, workers)
+        self.keep_finished = keep_finished
+        self.stream_above = stream_above
+        self.stream_window = stream_window
+        self.max_pending = max_pending
+        self.model_name = model_name
+        self.model_budget = model_budget
+        self.backend = backend
+        self.settings = settings or InferenceSettings()
+        self.output_format = output_format
+        self.jobs: Dict[str, QueuedJob] = {}
+        self.pool: Optional[ProcessPoolExecutor] = None
+        # Totalled across every worker from the jobs they've finished
+        self.model_stats = RegistryStats()
+        self.futures: Dict[str, Future] = {}
+        self.shared_weights: Optional[SharedWeights] = None  # Created along with the scratch space, in `start`
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> "JobQueue":
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.shutdown()
+
+    def start(self) -> "JobQueue":
+        """Creates the queue's scratch space. The workers only start once there's work for them, or `preload` is called
+
+        Returns:
+            JobQueue: The queue itself, for chaining
+        """
+        self.scratch.__enter__()
+        self.shared_weights = SharedWeights(self.scratch.path.joinpath("weights"))
+        return self
+
+    def shutdown(self) -> None:
+        """Stops every worker, abandoning whatever is still queued, and removes all uploads and outputs"""
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+        self.scratch.__exit__()
+
+    def preload(self, model_name: str) -> None:
+        """Loads a model here, for the workers to share, and has them map it ahead of time so the first file to use it
+            doesn't wait on it
+
+        Args:
+            model_name (str): The name of the Demucs model to load
+        """
+        self.shared_weights.publish(model_name)
+        pool = self.__pool()
+        # Each worker takes one of these, though one that finishes early may take another's and leave a worker cold
+        [pool.submit(preload_in_worker, model_name) for _ in range(self.workers)]
+
+    def save_upload(self, upload: BinaryIO, name: str, size: Optional[int] = None) -> Path:
+        """Copies an uploaded file to disk a chunk at a time, so a large upload is never held in memory twice over
+
+        Args:
+            upload (BinaryIO): The uploaded file, positioned at its start
+            name (str): The uploaded file's name. Only the name is kept, never any directories in it
+            size (Optional[int]): How many bytes to copy, for uploads read straight off a connection that won't
+                reach its end. If omitted, everything up to the end of the upload is copied
+
+        Raises:
+            EOFError: Thrown if the upload ends before size bytes were read. Nothing is left on disk
+
+        Returns:
+            Path: Where the upload was saved, inside a directory of its own
+        """
+        job_dir = self.scratch.job_dir()
+        path = job_dir.joinpath(Path(name).name)
+        with open(path, "wb") as fh:
+            if size is None:
+                shutil.copyfileobj(upload, fh, UPLOAD_CHUNK_BYTES)
+                return path
+
+            remaining = size
+            while remaining and (chunk := upload.read(min(remaining, UPLOAD_CHUNK_BYTES))):
+                fh.write(chunk)
+                remaining -= len(chunk)
+
+        if remaining:
+            self.scratch.release(job_dir)
+            raise EOFError(f"Upload ended {remaining} bytes short")
+        return path
+
+    def release_upload(self, path: Path) -> None:
+        """Removes an upload from `save_upload` that won't be submitted after all
+
+        Args:
+            path (Path): The saved upload
+        """
+        self.scratch.release(Path(path).parent)
+
+    def is_full(self) -> bool:
+        """Determines if the queue is already holding as many unfinished jobs as it's allowed
+
+        Returns:
+            bool: True if `submit` would turn a new job away right now
+        """
+        return bool(self.max_pending) and self.pending() >= self.max_pending
+
+    def submit(
+        self,
+        path: Path,
+        model_name: str,
+        owned: bool = True,
+        settings: Optional[InferenceSettings] = None,
+        output_format: Optional[OutputFormat] = None,
+    ) -> str:
+        """Queues a file to have its drums split out
+
+        Args:
+            path (Path): The file to split
+            model_name (str): The name of the Demucs model to split it with
+            owned (bool): Whether the file came from `save_upload`, in which case it's removed along with the job.
+                Files the queue doesn't own are left where they are
+            settings (Optional[InferenceSettings]): The shifts, overlap and segment length to split it with.
+                Defaults to the queue's
+            output_format (Optional[OutputFormat]): What to encode the output to. Defaults to the queue's
+
+        Raises:
+            QueueFullError: Thrown if the queue is already holding max_pending unfinished jobs
+
+        Returns:
+            str: The job's ID, to check on it with `status`
+        """
+        self.__expire()
+
+        job = QueuedJob(uuid4().hex, Path(path).name, model_name, Path(path).parent if owned else None)
+        stream = self.__should_stream(Path(path))
+        pool = self.__pool()
+
+        with self.lock:
+            # Checked and recorded under the same lock so that concurrent submits can't both squeeze into the last spot
+            if self.max_pending and len(self.futures) >= self.max_pending:
+                raise QueueFullError(f"The queue is full ({len(self.futures)} jobs waiting)")
+            try:
+                future = pool.submit(separate_in_worker, Path(path), stream, model_name, settings, output_format)
+            except BrokenProcessPool:
+                # Its workers died while it was idle, so there was no job to notice and replace it
+                pool = self.pool = self.__new_pool()
+                future = pool.submit(separate_in_worker, Path(path), stream, model_name, settings, output_format)
+            self.jobs[job.id] = job
+            self.futures[job.id] = future
+        future.add_done_callback(lambda future: self.__on_done(job, pool, future))
+        return job.id
+
+    def status(self, job_id: str) -> Optional[QueuedJob]:
+        """Checks on a job
+
+        Args:
+            job_id (str): The ID from `submit`
+
+        Returns:
+            Optional[QueuedJob]: The job as it currently stands, or None if there's no such job (or it's expired)
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            future = self.futures.get(job_id)
+            if job and future and job.state == QUEUED and future.running():
+                job.state = RUNNING
+            return job
+
+    def pending(self) -> int:
+        """Counts the jobs that are queued or running
+
+        Returns:
+            int: How many jobs haven't finished yet
+        """
+        with self.lock:
+            return len(self.futures)
+
+    def __pool(self) -> ProcessPoolExecutor:
+        """Gets the worker pool, creating it if this is the first time it's been needed"""
+        with self.lock:
+            if not self.pool:
+                self.pool = self.__new_pool()
+            return self.pool
+
+    def __new_pool(self) -> ProcessPoolExecutor:
+        """Creates the worker pool. Its workers start, and load the default model, once there's work for them"""
+        threads = max(1, (os.cpu_count() or 2) // self.workers)
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            # This runs inside servers that already have threads going, which forking doesn't play well with
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(
+                self.model_name,
+                threads,
+                False,
+                False,
+                None,
+                0,
+                0,
+                self.scratch.path,
+                self.stream_window,
+                self.model_budget,
+                self.backend,
+                self.settings,
+                self.output_format,
+                self.shared_weights.directory,
+            ),
+        )
+
+    def __on_done(self, job: QueuedJob, pool: ProcessPoolExecutor, future: Future) -> None:
+        """Records how a job's worker got on with it"""
+        with self.lock:
+            self.futures.pop(job.id, None)
+            job.finished = time.time()
+            if future.cancelled():
+                job.state, job.error = FAILED, "Cancelled"
+            elif future.exception():
+                job.state, job.error = FAILED, str(future.exception())
+                # A worker died (or the default model failed to load), so start over with fresh workers next time
+                if isinstance(future.exception(), BrokenProcessPool) and self.pool is pool:
+                    self.pool = None
+                    pool.shutdown(wait=False, cancel_futures=True)
+            else:
+                job.output, timings = future.result()
+                job.state = DONE
+
+                loads = [timing.wall_seconds for timing in timings if timing.stage == "load_model"]
+                self.model_stats.misses += len(loads)
+                self.model_stats.hits += not loads
+                self.model_stats.load_seconds += sum(loads)
+
+    def __expire(self) -> None:
+        """Removes the jobs, along with their uploads and outputs, that finished longer ago than keep_finished"""
+        cutoff = time.time() - self.keep_finished
+        with self.lock:
+            expired = [job for job in self.jobs.values() if job.finished and job.finished < cutoff]
+            for job in expired:
+                del self.jobs[job.id]
+
+        for job in expired:
+            if job.upload_dir:
+                self.scratch.release(job.upload_dir)
+            if job.output:
+                self.scratch.release(job.output.parent)
+
+    def __should_stream(self, path: Path) -> bool:
+        """Determines if a file is long enough, going by its header, to separate a window at a time"""
+        if not self.stream_above:
+            return False
+        try:
+            duration = TinyTag.get(str(path)).duration or 0
+        except Exception:
+            duration = 0
+        return duration > self.stream_above * 60
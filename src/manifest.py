@@ -0,0 +1,184 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+MANIFEST_NAME = ".dtc_manifest.sqlite"
+
+
+def hash_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """Hashes the contents of a file without reading the whole thing into memory
+
+    Args:
+        path (Path): The file to hash
+        chunk_size (int): How many bytes to read at a time
+
+    Returns:
+        str: The hex SHA-256 digest of the file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    def __init__(self, output_dir: Path):
+        """An on-disk record of every file that has been converted into the output directory, so that
+            re-runs only have to process new or changed files and crashed runs can pick up where they left off
+
+        Args:
+            output_dir (Path): The output directory to keep the manifest in
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        self.path = Path(output_dir).joinpath(MANIFEST_NAME)
+
+        # Lookups and updates can come from different pipeline stages, so the connection is shared behind a lock.
+        # Queue workers on other processes (or machines) may be updating it too, so they're waited on for a while
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS converted (
+                    input_path TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    output_path TEXT NOT NULL,
+                    converted_at REAL NOT NULL,
+                    PRIMARY KEY (input_path, model_name)
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    model_name TEXT NOT NULL,
+                    audio_seconds REAL NOT NULL,
+                    wall_seconds REAL NOT NULL,
+                    finished_at REAL NOT NULL
+                )
+                """
+            )
+
+    def is_up_to_date(self, input_path: Path, model_name: str) -> bool:
+        """Determines if the input file has already been converted with the given model and is unchanged since.
+            The file is only hashed if its size or modification time differ from the recorded ones
+
+        Args:
+            input_path (Path): The original music file
+            model_name (str): The name of the Demucs model being used
+
+        Returns:
+            bool: True if the recorded output still exists and the input hasn't changed, False otherwise
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, content_hash, output_path FROM converted WHERE input_path = ? AND model_name = ?",
+                (self.__key(input_path), model_name),
+            ).fetchone()
+        if not row:
+            return False
+
+        size, mtime_ns, content_hash, output_path = row
+        if not Path(output_path).exists():
+            return False
+
+        stat = input_path.stat()
+        if stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+            return True
+
+        # The file was touched, but that doesn't mean its contents changed (e.g. a copy that reset the mtime)
+        if stat.st_size != size or hash_file(input_path) != content_hash:
+            return False
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE converted SET mtime_ns = ? WHERE input_path = ? AND model_name = ?",
+                (stat.st_mtime_ns, self.__key(input_path), model_name),
+            )
+        return True
+
+    def mark_converted(self, input_path: Path, model_name: str, output_path: Path, content_hash: Optional[str] = None) -> None:
+        """Records that the input file has been successfully converted. Committed immediately so a crash never loses it
+
+        Args:
+            input_path (Path): The original music file
+            model_name (str): The name of the Demucs model used
+            output_path (Path): Where the drumless track ended up
+            content_hash (Optional[str]): The input's content hash, if already known. Computed if omitted
+        """
+        stat = input_path.stat()
+        content_hash = content_hash or hash_file(input_path)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO converted VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.__key(input_path),
+                    model_name,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    content_hash,
+                    str(Path(output_path).resolve()),
+                    time.time(),
+                ),
+            )
+
+    def record_run(self, model_name: str, audio_seconds: float, wall_seconds: float) -> None:
+        """Records how quickly a run got through its audio, for estimating how long future runs will take
+
+        Args:
+            model_name (str): The name of the Demucs model used
+            audio_seconds (float): How many seconds of audio were converted
+            wall_seconds (float): How long converting them took
+        """
+        if not audio_seconds or not wall_seconds:
+            return
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?)",
+                (model_name, audio_seconds, wall_seconds, time.time()),
+            )
+
+    def realtime_factor(self, model_name: str, recent_runs: int = 10) -> Optional[float]:
+        """Gets how many seconds of audio recent runs with the given model converted per second of wall time
+
+        Args:
+            model_name (str): The name of the Demucs model being used
+            recent_runs (int): How many of the most recent runs to average over
+
+        Returns:
+            Optional[float]: The realtime factor, or None if no run with this model has finished yet
+        """
+        with self.lock:
+            audio_seconds, wall_seconds = self.connection.execute(
+                """
+                SELECT SUM(audio_seconds), SUM(wall_seconds) FROM (
+                    SELECT audio_seconds, wall_seconds FROM runs WHERE model_name = ? ORDER BY finished_at DESC LIMIT ?
+                )
+                """,
+                (model_name, recent_runs),
+            ).fetchone()
+
+        if not audio_seconds or not wall_seconds:
+            return None
+        return audio_seconds / wall_seconds
+
+    def close(self) -> None:
+        """Closes the underlying database connection"""
+        self.connection.close()
+
+    def __key(self, input_path: Path) -> str:
+        """Gets the key a given input file is stored under"""
+        return str(Path(input_path).resolve())
@@ -3,13 +3,23 @@
 """
 
 import os
+import tempfile
 from pathlib import Path
+from typing import List, Optional
 
-import eyed3
-from demucs.separate import main as Separate
+import torch
 from eyed3.id3 import ID3_V2_4, Tag
+from eyed3.id3.frames import ImageFrame
 from tinytag import TinyTag
-from wavinfo import WavInfoReader
+
+from src.activity import InactiveSpan, find_inactive
+from src.cache import SeparationCache
+from src.encoders import AudioEncoder
+from src.formats import OutputFormat
+from src.engine import SeparationEngine
+from src.instrumentation import RunReport, maybe_measure
+from src.streaming import StreamingSeparator
+from src.tags import DRUMS_SUFFIX, NO_DRUMS_SUFFIX, AlbumArtCache, ContainerTags, container_tags, write_tag_header
 
 
 class MusicFile:
@@ -22,39 +32,202 @@ class MusicFile:
         self.file_path = path
         self.model_name = model_name
 
-    def separate(self) -> Path:
-        """_summary_
+    def separate(
+        self,
+        engine: Optional[SeparationEngine] = None,
+        out_dir: Optional[Path] = None,
+        keep_drums: bool = False,
+        cache: Optional[SeparationCache] = None,
+        report: Optional[RunReport] = None,
+        stream_window: Optional[float] = None,
+        tag: Optional[Tag] = None,
+        encoder: Optional[AudioEncoder] = None,
+    ) -> Path:
+        """Splits the drums out of the music file, saving the drumless result to `{out_dir}/no_drums` with the
+            encoder's extension
+
+        Args:
+            engine (Optional[SeparationEngine]): An already-loaded engine to reuse. If omitted, one is created
+                for this call alone, which means loading the model from disk
+            out_dir (Optional[Path]): Where to write the stems. Defaults to a new temporary directory, unique to this
+                call so that concurrent callers can't overwrite each other. The caller is responsible for removing it
+            keep_drums (bool): Also encode the drum stem to `{out_dir}/drums`. Off by default since
+                encoding a stem nobody wants is wasted time
+            cache (Optional[SeparationCache]): A cache of previous outputs to reuse if this audio has been split before.
+                Not used when keep_drums is set since only the drumless output is cached
+            report (Optional[RunReport]): Where to record how long decoding, separating and encoding took
+            stream_window (Optional[float]): If set, decode, separate and encode the file this many seconds at a time
+                rather than all at once, so memory use doesn't grow with its length. The cache isn't used when streaming
+            tag (Optional[Tag]): The tag from `get_tag` to give each output, so the outputs never have to be
+                re-opened to be tagged. The outputs are left untagged if omitted
+            encoder (Optional[AudioEncoder]): What to encode the outputs with. Defaults to 320 kbps MP3s
+
+        Returns:
+            Path: The path to the drumless output
+        """
+        engine = engine or SeparationEngine(self.model_name)
+        encoder = encoder or AudioEncoder(engine.samplerate, engine.audio_channels)
+        out_dir = out_dir or Path(tempfile.mkdtemp(prefix="dtc-"))
+
+        extension = encoder.output_format.extension
+        no_drums = out_dir.joinpath(f"no_drums{extension}")
+        os.makedirs(out_dir, exist_ok=True)
+
+        if stream_window:
+            streamer = StreamingSeparator(engine, stream_window)
+            return self.__separate_streaming(streamer, encoder, out_dir, keep_drums, report, tag)
+
+        with maybe_measure(report, self.file_path, "decode") as timing:
+            wav = engine.load_audio(self.file_path)
+            timing.audio_seconds = duration = wav.shape[-1] / engine.samplerate
+
+        with maybe_measure(report, self.file_path, "write_tag"):
+            audio_offset = self.write_tag_headers(tag, out_dir, keep_drums, encoder.output_format)
+
+        cache = cache if not keep_drums else None
+        if cache:
+            cache_key = SeparationCache.fingerprint(wav, encoder.output_format.variant(engine.variant))
+            if self.get_cached(cache, cache_key, no_drums, encoder, tag):
+                return no_drums.resolve()
+
+        inactive = self.find_inactive(wav, engine, report)
+        with maybe_measure(report, self.file_path, "separate", duration) as timing:
+            timing.skipped_seconds = engine.skipped_seconds(wav, inactive)
+            drums, other = engine.split_drums(wav, inactive)
+
+        with maybe_measure(report, self.file_path, "encode", duration):
+            encoder.encode(other.numpy(), no_drums, append=True, tags=self.container_tags(tag, NO_DRUMS_SUFFIX))
+            if cache:
+                cache.put(cache_key, no_drums, audio_offset)
+
+            # Unless asked for, the drum stem never leaves memory
+            if keep_drums:
+                drums_path = out_dir.joinpath(f"drums{extension}")
+                encoder.encode(drums.numpy(), drums_path, append=True, tags=self.container_tags(tag, DRUMS_SUFFIX))
+
+        return no_drums.resolve()
+
+    def find_inactive(self, wav: torch.Tensor, engine: SeparationEngine, report: Optional[RunReport] = None) -> List[InactiveSpan]:
+        """Looks over the decoded audio for the stretches the model needn't run over, as far as the engine's settings
+            allow: silence, and passages without drums
+
+        Args:
+            wav (torch.Tensor): The decoded waveform, shaped (channels, samples)
+            engine (SeparationEngine): The engine that'll split it
+            report (Optional[RunReport]): Where to record how long looking took
+
+        Returns:
+            List[InactiveSpan]: The stretches to skip, for `SeparationEngine.split_drums`
+        """
+        with maybe_measure(report, self.file_path, "analyze", wav.shape[-1] / engine.samplerate):
+            return find_inactive(wav.numpy(), engine.samplerate, engine.skip_silence, engine.skip_drumless)
+
+    def write_tag_headers(self, tag: Optional[Tag], out_dir: Path, keep_drums: bool, output_format: OutputFormat = OutputFormat()) -> int:
+        """Starts `{out_dir}/no_drums.mp3` (and `{out_dir}/drums.mp3` if wanted) off with the original's tag,
+            retitled so each output is distinguishable from the original. The encoded audio is then appended after it.
+            Other formats are tagged by the encoder instead, so nothing is written for them
+
+        Args:
+            tag (Optional[Tag]): The tag from `get_tag`. If None, the outputs are started off empty
+            out_dir (Path): Where the outputs are being written
+            keep_drums (bool): Whether the drum stem is being output too
+            output_format (OutputFormat): What the outputs are being encoded to
+
+        Returns:
+            int: Where the audio will start in the drumless output
+        """
+        if not output_format.tags_ahead:
+            return 0
+
+        outputs = [(out_dir.joinpath("no_drums.mp3"), NO_DRUMS_SUFFIX)]
+        if keep_drums:
+            outputs.append((out_dir.joinpath("drums.mp3"), DRUMS_SUFFIX))
+
+        offsets = []
+        for path, suffix in outputs:
+            if tag is None:
+                path.write_bytes(b"")
+                offsets.append(0)
+            else:
+                offsets.append(write_tag_header(tag, path, suffix, self.file_path.stem))
+        return offsets[0]
+
+    def container_tags(self, tag: Optional[Tag], title_suffix: str) -> Optional[ContainerTags]:
+        """Translates the tag from `get_tag` for the formats that the encoder tags
+
+        Args:
+            tag (Optional[Tag]): The tag from `get_tag`
+            title_suffix (str): What to append to the title so the output is distinguishable from the original
 
         Returns:
-            Path: _description_
+            Optional[ContainerTags]: The translated tags, or None if there's no tag
         """
-        Separate(
-            [
-                "--mp3",  # Saves the output file to MP3 format
-                "--two-stems",  # Defines two stems, {stem}.mp3 and no_{stem}.mp3
-                "drums",  # {stem} as declared above
-                "--jobs",  # Multitasking where possible
-                f"{os.cpu_count() or 2}",  # Try to get it dynamically, fall back to 2
-                "--out",  # Sets the subfolder to save stems to ({ModelName}/{--out}/{stem}.mp3)
-                "",  # Fix it to empty string for easier automation
-                "--filename",  # Set the file format for easier automation
-                "{stem}.{ext}",  # Again, easier to automate "drums.mp3" than others..
-                "--name",  # Model Name -- including this prevents output spam and removes unpredictability
-                self.model_name,
-                f"{str(self.file_path.resolve())}",
-            ]
-        )
-
-        just_drums = Path(self.model_name).joinpath("drums.mp3")
-        no_drums = Path(self.model_name).joinpath("no_drums.mp3")
-
-        if os.path.exists(just_drums):
-            os.unlink(just_drums)
+        return container_tags(tag, title_suffix, self.file_path.stem) if tag else None
+
+    def get_cached(self, cache: SeparationCache, cache_key: str, no_drums: Path, encoder: AudioEncoder, tag: Optional[Tag]) -> bool:
+        """Fills in the drumless output from the cache, if this audio has been split and encoded the same way before.
+            Cached MP3s are appended after the tag already written ahead; other formats are cached with whichever
+            track's tags they were first encoded with, so they're retagged on the way out
+
+        Args:
+            cache (SeparationCache): The cache to look in
+            cache_key (str): The audio's cache key
+            no_drums (Path): Where the drumless output goes
+            encoder (AudioEncoder): The encoder for the chosen output format
+            tag (Optional[Tag]): The tag from `get_tag`
+
+        Returns:
+            bool: True if the output was cached and filled in, False otherwise
+        """
+        if encoder.output_format.tags_ahead:
+            return cache.get(cache_key, no_drums)
+
+        cached = no_drums.with_name(f"cached{no_drums.suffix}")
+        if not cache.get(cache_key, cached):
+            return False
+        try:
+            encoder.retag(cached, no_drums, self.container_tags(tag, NO_DRUMS_SUFFIX))
+        finally:
+            cached.unlink(missing_ok=True)
+        return True
+
+    def __separate_streaming(
+        self,
+        streamer: StreamingSeparator,
+        encoder: AudioEncoder,
+        out_dir: Path,
+        keep_drums: bool,
+        report: Optional[RunReport],
+        tag: Optional[Tag],
+    ) -> Path:
+        """The windowed counterpart to `separate`, for tracks too long to hold in memory all at once"""
+        extension = encoder.output_format.extension
+        no_drums = out_dir.joinpath(f"no_drums{extension}")
+
+        with maybe_measure(report, self.file_path, "write_tag"):
+            self.write_tag_headers(tag, out_dir, keep_drums, encoder.output_format)
+
+        with maybe_measure(report, self.file_path, "decode") as timing:
+            stats = streamer.measure(self.file_path)
+            timing.audio_seconds = duration = stats.frames / streamer.engine.samplerate
+
+        with maybe_measure(report, self.file_path, "separate", duration):
+            spilled_no_drums, spilled_drums = streamer.separate(self.file_path, stats, out_dir, keep_drums)
+
+        with maybe_measure(report, self.file_path, "encode", duration):
+            streamer.encode(spilled_no_drums, no_drums, encoder, append=True, tags=self.container_tags(tag, NO_DRUMS_SUFFIX))
+            if spilled_drums:
+                drums_path = out_dir.joinpath(f"drums{extension}")
+                streamer.encode(spilled_drums, drums_path, encoder, append=True, tags=self.container_tags(tag, DRUMS_SUFFIX))
 
         return no_drums.resolve()
 
-    def get_tag(self) -> Tag:
-        """Attempts to get the ID3 V2.4 Tag from the music file
+    def get_tag(self, art_cache: Optional[AlbumArtCache] = None) -> Tag:
+        """Attempts to get the ID3 V2.4 Tag from the music file. Only the metadata is read, never the audio
+
+        Args:
+            art_cache (Optional[AlbumArtCache]): Covers already read from other tracks of the same album. M4A covers
+                have to be converted to an ID3 frame, so they're only read once per album when this is given
 
         Raises:
             Exception: Thrown if the container for the file is not supported
@@ -62,20 +235,21 @@ class MusicFile:
         Returns:
             Tag: The ID3 V2.4 metadata tag from the music file contained
         """
-        if self.file_path.suffix == ".mp3":
+        if self.file_path.suffix.lower() == ".mp3":
             return self.__get_mp3_tag()
-        if self.file_path.suffix == ".m4a":
-            return self.__get_m4a_tag()
-        if self.file_path.suffix == ".wav":
+        if self.file_path.suffix.lower() == ".m4a":
+            return self.__get_m4a_tag(art_cache)
+        if self.file_path.suffix.lower() == ".wav":
             return self.__get_wav_tag()
         raise Exception(f"Failed to determine tag type for {self.file_path}")
 
-    def __get_m4a_tag(self) -> Tag:
+    def __get_m4a_tag(self, art_cache: Optional[AlbumArtCache]) -> Tag:
         """
         Creates a new eyed3 Tag object from an m4a tag which is not natively supported
         This implementation is based off of TinyTag's m4a support
         """
-        tag = TinyTag.get(str(self.file_path))
+        # The duration needs the whole sample table walked, and nothing here uses it
+        tag = TinyTag.get(str(self.file_path), duration=False)
 
         ret = Tag(version=ID3_V2_4)
 
@@ -94,13 +268,30 @@ class MusicFile:
         ret.track_num = (track, track_total)
         ret.release_date = tag.year
 
+        if art_cache:
+            cover = art_cache.get(
+                self.file_path,
+                tag.album,
+                tag.albumartist,
+                lambda: TinyTag.get(str(self.file_path), duration=False, image=True).get_image(),
+            )
+            if cover:
+                image, mime_type = cover
+                ret.images.set(ImageFrame.FRONT_COVER, image, mime_type)
+
         return ret
 
     def __get_wav_tag(self) -> Tag:
         """Gets the tag for a wav file based off of WavInfo's impl"""
+        # Only imported once there's a WAV to read
+        from wavinfo import WavInfoReader
+
         tag = WavInfoReader(str(self.file_path))
 
         ret = Tag(version=ID3_V2_4)
+        if not tag.info:
+            return ret  # No LIST/INFO chunk, so there's nothing to copy
+
         ret.album = tag.info.album
         ret.album_artist = tag.info.artist
         ret.artist = tag.info.artist
@@ -112,11 +303,12 @@ class MusicFile:
 
     def __get_mp3_tag(self) -> Tag:
         """
-        Gets or creates a tag from the given file path. If the tag fails to be created,
+        Gets or creates a tag from the given file path. If the file has no tag,
             an empty tag is made and returned
         """
-        audio_file = eyed3.load(str(self.file_path))
-        if not audio_file:
+        # Parsing just the tag skips scanning the MPEG frames, which eyed3.load would do to work out the duration
+        tag = Tag()
+        if not tag.parse(str(self.file_path)):
             print(f"Failed to load tag from file {self.file_path} -- returning empty tag")
             return Tag(version=ID3_V2_4)
-        return audio_file.tag
+        return tag
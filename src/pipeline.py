@@ -0,0 +1,236 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from queue import Empty, Queue
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import torch
+from eyed3.id3 import Tag
+
+from src.activity import InactiveSpan
+from src.messaging import CliOutput
+from src.music_file import MusicFile
+from src.streaming import SpilledStem, StreamStats
+
+
+@dataclass
+class PipelineJob:
+    """A single file's state as it moves through the pipeline. Stages fill in fields as they go"""
+
+    file: MusicFile
+    out_dir: Path
+    tag: Optional[Tag] = None
+    # Where the audio starts in the drumless output, after the tag written ahead of it
+    audio_offset: int = 0
+    wav: Optional[torch.Tensor] = None
+    duration: float = 0
+    # The stretches of the decoded audio the model can skip over
+    inactive: List[InactiveSpan] = field(default_factory=list)
+    cache_key: Optional[str] = None
+    cached: bool = False
+    drums: Optional[torch.Tensor] = None
+    no_drums: Optional[torch.Tensor] = None
+    no_drums_path: Optional[Path] = None
+    # Only set for tracks long enough to be separated a window at a time, which never hold the whole waveform
+    stats: Optional[StreamStats] = None
+    spilled: Optional[Tuple[SpilledStem, Optional[SpilledStem]]] = None
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable[[PipelineJob], Optional[PipelineJob]], threads: int = 1):
+        """A single step of the pipeline, run on its own thread(s)
+
+        Args:
+            name (str): The name to report the stage's throughput under
+            func (Callable[[PipelineJob], Optional[PipelineJob]]): Does the stage's work on a job.
+                Returning None drops the job instead of passing it on to the next stage
+            threads (int): How many jobs the stage may work on at once. Jobs can leave the stage out of order
+                when it's more than one
+        """
+        self.name = name
+        self.func = func
+        self.threads = max(1, threads)
+        self.jobs: int = 0
+        self.busy_seconds: float = 0
+        self.audio_seconds: float = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, job: PipelineJob) -> Optional[PipelineJob]:
+        start = time.perf_counter()
+        try:
+            return self.func(job)
+        finally:
+            with self.lock:
+                self.busy_seconds += time.perf_counter() - start
+                self.jobs += 1
+                self.audio_seconds += job.duration
+
+    def summary(self) -> str:
+        """Describes how much work the stage did and how quickly. With several threads, busy time is summed across them
+
+        Returns:
+            str: A human-readable throughput summary
+        """
+        busy = max(self.busy_seconds, 1e-9)
+        return (
+            f"{self.name}: {self.jobs} file(s) in {self.busy_seconds:.1f}s busy "
+            f"({self.jobs / busy:.2f} files/s, {self.audio_seconds / busy:.1f}x realtime)"
+        )
+
+
+class BatchStage(Stage):
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[List[PipelineJob]], List[PipelineJob]],
+        capacity: int,
+        weigh: Callable[[PipelineJob], int],
+    ):
+        """A pipeline step that works on several jobs at once. It takes whatever jobs are already waiting
+            (never blocking for more) until their combined weight reaches the capacity
+
+        Args:
+            name (str): The name to report the stage's throughput under
+            func (Callable[[List[PipelineJob]], List[PipelineJob]]): Does the stage's work on a batch of jobs,
+                returning the ones to pass on to the next stage
+            capacity (int): The combined weight to stop gathering jobs at
+            weigh (Callable[[PipelineJob], int]): How much of the capacity a given job takes up
+        """
+        super().__init__(name, func)
+        self.capacity = capacity
+        self.weigh = weigh
+
+    def __call__(self, jobs: List[PipelineJob]) -> List[PipelineJob]:
+        start = time.perf_counter()
+        try:
+            return self.func(jobs)
+        finally:
+            self.busy_seconds += time.perf_counter() - start
+            self.jobs += len(jobs)
+            self.audio_seconds += sum(job.duration for job in jobs)
+
+
+class Pipeline:
+    # Placed on a queue after the last job so each stage knows to shut down
+    __DONE = object()
+
+    def __init__(self, stages: List[Stage], depth: int, on_error: Callable[[PipelineJob, Exception], None], output: CliOutput):
+        """Runs jobs through a series of stages, each on its own thread and joined by bounded queues.
+            This lets e.g. inference on one track overlap with encoding the previous one, while the
+            queue depth caps how many decoded tracks can be held in memory at once
+
+        Args:
+            stages (List[Stage]): The stages to run each job through, in order
+            depth (int): How many jobs may wait between any two stages
+            on_error (Callable[[PipelineJob, Exception], None]): Called when a stage fails on a job. The job is dropped
+            output (CliOutput): Where to report anything `on_error` raises itself, since it can't be left to
+                take the stage's thread down
+        """
+        self.stages = stages
+        self.depth = max(1, depth)
+        self.on_error = on_error
+        self.output = output
+        self.running: List[int] = []
+        self.lock = threading.Lock()
+
+    def run(self, jobs: Iterable[PipelineJob]) -> None:
+        """Feeds every job through the pipeline, returning once the last stage has finished with all of them
+
+        Args:
+            jobs (Iterable[PipelineJob]): The jobs to run. Consumed lazily, only as fast as the first stage keeps up
+        """
+        queues = [Queue(maxsize=self.depth) for _ in self.stages]
+        # How many of each stage's threads are still going, so only the last to finish signals the next stage
+        self.running = [stage.threads for stage in self.stages]
+        threads = [
+            threading.Thread(
+                target=self.__run_stage,
+                args=(idx, queues[idx], queues[idx + 1] if idx + 1 < len(queues) else None),
+                name=f"pipeline-{stage.name}-{thread}",
+                daemon=True,
+            )
+            for idx, stage in enumerate(self.stages)
+            for thread in range(stage.threads)
+        ]
+        [thread.start() for thread in threads]
+
+        for job in jobs:
+            queues[0].put(job)
+        queues[0].put(Pipeline.__DONE)
+
+        [thread.join() for thread in threads]
+
+    def __run_stage(self, idx: int, inbox: Queue, outbox: Optional[Queue]) -> None:
+        """The loop for one of a stage's threads
+
+        Args:
+            idx (int): Which stage to run
+            inbox (Queue): Where jobs for this stage come from
+            outbox (Optional[Queue]): Where finished jobs go. None for the last stage
+        """
+        stage = self.stages[idx]
+        try:
+            while True:
+                job = inbox.get()
+                if job is Pipeline.__DONE:
+                    # Passed around so each of the stage's other threads sees it too
+                    inbox.put(job)
+                    break
+
+                batched = isinstance(stage, BatchStage)
+                jobs, finished = self.__gather(stage, job, inbox) if batched else ([job], False)
+
+                try:
+                    results = stage(jobs) if batched else [stage(job)]
+                except Exception as e:
+                    [self.__fail(job, e) for job in jobs]
+                    results = []
+
+                if outbox:
+                    [outbox.put(result) for result in results if result]
+                if finished:
+                    inbox.put(Pipeline.__DONE)
+                    break
+        finally:
+            # However this thread ends, the next stage has to hear about it or it would wait for more jobs forever
+            with self.lock:
+                self.running[idx] -= 1
+                last = not self.running[idx]
+            if outbox and last:
+                outbox.put(Pipeline.__DONE)
+
+    def __fail(self, job: PipelineJob, e: Exception) -> None:
+        """Hands a job a stage failed on to `on_error`, reporting anything that goes wrong in there rather than raising it"""
+        try:
+            self.on_error(job, e)
+        except Exception as handler_error:
+            self.output.error(f"Couldn't clean up after {job.file.file_path.name} failed ({e}): {handler_error}")
+
+    def __gather(self, stage: BatchStage, first: PipelineJob, inbox: Queue) -> Tuple[List[PipelineJob], bool]:
+        """Collects a batch for a BatchStage from the jobs already waiting in its inbox
+
+        Args:
+            stage (BatchStage): The stage to gather a batch for
+            first (PipelineJob): The job that's already been taken from the inbox
+            inbox (Queue): Where jobs for this stage come from
+
+        Returns:
+            Tuple[List[PipelineJob], bool]: The batch, and whether the end of the jobs was reached while gathering it
+        """
+        jobs = [first]
+        weight = stage.weigh(first)
+        while weight < stage.capacity:
+            try:
+                job = inbox.get_nowait()
+            except Empty:
+                break
+            if job is Pipeline.__DONE:
+                return jobs, True
+            jobs.append(job)
+            weight += stage.weigh(job)
+        return jobs, False
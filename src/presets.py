@@ -0,0 +1,72 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+from dataclasses import dataclass, replace
+from typing import Dict, Optional
+
+
+@dataclass
+class InferenceSettings:
+    """How much work the model puts into each track, trading speed for quality"""
+
+    shifts: int = 1  # Each shift is another full pass over the track at a random offset, averaged together. 0 for one unshifted pass
+    overlap: float = 0.25  # How much neighbouring segments overlap, as a fraction of the segment length
+    segment: Optional[float] = None  # The segment length in seconds. None for what the model was trained with
+    skip_silence: bool = True  # Pass silent stretches through rather than running the model over them
+    skip_drumless: bool = False  # Pass stretches without any drum hits through too. Off by default since it's a judgement call
+
+    @staticmethod
+    def from_preset(
+        preset: str = "balanced",
+        shifts: Optional[int] = None,
+        overlap: Optional[float] = None,
+        segment: Optional[float] = None,
+        skip_silence: Optional[bool] = None,
+        skip_drumless: Optional[bool] = None,
+    ) -> "InferenceSettings":
+        """Starts from one of the PRESETS, overriding whichever of its settings are given
+
+        Args:
+            preset (str): The name of the preset to start from
+            shifts (Optional[int]): Overrides the preset's shifts if set
+            overlap (Optional[float]): Overrides the preset's overlap if set
+            segment (Optional[float]): Overrides the preset's segment length if set
+            skip_silence (Optional[bool]): Overrides whether the preset skips silence if set
+            skip_drumless (Optional[bool]): Overrides whether the preset skips drumless stretches if set
+
+        Returns:
+            InferenceSettings: The resulting settings
+        """
+        settings = PRESETS[preset]
+        return InferenceSettings(
+            settings.shifts if shifts is None else shifts,
+            settings.overlap if overlap is None else overlap,
+            settings.segment if segment is None else segment,
+            settings.skip_silence if skip_silence is None else skip_silence,
+            settings.skip_drumless if skip_drumless is None else skip_drumless,
+        )
+
+    def variant(self, model_name: str, backend: str = "float32") -> str:
+        """Names what these settings make of a model, so outputs made differently aren't mistaken for each other
+
+        Args:
+            model_name (str): The name of the Demucs model
+            backend (str): How the model is run, one of `backends.BACKENDS`
+
+        Returns:
+            str: Just the model name for the defaults, so that what was recorded before there were settings still counts.
+                Whether silence is skipped is left out, since it makes no audible difference to the outputs
+        """
+        if replace(self, skip_silence=True) == InferenceSettings() and backend == "float32":
+            return model_name
+        drumless = ", drumless skipped" if self.skip_drumless else ""
+        return f"{model_name} (shifts={self.shifts}, overlap={self.overlap}, segment={self.segment}, {backend}{drumless})"
+
+
+# Tuned combinations for `--preset`. Balanced is what `demucs.separate` does by default
+PRESETS: Dict[str, InferenceSettings] = {
+    "fast": InferenceSettings(shifts=0, overlap=0.1),
+    "balanced": InferenceSettings(),
+    "best": InferenceSettings(shifts=5, overlap=0.5),
+}
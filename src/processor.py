@@ -4,16 +4,37 @@
 
 import os
 import shutil
-import subprocess
+import threading
+import time
 from argparse import Namespace as argset
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from datetime import timedelta
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import eyed3
-from eyed3.id3 import ID3_V2_4, Tag
-
-from src.common import MODEL_CHOICES, SUPPORTED_EXTS
+from src.common import MODEL_CHOICES, is_ffmpeg_present
+from src.formats import OutputFormat
+from src.presets import InferenceSettings
+from src.manifest import Manifest
 from src.messaging import CliOutput, NoPrintStatements
-from src.music_file import MusicFile
+from src.progress import DECODE, DONE, ENCODE, FAILED, SEPARATE, ConversionCancelled, ProgressEvent, ProgressTracker
+from src.scanner import DirectoryScanner, PlannedJob
+from src.scratch import ScratchSpace
+from src.work_queue import DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, QUEUE_NAME, WorkQueue
+
+# Everything that pulls in torch (or the encoders and taggers) is only imported once a run has work to do, so that
+# runs with nothing to convert, and --help, don't pay seconds of imports for it
+if TYPE_CHECKING:
+    from src.cache import SeparationCache
+    from src.encoders import AudioEncoder
+    from src.engine import SeparationEngine
+    from src.instrumentation import RunReport, SlowestProfiles
+    from src.music_file import MusicFile
+    from src.pipeline import PipelineJob
+    from src.registry import ModelRegistry
+    from src.streaming import StreamingSeparator
+    from src.tags import AlbumArtCache
 
 
 class FolderProcessor:
@@ -24,6 +45,27 @@ class FolderProcessor:
         model_name: str,
         output: CliOutput,
         verbose: bool = False,
+        workers: int = 1,
+        keep_drums: bool = False,
+        force: bool = False,
+        cache_dir: Optional[str] = None,
+        cache_size: float = 5,
+        queue_depth: int = 2,
+        batch_segments: int = 0,
+        report_path: Optional[str] = None,
+        profile: int = 0,
+        scratch_dir: Optional[str] = None,
+        stream_above: float = 20,
+        stream_window: float = 30,
+        backend: str = "float32",
+        settings: Optional[InferenceSettings] = None,
+        output_format: OutputFormat = OutputFormat(),
+        encode_workers: int = 2,
+        registry: Optional["ModelRegistry"] = None,
+        on_progress: Optional[Callable[[ProgressEvent], None]] = None,
+        queue_path: Optional[str] = None,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
     ):
         """
         Args:
@@ -31,12 +73,85 @@ class FolderProcessor:
             output_dir (str): The destination directory which will mirror the source, but with tracks that have no drums
             model_name (str): The name of the Demucs model to use for splitting tracks
             output (CliOutput): The handler for displaying output to the user
+            workers (int): How many processes to split files across. They share one copy of the model's weights between them
+            keep_drums (bool): Also output the isolated drum stem alongside each drumless track
+            force (bool): Reprocess every file, even those the manifest says are already up-to-date
+            cache_dir (Optional[str]): Where to cache split outputs so duplicate audio is only split once. Disabled if None
+            cache_size (float): The most the cache may hold on disk, in gigabytes
+            queue_depth (int): How many files may wait between pipeline stages. Bounds how many decoded tracks are in memory
+            batch_segments (int): How many segments to run through the model per forward pass, gathered across however
+                many queued tracks it takes. 0 disables cross-track batching
+            report_path (Optional[str]): Where to write the per-file, per-stage timing report. `.csv` for CSV, otherwise
+                JSON. Defaults to `.dtc_report.json` in the output directory
+            profile (int): How many of the slowest inference runs to keep cProfile and torch profiler traces for
+            scratch_dir (Optional[str]): Where to write intermediate files. Defaults to `.dtc_scratch` in the output
+                directory so that relocating finished tracks is a rename rather than a copy
+            stream_above (float): Tracks longer than this many minutes are decoded, separated and encoded a window at a
+                time, so that memory use doesn't grow with their length. 0 disables streaming
+            stream_window (float): How many seconds of audio to work on at a time when streaming
+            backend (str): How to run the model, one of `backends.BACKENDS`
+            settings (Optional[InferenceSettings]): The shifts, overlap and segment length to split with. Defaults to
+                the balanced preset. Files converted with other settings (or another backend) are converted again
+            output_format (OutputFormat): What to encode the outputs to. Files converted to another format are converted again
+            encode_workers (int): How many tracks may be encoded at once, each in an encoder process of its own so that
+                encoding doesn't hold up inference. Only applies without --workers, whose workers encode their own tracks
+            registry (Optional[ModelRegistry]): Where to get the model from without --workers, so that it stays loaded
+                for the next run. Its engines are used as its factory made them, whatever backend and batch_segments
+                say. If omitted, the model is loaded for this run alone
+            on_progress (Optional[Callable[[ProgressEvent], None]]): Called, from whichever thread is working on the
+                file, every time a file moves on to its next stage
+            queue_path (Optional[str]): The work queue shared by `publish_directory` and `process_queue`. Defaults to
+                `.dtc_queue.sqlite` in the output directory
+            lease_seconds (float): How long a worker may go without renewing its leases before its files are handed to
+                another worker
+            max_attempts (int): How many times a queued file is tried before it's given up on
         """
         self.input_dir: str = input_dir
         self.output_dir: str = output_dir
         self.output: CliOutput = output
         self.model_name = model_name
         self.verbose: bool = verbose
+        self.workers: int = max(1, workers)
+        self.keep_drums: bool = keep_drums
+        self.force: bool = force
+        self.manifest: Manifest = None
+        # Filled in from the job plan as each run starts
+        self.durations: Dict[Path, float] = {}
+        self.converted_seconds: float = 0
+        self.cache_dir: Optional[str] = cache_dir
+        self.cache_max_bytes: int = int(cache_size * 1024**3)
+        # The cache, report and album art cache are created once there's something to convert
+        self.cache: Optional["SeparationCache"] = None
+        self.queue_depth: int = queue_depth
+        self.batch_segments: int = batch_segments
+        self.report_path: Path = Path(report_path or Path(output_dir).joinpath(".dtc_report.json"))
+        self.profile: int = profile
+        self.report: "RunReport" = None
+        self.profiles: Optional["SlowestProfiles"] = None
+        self.scratch_dir: Path = Path(scratch_dir or Path(output_dir).joinpath(".dtc_scratch"))
+        self.scratch: ScratchSpace = None
+        self.stream_above: float = stream_above
+        self.stream_window: float = stream_window
+        self.art_cache: Optional["AlbumArtCache"] = None
+        # Several tracks can finish at once when they're encoded in parallel
+        self.lock = threading.Lock()
+        self.backend: str = backend
+        self.settings: InferenceSettings = settings or InferenceSettings()
+        self.output_format: OutputFormat = output_format
+        self.encode_workers: int = encode_workers
+        # What the manifest, report and cache know this run's model as, so changing the settings or format counts as
+        # a different model
+        self.variant: str = output_format.variant(self.settings.variant(model_name, backend))
+        self.registry: Optional["ModelRegistry"] = registry
+        self.on_progress: Optional[Callable[[ProgressEvent], None]] = on_progress
+        self.progress: ProgressTracker = ProgressTracker({}, None)
+        # Set by `cancel`, from any thread
+        self.cancelled = threading.Event()
+        self.queue_path: Path = Path(queue_path or Path(output_dir).joinpath(QUEUE_NAME))
+        self.lease_seconds: float = lease_seconds
+        self.max_attempts: int = max_attempts
+        # Only while working on the queue, so that finished and failed files are recorded in it
+        self.work_queue: Optional[WorkQueue] = None
 
     @staticmethod
     def from_args(args: argset, output: CliOutput):
@@ -46,99 +161,587 @@ class FolderProcessor:
             args (argset): Arguments from the CLI
             output (CliOutput): The handler for displaying output to the user
         """
-        return FolderProcessor(args.input_dir, args.output_dir, args.model, output, args.verbose)
+        return FolderProcessor(
+            args.input_dir,
+            args.output_dir,
+            args.model,
+            output,
+            args.verbose,
+            args.workers,
+            args.keep_drums,
+            args.force,
+            args.cache_dir,
+            args.cache_size,
+            args.queue_depth,
+            args.batch_segments,
+            args.report,
+            args.profile,
+            args.scratch_dir,
+            args.stream_above,
+            args.stream_window,
+            args.backend,
+            InferenceSettings.from_preset(
+                args.preset, args.shifts, args.overlap, args.segment, False if args.keep_silence else None, args.skip_drumless or None
+            ),
+            OutputFormat.for_container(args.format, args.bitrate, args.vbr),
+            args.encode_workers,
+            queue_path=args.queue,
+            lease_seconds=args.lease,
+            max_attempts=args.max_attempts,
+        )
 
     @staticmethod
     def is_ffmpeg_present() -> bool:
-        """Determines if ffmpeg is installed and accessible
+        """Determines if ffmpeg is installed and accessible. Only actually checked once per process
 
         Returns:
             bool: True if ffmpeg is installed and accessible, false otherwise.
                 When returning false, no processing should be permitted.
         """
-        try:
-            exit_code = subprocess.call(["ffmpeg"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            return exit_code == 1
-        except FileNotFoundError:
-            return False
+        return is_ffmpeg_present()
+
+    def cancel(self) -> None:
+        """Stops the run at its soonest convenience. Files already converted are kept, and the one being split is
+            abandoned partway through. With --workers, files already being split still finish"""
+        self.cancelled.set()
 
     def process_directory(self) -> None:
         """
         Traverses all files in the provided source directory, replicating the directory format in \
             the destination directory and moving the converted file to match suit.
         
-        Also ensures that metadata is copied from the old file to the new one to provide the best user experience in the end
+        Also ensures that metadata is carried over from the old file to the new one to provide the best user experience in the end
         """
+        src, dest = self.__check_directories()
+        self.manifest = Manifest(dest)
+
+        try:
+            jobs = self.__plan(src)
+            if not jobs:
+                return
+
+            self.__start_run({job.path: job.duration for job in jobs}, dest)
+            start = time.perf_counter()
+
+            # Removed on the way out whether the run finishes, fails or is interrupted
+            with ScratchSpace(self.scratch_dir) as self.scratch:
+                if self.workers > 1:
+                    self.__process_in_pool([job.path for job in jobs], src, dest)
+                else:
+                    self.__process_pipelined([job.path for job in jobs], src, dest)
+
+            self.manifest.record_run(self.variant, self.converted_seconds, time.perf_counter() - start)
+            self.__write_report(self.report_path)
+            if self.cancelled.is_set():
+                remaining = len(jobs) - self.progress.files_done
+                self.output.warning(f"Cancelled with {remaining} of {len(jobs)} file(s) left to convert. They'll be picked up next run")
+        finally:
+            self.manifest.close()
+
+    def publish_directory(self) -> None:
+        """Scans and plans the source directory just as `process_directory` does, but rather than converting the files
+            itself, queues them in the work queue for any number of `process_queue` workers to share"""
+        src, dest = self.__check_directories()
+        self.manifest = Manifest(dest)
+        queue = WorkQueue(self.queue_path, self.variant, lease_seconds=self.lease_seconds, max_attempts=self.max_attempts)
+
+        try:
+            jobs = self.__plan(src)
+            queued = queue.publish([(job.path, job.duration) for job in jobs])
+            counts = queue.counts()
+            self.output.info(
+                f"Queued {queued} file(s) in {self.queue_path}. {counts.pending} waiting and {counts.leased} being converted "
+                "by workers; start more with --worker"
+            )
+        finally:
+            queue.close()
+            self.manifest.close()
+
+    def process_queue(self) -> None:
+        """Converts files from the work queue, alongside any other workers sharing it, until none are left. Each file
+            is leased while it's converted, so that if this worker stops partway through (or its machine goes down) the
+            file is handed to another once its lease runs out. Converted files end up in the output directory just as
+            they would from `process_directory`, so every worker must be given the same source and output directories"""
+        src, dest = self.__check_directories()
+        if self.workers > 1:
+            self.output.warning("--workers is ignored with --worker; start a --worker process for each file to convert at once instead")
 
+        self.manifest = Manifest(dest)
+        self.work_queue = WorkQueue(self.queue_path, self.variant, lease_seconds=self.lease_seconds, max_attempts=self.max_attempts)
+        try:
+            counts = self.work_queue.counts()
+            if not counts.pending and not counts.leased:
+                others = [variant for variant in self.work_queue.variants() if variant != self.variant]
+                self.output.info(f"Nothing is queued in {self.queue_path} for {self.variant}")
+                if others:
+                    self.output.warning(f"Files are queued for {', '.join(others)}. Start this worker with the same settings as the coordinator")
+                return
+
+            self.output.info(f"Working on {self.queue_path} as {self.work_queue.worker}: {counts.pending} file(s) waiting")
+            # Filled in as files are claimed, since the rest of the queue may well go to other workers
+            self.__start_run({}, dest)
+            start = time.perf_counter()
+
+            with self.work_queue, ScratchSpace(self.scratch_dir) as self.scratch:
+                self.__process_pipelined(self.__claim_files(), src, dest)
+
+            self.manifest.record_run(self.variant, self.converted_seconds, time.perf_counter() - start)
+            # Workers share an output directory, so each writes a report of its own
+            report_path = self.report_path.with_name(f"{self.report_path.stem}.{self.work_queue.worker}{self.report_path.suffix}")
+            self.__write_report(report_path)
+
+            counts = self.work_queue.counts()
+            self.output.info(f"The queue has {counts.done} file(s) done, {counts.failed} failed and {counts.pending + counts.leased} left")
+        finally:
+            self.work_queue.close()
+            self.work_queue = None
+            self.manifest.close()
+
+    def __check_directories(self) -> Tuple[Path, Path]:
+        """Makes sure there's something to convert, and something to convert it with
+
+        Raises:
+            Exception: Thrown if ffmpeg isn't installed, or the source directory doesn't exist
+
+        Returns:
+            Tuple[Path, Path]: The source and destination directories
+        """
         if not FolderProcessor.is_ffmpeg_present():
             raise Exception("FFMpeg is not installed! Please install it from here: https://www.ffmpeg.org/download.html")
 
         src: Path = Path(self.input_dir)
         dest: Path = Path(self.output_dir)
-        cur_dir: Path = Path(".").resolve()  # Used just for logging
 
         if not src.exists():
             raise Exception("Input directory does not exist!")
+        return src, dest
 
-        for root, _, files in os.walk(src):
-            for file in files:
-                original_path = Path(root).joinpath(file)
-                if original_path.suffix not in SUPPORTED_EXTS:
-                    self.output.warning(f"File {original_path.name} has an unsupported extension and will be skipped!")
-                    continue
-                # Create a "MusicFile" from the full path of the original file
-                original_file = MusicFile(original_path, self.model_name)
+    def __plan(self, src: Path) -> List[PlannedJob]:
+        """Scans the source directory for files that still need converting, and logs the plan for them
 
-                self.output.info(f"Splitting drum tracks from {original_path.name} using {list(MODEL_CHOICES.keys())[list(MODEL_CHOICES.values()).index(self.model_name)]}:")
+        Args:
+            src (Path): The source directory
 
-                with NoPrintStatements(self.verbose):
-                    no_drums_path = original_file.separate()
+        Returns:
+            List[PlannedJob]: The files to convert, in the order to convert them
+        """
+        scanner = DirectoryScanner(self.output)
+        self.output.info(f"Scanning {src}..")
+        files, unsupported = scanner.scan(src)
+        for path in unsupported:
+            self.output.warning(f"File {path.name} has an unsupported extension and will be skipped!")
 
-                # If metadata cloning fails, skip the file.
-                if not self.__copy_metadata(original_file, no_drums_path):
-                    continue
+        jobs = scanner.plan(list(self.__skip_up_to_date(files)))
+        self.__log_plan(jobs)
+        return jobs
 
-                # Replace the input destination with the output destination
-                file_output_root = root.replace(str(src), str(dest))
-                file_output_root = Path(file_output_root).resolve()
-                # We also need to replace the original {file} extension with .mp3
-                filename_with_mp3_ext = f"{Path(file).stem}.mp3"
-                file_dest = file_output_root.joinpath(filename_with_mp3_ext)
-                # Make the output subdir(s) and move the no-drums file from the temp output to the final destination
-                os.makedirs(file_output_root, exist_ok=True)
-                shutil.move(no_drums_path, file_dest)
+    def __start_run(self, durations: Dict[Path, float], dest: Path) -> None:
+        """Sets up the progress, report, caches and profiler for a run that has files to convert
 
-                self.output.info(f"Done processing {original_path.name} and relocated it to {file_dest.relative_to(cur_dir)}!")
+        Args:
+            durations (Dict[Path, float]): Each planned file's duration in seconds, in the order they were planned
+            dest (Path): The destination directory
+        """
+        from src.instrumentation import RunReport, SlowestProfiles
+        from src.tags import AlbumArtCache
 
-        # Remove the model output since we don't need it anymore
-        if os.path.exists(self.model_name):
-            shutil.rmtree(self.model_name)
+        self.durations = durations
+        self.converted_seconds = 0
+        self.progress = ProgressTracker(self.durations, self.on_progress, self.manifest.realtime_factor(self.variant))
+        self.report = RunReport(self.variant)
+        if self.cache_dir and not self.cache:
+            from src.cache import SeparationCache
 
-    def __copy_metadata(self, original_file: MusicFile, no_drums_path: Path) -> bool:
+            self.cache = SeparationCache(Path(self.cache_dir), self.cache_max_bytes)
+        if not self.art_cache:
+            self.art_cache = AlbumArtCache()
+        if self.profile:
+            self.profiles = SlowestProfiles(self.profile, dest.joinpath(".dtc_profiles"))
+
+    def __claim_files(self) -> Iterator[Path]:
+        """Claims files from the work queue as the pipeline makes room for them, until there are none left to claim
+
+        Yields:
+            Path: Each claimed file
         """
-        Copies the metadata from the original music file to the new drumless track
+        for job in self.work_queue.claims(self.cancelled):
+            # Streaming goes by the planned durations
+            self.durations[job.path] = job.duration
+            retry = f" (attempt {job.attempt})" if job.attempt > 1 else ""
+            self.output.info(f"Claimed {job.path.name}{retry}")
+            yield job.path
+
+    def __write_report(self, path: Path) -> None:
+        """Writes out the timing report and any profiler traces, summarizing the run for the user
 
         Args:
-            original_file (MusicFile): The MusicFile instance for the original, unmodified/unsplit son
-            no_drums_path (Path): The path to the drumless output file after splitting
+            path (Path): Where to write the report
+        """
+        self.report.write(path)
 
-        Returns:
-            bool: True if the process succeeds, False if get_tag raises an exception
+        summary = self.report.summary()
+        skipped = f", skipping {summary['skipped_seconds'] / 60:.1f} minutes of silent or drumless audio" if summary["skipped_seconds"] else ""
+        self.output.info(
+            f"Converted {summary['audio_seconds'] / 60:.1f} minutes of audio in {summary['wall_seconds'] / 60:.1f} minutes "
+            f"({summary['realtime_factor']:.2f}x realtime{skipped}). Timing report written to {path}"
+        )
+
+        if self.profiles:
+            traces = self.profiles.dump()
+            self.output.info(f"Wrote {len(traces)} profiler trace file(s) for the slowest tracks to {self.profiles.out_dir}")
+
+    def __log_plan(self, jobs: List[PlannedJob]) -> None:
+        """Displays the totals for the planned work, including an ETA based on how quickly previous runs went
+
+        Args:
+            jobs (List[PlannedJob]): The planned jobs
         """
+        audio_seconds = sum(job.duration for job in jobs)
+        gigabytes = sum(job.size for job in jobs) / 1024**3
+
+        realtime_factor = self.manifest.realtime_factor(self.variant)
+        if not jobs:
+            eta = "nothing to do!"
+        elif realtime_factor:
+            eta = f"~{timedelta(seconds=round(audio_seconds / realtime_factor))}"
+        else:
+            eta = "unknown until a run with this model has finished"
+
+        self.output.info(
+            f"Planned {len(jobs)} file(s), {audio_seconds / 3600:.2f} hours of audio ({gigabytes:.2f} GB). Estimated time: {eta}"
+        )
+
+    def __skip_up_to_date(self, files: List[Path]) -> Iterator[Path]:
+        """Filters out files that the manifest says were already converted and haven't changed since
+
+        Args:
+            files (List[Path]): The music files found in the source directory
+
+        Yields:
+            Path: The path to each music file that still needs converting
+        """
+        for original_path in files:
+            if not self.force and self.manifest.is_up_to_date(original_path, self.variant):
+                if self.verbose:
+                    self.output.info(f"{original_path.name} is already up-to-date - skipping!")
+                continue
+            yield original_path
+
+    def __process_pipelined(self, files: Iterable[Path], src: Path, dest: Path) -> None:
+        """Converts files in this process through a decode -> separate -> encode/tag/move pipeline,
+            so each stage can work on a different file at the same time
+
+        Args:
+            files (Iterable[Path]): The music files to convert. Consumed lazily, as the pipeline makes room for them
+            src (Path): The source directory being traversed
+            dest (Path): The destination directory to mirror the source into
+        """
+        from src.encoders import AudioEncoder
+        from src.engine import SeparationEngine
+        from src.music_file import MusicFile
+        from src.pipeline import BatchStage, Pipeline, PipelineJob, Stage
+        from src.streaming import StreamingSeparator
+
+        # Load the model once up-front; every file below reuses it rather than reloading the weights
+        if not (self.registry and self.registry.is_resident(self.model_name)):
+            self.output.info(f"Loading model {self.model_name}..")
+        with NoPrintStatements(self.verbose):
+            if self.registry:
+                engine = self.registry.get(self.model_name)
+                engine.configure(self.settings)
+            else:
+                engine = SeparationEngine(self.model_name, batch_segments=self.batch_segments, backend=self.backend, settings=self.settings)
+        engine.cancel = self.cancelled
+
+        streamer = StreamingSeparator(engine, self.stream_window)
+        # Spread across processes, since the MP3 encoder holds the GIL for as long as it's encoding
+        encoder = AudioEncoder(engine.samplerate, engine.audio_channels, self.output_format, self.encode_workers)
+
+        if self.batch_segments:
+            separate_stage = BatchStage(
+                "separate",
+                lambda jobs: self.__separate_batch_stage(engine, streamer, jobs),
+                self.batch_segments,
+                lambda job: engine.count_segments(job.wav, job.inactive) if job.wav is not None else 0,
+            )
+        else:
+            separate_stage = Stage("separate", lambda job: self.__separate_stage(engine, streamer, job))
+
+        pipeline = Pipeline(
+            [
+                Stage("decode", lambda job: self.__decode_stage(engine, streamer, encoder, job)),
+                separate_stage,
+                Stage("encode+move", lambda job: self.__encode_stage(streamer, encoder, job, src, dest), self.encode_workers),
+            ],
+            self.queue_depth,
+            self.__on_pipeline_error,
+            self.output,
+        )
+
+        # Every job gets its own folder since several are in flight at once. Cancelling stops any more being fed in
+        jobs = (PipelineJob(MusicFile(path, self.model_name), self.scratch.job_dir()) for path in files if not self.cancelled.is_set())
         try:
-            self.output.info(f"Copying Metadata from {original_file.file_path.name} to {no_drums_path.name}")
-
-            original_tag: Tag = original_file.get_tag()
-
-            no_drums_audiofile = eyed3.load(str(no_drums_path))
-            if not no_drums_audiofile:
-                raise Exception(f"Failed to load eyed3 tags from {str(no_drums_path)}")
-
-            no_drums_audiofile.tag = original_tag
-            no_drums_audiofile.tag.title = f"{original_tag.title} (No Drums)"
-            no_drums_audiofile.tag.save(version=ID3_V2_4)
-        except Exception:
-            self.output.warning(f"Failed to get the tag for {no_drums_path.name} - skipping!")
-            no_drums_path.unlink()
-            return False
-        return True
+            with encoder:
+                pipeline.run(jobs)
+        finally:
+            engine.cancel = None
+
+        for stage in pipeline.stages:
+            self.output.info(stage.summary())
+
+    def __decode_stage(
+        self, engine: "SeparationEngine", streamer: "StreamingSeparator", encoder: "AudioEncoder", job: "PipelineJob"
+    ) -> "PipelineJob":
+        """Reads the job's tag and decodes its file, short-circuiting the separate and encode stages if it's already
+            cached. Long tracks are only measured here, since they're decoded again a window at a time as they're separated.
+            MP3 outputs are started off with the tag so the encoded audio only has to be appended after it"""
+        self.__start_stage(job, DECODE)
+        job.no_drums_path = job.out_dir.joinpath(f"no_drums{self.output_format.extension}").resolve()
+
+        with self.report.measure(job.file.file_path, "read_tag"):
+            try:
+                job.tag = job.file.get_tag(self.art_cache)
+            except Exception as e:
+                raise Exception(f"failed to get the tag: {e}") from e
+
+        with self.report.measure(job.file.file_path, "write_tag"):
+            job.audio_offset = job.file.write_tag_headers(job.tag, job.out_dir, self.keep_drums, self.output_format)
+
+        if self.__should_stream(job.file.file_path):
+            with self.report.measure(job.file.file_path, "decode") as timing:
+                job.stats = streamer.measure(job.file.file_path)
+                timing.audio_seconds = job.duration = job.stats.frames / engine.samplerate
+            return job
+
+        with self.report.measure(job.file.file_path, "decode") as timing:
+            job.wav = engine.load_audio(job.file.file_path)
+            timing.audio_seconds = job.duration = job.wav.shape[-1] / engine.samplerate
+
+        # Only the drumless output is cached, so the cache can't help if the drums are wanted too
+        if self.cache and not self.keep_drums:
+            job.cache_key = self.cache.fingerprint(job.wav, self.variant)
+            job.cached = job.file.get_cached(self.cache, job.cache_key, job.no_drums_path, encoder, job.tag)
+            if job.cached:
+                self.output.info(f"Found {job.file.file_path.name} in the cache")
+                job.wav = None
+                return job
+
+        job.inactive = job.file.find_inactive(job.wav, engine, self.report)
+        return job
+
+    def __separate_stage(self, engine: "SeparationEngine", streamer: "StreamingSeparator", job: "PipelineJob") -> "PipelineJob":
+        """Runs the model over the job's decoded audio"""
+        if job.cached:
+            return job
+        self.__start_stage(job, SEPARATE)
+
+        self.output.info(f"Splitting drum tracks from {job.file.file_path.name} using {self.__model_display_name()}:")
+        with NoPrintStatements(self.verbose), self.report.measure(job.file.file_path, "separate", job.duration) as timing:
+            with self.profiles.profile(job.file.file_path.name) if self.profiles else nullcontext():
+                if job.stats:
+                    job.spilled = streamer.separate(job.file.file_path, job.stats, job.out_dir, self.keep_drums)
+                else:
+                    timing.skipped_seconds = engine.skipped_seconds(job.wav, job.inactive)
+                    job.drums, job.no_drums = engine.split_drums(job.wav, job.inactive)
+
+        # Free the input now rather than holding it while the job waits to be encoded
+        job.wav = None
+        return job
+
+    def __separate_batch_stage(
+        self, engine: "SeparationEngine", streamer: "StreamingSeparator", jobs: List["PipelineJob"]
+    ) -> List["PipelineJob"]:
+        """Runs the model over several jobs' decoded audio in shared batches"""
+        # Streamed tracks were never decoded in full, so they're split on their own
+        for job in jobs:
+            if job.stats:
+                self.__separate_stage(engine, streamer, job)
+
+        to_split = [job for job in jobs if job.wav is not None]
+        if not to_split:
+            return jobs
+        [self.__start_stage(job, SEPARATE) for job in to_split]
+
+        names = ", ".join(job.file.file_path.name for job in to_split)
+        self.output.info(f"Splitting drum tracks from {names} using {self.__model_display_name()}:")
+        paths = [job.file.file_path for job in to_split]
+        durations = [job.duration for job in to_split]
+        skipped = [engine.skipped_seconds(job.wav, job.inactive) for job in to_split]
+        with NoPrintStatements(self.verbose), self.report.measure_batch(paths, durations, "separate", skipped):
+            with self.profiles.profile(f"batch of {to_split[0].file.file_path.name}") if self.profiles else nullcontext():
+                stems = engine.split_drums_batch([job.wav for job in to_split], [job.inactive for job in to_split])
+
+        for job, (drums, no_drums) in zip(to_split, stems):
+            job.drums, job.no_drums = drums, no_drums
+            job.wav = None
+        return jobs
+
+    def __encode_stage(
+        self, streamer: "StreamingSeparator", encoder: "AudioEncoder", job: "PipelineJob", src: Path, dest: Path
+    ) -> "PipelineJob":
+        """Encodes the job's drumless output (and the drums, if wanted), tagged, then relocates them"""
+        from src.tags import DRUMS_SUFFIX, NO_DRUMS_SUFFIX
+
+        self.__start_stage(job, ENCODE)
+        drums_path = job.out_dir.joinpath(f"drums{self.output_format.extension}")
+        no_drums_tags = job.file.container_tags(job.tag, NO_DRUMS_SUFFIX)
+        drums_tags = job.file.container_tags(job.tag, DRUMS_SUFFIX)
+
+        if job.spilled:
+            spilled_no_drums, spilled_drums = job.spilled
+            with self.report.measure(job.file.file_path, "encode", job.duration):
+                streamer.encode(spilled_no_drums, job.no_drums_path, encoder, append=True, tags=no_drums_tags)
+                if spilled_drums:
+                    streamer.encode(spilled_drums, drums_path, encoder, append=True, tags=drums_tags)
+            job.spilled = None
+        elif not job.cached:
+            with self.report.measure(job.file.file_path, "encode", job.duration):
+                encoder.encode(job.no_drums.numpy(), job.no_drums_path, append=True, tags=no_drums_tags)
+                if job.cache_key:
+                    self.cache.put(job.cache_key, job.no_drums_path, job.audio_offset)
+                if self.keep_drums:
+                    encoder.encode(job.drums.numpy(), drums_path, append=True, tags=drums_tags)
+            job.drums, job.no_drums = None, None
+
+        self.__finish_file(job.file, job.no_drums_path, src, dest)
+        return job
+
+    def __on_pipeline_error(self, job: "PipelineJob", e: Exception) -> None:
+        """Reports a file that failed partway through the pipeline and cleans up after it"""
+        self.scratch.release(job.out_dir)
+        # Every file still in the pipeline fails this way once the run is cancelled, which isn't worth a warning each
+        if isinstance(e, ConversionCancelled):
+            return
+        self.output.warning(f"Failed to convert {job.file.file_path.name} - skipping! ({e})")
+        self.progress.stage(job.file.file_path, FAILED)
+        if self.work_queue and self.work_queue.fail(job.file.file_path, str(e)):
+            self.output.info(f"{job.file.file_path.name} will be tried again")
+
+    def __start_stage(self, job: "PipelineJob", stage: str) -> None:
+        """Reports a job moving on to a stage, unless the run's been cancelled, in which case the job is abandoned"""
+        if self.cancelled.is_set():
+            raise ConversionCancelled("Cancelled")
+        self.progress.stage(job.file.file_path, stage)
+
+    def __process_in_pool(self, files: List[Path], src: Path, dest: Path) -> None:
+        """Splits files across a pool of worker processes, each with the model resident.
+            Results stream back here as they complete so that tagging and relocation stay in one place
+
+        Args:
+            files (List[Path]): The music files to convert
+            src (Path): The source directory being traversed
+            dest (Path): The destination directory to mirror the source into
+        """
+        from src.music_file import MusicFile
+        from src.registry import DEFAULT_BUDGET_BYTES
+        from src.shared_weights import SharedWeights
+        from src.workers import init_worker, separate_in_worker
+
+        if self.profiles:
+            self.output.warning("Profiling only covers single-process runs; no traces will be taken with --workers")
+
+        # Split the cores evenly so that workers x threads ~= cores rather than oversubscribing them
+        threads = max(1, (os.cpu_count() or 2) // self.workers)
+        # Loaded once here and mapped by every worker, so the weights are only in memory once however many workers there are
+        weights_dir = self.scratch.path.joinpath("weights")
+        self.output.info(f"Loading model {self.model_name} to share between the workers..")
+        with NoPrintStatements(self.verbose):
+            SharedWeights(weights_dir).publish(self.model_name)
+
+        self.output.info(f"Starting {self.workers} workers with {threads} thread(s) each using {self.__model_display_name()}..")
+
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=init_worker,
+            initargs=(
+                self.model_name,
+                threads,
+                self.verbose,
+                self.keep_drums,
+                self.cache_dir,
+                self.cache_max_bytes,
+                self.batch_segments,
+                self.scratch.path,
+                self.stream_window,
+                DEFAULT_BUDGET_BYTES,
+                self.backend,
+                self.settings,
+                self.output_format,
+                weights_dir,
+            ),
+        ) as pool:
+            futures = {pool.submit(separate_in_worker, path, self.__should_stream(path)): path for path in files}
+
+            for future in as_completed(futures):
+                # Only the files no worker has started on yet can be called off
+                if self.cancelled.is_set():
+                    [pending.cancel() for pending in futures]
+                if future.cancelled():
+                    continue
+
+                original_path = futures[future]
+                try:
+                    no_drums_path, timings = future.result()
+                except Exception as e:
+                    self.output.warning(f"Failed to split {original_path.name} - skipping! ({e})")
+                    self.progress.stage(original_path, FAILED)
+                    continue
+
+                self.report.add(timings)
+
+                self.output.info(f"Split drum tracks from {original_path.name}")
+                # One file failing to be moved into place mustn't take the rest of the pool's results down with it
+                try:
+                    self.__finish_file(MusicFile(original_path, self.model_name), no_drums_path, src, dest)
+                except Exception as e:
+                    self.output.warning(f"Failed to convert {original_path.name} - skipping! ({e})")
+                    self.scratch.release(no_drums_path.parent)
+                    self.progress.stage(original_path, FAILED)
+
+    def __finish_file(self, original_file: "MusicFile", no_drums_path: Path, src: Path, dest: Path) -> None:
+        """Moves the drumless track to its mirrored spot in the destination. It's already been tagged by this point
+
+        Args:
+            original_file (MusicFile): The MusicFile instance for the original, unmodified/unsplit song
+            no_drums_path (Path): The path to the drumless, tagged output file after splitting
+            src (Path): The source directory being traversed
+            dest (Path): The destination directory to mirror the source into
+        """
+        original_path = original_file.file_path
+        extension = no_drums_path.suffix
+
+        # Grab this before the drumless track gets moved away from its side
+        drums_path = no_drums_path.parent.joinpath(f"drums{extension}")
+
+        # Replace the input destination with the output destination
+        file_output_root = str(original_path.parent).replace(str(src), str(dest))
+        file_output_root = Path(file_output_root).resolve()
+        # We also need to replace the original {file} extension with the output format's
+        file_dest = file_output_root.joinpath(f"{original_path.stem}{extension}")
+        # Make the output subdir(s) and move the no-drums file from the temp output to the final destination
+        with self.report.measure(original_path, "move"):
+            os.makedirs(file_output_root, exist_ok=True)
+            shutil.move(no_drums_path, file_dest)
+
+        if self.keep_drums and drums_path.exists():
+            with self.report.measure(original_path, "move"):
+                shutil.move(drums_path, file_output_root.joinpath(f"{original_path.stem} (Drums){extension}"))
+        self.scratch.release(no_drums_path.parent)
+
+        # Logged before the bookkeeping below, since nothing may fail once a file's been recorded as converted
+        self.output.info(f"Done processing {original_path.name} and relocated it to {file_dest}!")
+
+        self.manifest.mark_converted(original_path, self.variant, file_dest)
+        if self.work_queue:
+            self.work_queue.complete(original_path)
+        with self.lock:
+            self.converted_seconds += self.durations.get(original_path, 0)
+        self.progress.stage(original_path, DONE)
+
+    def __should_stream(self, path: Path) -> bool:
+        """Determines if a file is long enough, going by the job plan, to separate a window at a time"""
+        return bool(self.stream_above) and self.durations.get(path, 0) > self.stream_above * 60
+
+    def __model_display_name(self) -> str:
+        """Gets the human-friendly name of the model in use, as listed in MODEL_CHOICES"""
+        return list(MODEL_CHOICES.keys())[list(MODEL_CHOICES.values()).index(self.model_name)]
@@ -0,0 +1,95 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+# The stages a file is reported at, in the order it moves through them. A file ends up either DONE or FAILED
+DECODE = "decode"
+SEPARATE = "separate"
+ENCODE = "encode"
+DONE = "done"
+FAILED = "failed"
+
+
+class ConversionCancelled(Exception):
+    """Raised inside a run that's been asked to stop, to abandon whatever it was working on"""
+
+
+@dataclass
+class ProgressEvent:
+    """Where a run has got to, sent whenever a file moves on to its next stage"""
+
+    file_index: int  # 1-based, in the order the files were planned
+    total_files: int
+    file_name: str
+    stage: str
+    files_done: int
+    # How much of the run's audio has been converted (or given up on), from 0 to 1
+    fraction: float
+    # Seconds of audio converted per second of the run so far. Until a file has finished, the average of previous runs
+    realtime_factor: Optional[float]
+    eta_seconds: Optional[float]
+
+
+class ProgressTracker:
+    def __init__(
+        self,
+        durations: Dict[Path, float],
+        on_progress: Optional[Callable[[ProgressEvent], None]],
+        realtime_factor: Optional[float] = None,
+    ):
+        """Follows the files of a single run through their stages, reporting each step along with an ETA.
+            Safe to call from every stage's threads at once
+
+        Args:
+            durations (Dict[Path, float]): Each planned file's duration in seconds, in the order they were planned
+            on_progress (Optional[Callable[[ProgressEvent], None]]): Called with every event, on whichever thread
+                reported it. Nothing is reported if None
+            realtime_factor (Optional[float]): How quickly previous runs went, for an ETA before any file has finished
+        """
+        self.durations = durations
+        self.indices = {path: idx + 1 for idx, path in enumerate(durations)}
+        self.on_progress = on_progress
+        self.realtime_factor = realtime_factor
+        self.total_seconds = sum(durations.values())
+        self.done_seconds: float = 0
+        self.converted_seconds: float = 0
+        self.files_done: int = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def stage(self, path: Path, stage: str) -> None:
+        """Reports a file moving on to a stage. DONE and FAILED count the file as finished
+
+        Args:
+            path (Path): The original file, as planned
+            stage (str): One of the stages above
+        """
+        with self.lock:
+            if stage in (DONE, FAILED):
+                self.files_done += 1
+                self.done_seconds += self.durations.get(path, 0)
+                if stage == DONE:
+                    self.converted_seconds += self.durations.get(path, 0)
+            if not self.on_progress:
+                return
+
+            elapsed = time.perf_counter() - self.start
+            realtime_factor = self.converted_seconds / elapsed if self.converted_seconds and elapsed else self.realtime_factor
+            remaining = self.total_seconds - self.done_seconds
+            event = ProgressEvent(
+                self.indices.get(path, 0),
+                len(self.durations),
+                path.name,
+                stage,
+                self.files_done,
+                self.done_seconds / self.total_seconds if self.total_seconds else self.files_done / max(1, len(self.durations)),
+                realtime_factor,
+                remaining / realtime_factor if realtime_factor else None,
+            )
+        self.on_progress(event)
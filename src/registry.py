@@ -0,0 +1,150 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+import torch
+
+from src.engine import SeparationEngine
+
+# Room for a couple of the larger MODEL_CHOICES at once
+DEFAULT_BUDGET_BYTES = 2 * 1024**3
+
+
+@dataclass
+class RegistryStats:
+    """How well a ModelRegistry's resident models have matched what was asked of it"""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    load_seconds: float = 0
+    resident: List[str] = field(default_factory=list)
+    resident_bytes: int = 0
+
+
+def model_bytes(model: torch.nn.Module) -> int:
+    """Measures how much memory a model's weights take up
+
+    Args:
+        model (torch.nn.Module): The model to measure. For a bag of models, every model in the bag is counted
+
+    Returns:
+        int: The combined size of the model's parameters and buffers in bytes
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_BUDGET_BYTES,
+        factory: Callable[[str], SeparationEngine] = SeparationEngine,
+    ):
+        """Keeps the engines for recently used models loaded so that switching back and forth between models doesn't
+            mean reloading them every time. Models are loaded on first use, and the least recently used ones are
+            dropped once the resident models' weights add up to more than max_bytes. The model just asked for is
+            always kept, even if it's larger than the budget on its own
+
+        Args:
+            max_bytes (int): The most memory the resident models' weights may take up. The memory used while
+                separating comes on top of this and isn't counted
+            factory (Callable[[str], SeparationEngine]): Creates the engine for a model name
+        """
+        self.max_bytes = max_bytes
+        self.factory = factory
+        self.engines: "OrderedDict[str, SeparationEngine]" = OrderedDict()
+        self.sizes: Dict[str, int] = {}
+        self.counters = RegistryStats()
+        self.lock = threading.Lock()
+        # Held while loading, so two threads asking for the same cold model only load it once
+        self.loading: Dict[str, threading.Lock] = {}
+
+    def get(self, model_name: str) -> SeparationEngine:
+        """Gets the engine for a model, loading it first if it isn't resident
+
+        Args:
+            model_name (str): The name of the Demucs model
+
+        Returns:
+            SeparationEngine: The model's engine
+        """
+        return self.__get(model_name, count=True)
+
+    def preload(self, model_name: str) -> None:
+        """Loads a model ahead of time so that its first use doesn't wait on it. Doesn't count as a hit or miss
+
+        Args:
+            model_name (str): The name of the Demucs model to load
+        """
+        self.__get(model_name, count=False)
+
+    def is_resident(self, model_name: str) -> bool:
+        """Determines if a model is already loaded
+
+        Args:
+            model_name (str): The name of the Demucs model
+
+        Returns:
+            bool: True if getting the model won't have to load it
+        """
+        with self.lock:
+            return model_name in self.engines
+
+    def stats(self) -> RegistryStats:
+        """Gets a snapshot of how the registry has fared so far
+
+        Returns:
+            RegistryStats: The hit, miss and eviction counts, time spent loading, and what's currently resident
+        """
+        with self.lock:
+            return RegistryStats(
+                self.counters.hits,
+                self.counters.misses,
+                self.counters.evictions,
+                self.counters.load_seconds,
+                list(self.engines),
+                sum(self.sizes.values()),
+            )
+
+    def __get(self, model_name: str, count: bool) -> SeparationEngine:
+        """Gets the engine for a model, loading it if need be, and counting the hit or miss if asked to"""
+        with self.lock:
+            if model_name in self.engines:
+                self.engines.move_to_end(model_name)
+                self.counters.hits += count
+                return self.engines[model_name]
+            loading = self.loading.setdefault(model_name, threading.Lock())
+
+        with loading:
+            with self.lock:
+                # Another thread may have loaded it while this one waited its turn
+                if model_name in self.engines:
+                    self.engines.move_to_end(model_name)
+                    self.counters.hits += count
+                    return self.engines[model_name]
+
+            start = time.perf_counter()
+            engine = self.factory(model_name)
+            load_seconds = time.perf_counter() - start
+
+            with self.lock:
+                self.counters.misses += count
+                self.counters.load_seconds += load_seconds
+                self.engines[model_name] = engine
+                self.sizes[model_name] = model_bytes(engine.model)
+                self.__evict()
+        return engine
+
+    def __evict(self) -> None:
+        """Drops the least recently used models until the rest fit in the budget. Must be called with the lock held"""
+        while len(self.engines) > 1 and sum(self.sizes.values()) > self.max_bytes:
+            model_name, _ = self.engines.popitem(last=False)
+            del self.sizes[model_name]
+            self.counters.evictions += 1
@@ -0,0 +1,123 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Tuple
+
+from tinytag import TinyTag
+
+from src.common import SUPPORTED_EXTS
+from src.messaging import CliOutput
+
+
+@dataclass
+class PlannedJob:
+    """A single file to convert, along with what a cheap look at its header says about it"""
+
+    path: Path
+    size: int
+    duration: float  # In seconds; 0 if the header couldn't be read
+
+
+class DirectoryScanner:
+    def __init__(self, output: CliOutput, threads: int = 16):
+        """Finds and sizes up the work in a directory before any of it starts. Directory listings and header
+            probes run across a thread pool since on network mounts they're dominated by round-trip latency
+
+        Args:
+            output (CliOutput): Where to report directories that couldn't be listed
+            threads (int): How many directories or files to look at concurrently
+        """
+        self.output = output
+        self.threads = threads
+
+    def scan(self, src: Path) -> Tuple[List[Path], List[Path]]:
+        """Recursively lists every file in the source directory
+
+        Args:
+            src (Path): The directory to scan
+
+        Returns:
+            Tuple[List[Path], List[Path]]: The supported and unsupported files found, in that order
+        """
+        supported, unsupported = [], []
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            pending = {pool.submit(self.__list_dir, src)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dirs, files = future.result()
+                    pending |= {pool.submit(self.__list_dir, d) for d in dirs}
+                    for file in files:
+                        (supported if is_supported(file) else unsupported).append(file)
+
+        return sorted(supported), sorted(unsupported)
+
+    def plan(self, paths: List[Path]) -> List[PlannedJob]:
+        """Probes each file's size and duration, ordering them longest-first so that the biggest jobs
+            start early rather than leaving one worker grinding on a long track at the very end
+
+        Args:
+            paths (List[Path]): The files to plan
+
+        Returns:
+            List[PlannedJob]: The planned jobs, longest first
+        """
+        with ThreadPoolExecutor(self.threads) as pool:
+            jobs = list(pool.map(self.__probe, paths))
+
+        return sorted(jobs, key=lambda job: (job.duration, job.size), reverse=True)
+
+    def __list_dir(self, path: Path) -> Tuple[List[Path], List[Path]]:
+        """Lists a single directory. Symlinked directories aren't followed, so a link back up the tree can't loop
+            forever or pull in files from outside it, and a directory that can't be read is reported and skipped
+
+        Args:
+            path (Path): The directory to list
+
+        Returns:
+            Tuple[List[Path], List[Path]]: The subdirectories and files within it, in that order
+        """
+        dirs, files = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(Path(entry.path))
+                    elif entry.is_file():
+                        files.append(Path(entry.path))
+        except OSError as e:
+            self.output.warning(f"Couldn't list {path}, skipping it: {e}")
+        return dirs, files
+
+    def __probe(self, path: Path) -> PlannedJob:
+        """Reads a file's size and, from its header alone, its duration
+
+        Args:
+            path (Path): The file to probe
+
+        Returns:
+            PlannedJob: The planned job for the file
+        """
+        try:
+            duration = TinyTag.get(str(path)).duration or 0
+        except Exception:
+            duration = 0
+        return PlannedJob(path, path.stat().st_size, duration)
+
+
+def is_supported(path: Path) -> bool:
+    """Determines if a file has one of the SUPPORTED_EXTS, ignoring case
+
+    Args:
+        path (Path): The file to check
+
+    Returns:
+        bool: True if the file can be converted, False otherwise
+    """
+    return path.suffix.lower() in SUPPORTED_EXTS
@@ -0,0 +1,83 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import atexit
+import os
+import shutil
+import signal
+import threading
+import time
+from pathlib import Path
+from uuid import uuid4
+
+# Anything left behind by a run that was killed outright (so never got to clean up) is removed after this long
+STALE_AFTER_SECONDS = 24 * 60 * 60
+
+
+class ScratchSpace:
+    def __init__(self, root: Path):
+        """A private directory for a single run's intermediate files, with a fresh subdirectory per job so that
+            neither concurrent jobs nor concurrent runs sharing the same root can overwrite each other's output.
+            Keeping the root on the same volume as the output means the final move is a rename instead of a copy
+
+        Args:
+            root (Path): Where to create the run's directory. Shared between runs, so it's never removed itself
+        """
+        self.root = Path(root).resolve()
+        self.path = self.root.joinpath(uuid4().hex)
+        self.__previous_sigterm = None
+
+    def __enter__(self) -> "ScratchSpace":
+        self.__sweep_stale()
+        os.makedirs(self.path, exist_ok=True)
+
+        # A crash still runs atexit handlers, and SIGTERM is turned into a normal exit so it does too
+        atexit.register(self.cleanup)
+        if threading.current_thread() is threading.main_thread():
+            self.__previous_sigterm = signal.signal(signal.SIGTERM, self.__on_sigterm)
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.cleanup()
+        atexit.unregister(self.cleanup)
+        if self.__previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, self.__previous_sigterm)
+            self.__previous_sigterm = None
+
+    def job_dir(self) -> Path:
+        """Creates a new, empty directory for a single job
+
+        Returns:
+            Path: The job's directory
+        """
+        path = self.path.joinpath(uuid4().hex)
+        os.makedirs(path)
+        return path
+
+    def release(self, job_dir: Path) -> None:
+        """Removes a job's directory once everything worth keeping has been moved out of it
+
+        Args:
+            job_dir (Path): The directory given out by `job_dir`
+        """
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    def cleanup(self) -> None:
+        """Removes the run's directory along with anything still in it"""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __sweep_stale(self) -> None:
+        """Removes run directories that haven't been touched in a long time, left by runs that were killed outright"""
+        if not self.root.exists():
+            return
+
+        for entry in self.root.iterdir():
+            try:
+                if entry.is_dir() and time.time() - entry.stat().st_mtime > STALE_AFTER_SECONDS:
+                    shutil.rmtree(entry, ignore_errors=True)
+            except OSError:
+                continue  # Another run got to it first
+
+    def __on_sigterm(self, *_) -> None:
+        raise SystemExit(1)
@@ -0,0 +1,396 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import json
+import shutil
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from src.common import BACKENDS, MODEL_CHOICES
+from src.formats import MIME_TYPES, OUTPUT_FORMATS, OutputFormat
+from src.presets import PRESETS, InferenceSettings
+from src.jobqueue import DONE, JobQueue, QueuedJob, QueueFullError
+from src.messaging import CliOutput
+from src.registry import DEFAULT_BUDGET_BYTES
+from src.scanner import is_supported
+
+# Sent with 503s so well-behaved clients back off rather than retrying straight away
+RETRY_AFTER_SECONDS = 10
+
+
+class SeparationServer(ThreadingHTTPServer):
+    # Don't hold up shutting down for requests that are still being answered
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple,
+        job_queue: JobQueue,
+        output: CliOutput,
+        allowed_dirs: List[Path],
+        max_upload_bytes: int,
+        overrides: Optional[dict] = None,
+    ):
+        """A small HTTP/JSON front end to a JobQueue, so other services can have files converted.
+            Each request is handled on its own thread; the splitting itself happens in the queue's workers
+
+        Args:
+            address (tuple): The (host, port) to listen on
+            job_queue (JobQueue): The already-started queue to submit jobs to
+            output (CliOutput): The handler for displaying output to the user
+            allowed_dirs (List[Path]): The directories whose files may be submitted by path. Empty disallows it
+            max_upload_bytes (int): The largest upload to accept
+            overrides (Optional[dict]): `InferenceSettings.from_preset`'s keyword arguments the server was started with,
+                applied on top of whichever preset a job asks for
+        """
+        super().__init__(address, SeparationRequestHandler)
+        self.job_queue = job_queue
+        self.output = output
+        self.allowed_dirs = [Path(path).resolve() for path in allowed_dirs]
+        self.max_upload_bytes = max_upload_bytes
+        self.overrides = overrides or {}
+
+
+class SeparationRequestHandler(BaseHTTPRequestHandler):
+    """Handles the server's endpoints:
+
+    GET  /models                               The models, presets and formats that can be asked for, and how often the
+                                               workers had to load a model
+    POST /jobs?model=&name=&preset=&format=    Submits the request body as an audio file named `name`
+    POST /jobs                                 Submits {"path": ..., "model": ..., "preset": ..., "format": ...} for a
+                                               file already on the server
+    GET  /jobs/{id}                            Checks on a job
+    GET  /jobs/{id}/download                   Downloads a finished job's tagged, drumless output
+
+    Jobs that don't name a model, preset or format use the ones the server was started with. The server's --shifts,
+    --overlap, --segment, --keep-silence and --skip-drumless apply whichever preset a job asks for. A format asked for
+    by name is encoded at its default bitrate
+    """
+
+    server: SeparationServer
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        parts = urlparse(self.path).path.strip("/").split("/")
+
+        if parts == ["models"]:
+            models = [{"name": name, "description": desc} for desc, name in MODEL_CHOICES.items()]
+            stats = self.server.job_queue.model_stats
+            self.__send_json(
+                HTTPStatus.OK,
+                {
+                    "models": models,
+                    "default": self.server.job_queue.model_name,
+                    "presets": list(PRESETS),
+                    "formats": OUTPUT_FORMATS,
+                    "hits": stats.hits,
+                    "misses": stats.misses,
+                    "load_seconds": stats.load_seconds,
+                },
+            )
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self.__get_job(parts[1])
+            if job:
+                self.__send_json(HTTPStatus.OK, self.__describe(job))
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "download":
+            job = self.__get_job(parts[1])
+            if job:
+                self.__send_output(job)
+        else:
+            self.__send_error(HTTPStatus.NOT_FOUND, "No such endpoint")
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        if url.path.strip("/") != "jobs":
+            self.__send_error(HTTPStatus.NOT_FOUND, "No such endpoint")
+            return
+
+        # Turned away before the upload is read, so a full queue costs the client as little as possible
+        if self.server.job_queue.is_full():
+            self.__send_busy()
+            return
+
+        if self.headers.get_content_type() == "application/json":
+            self.__submit_path()
+        else:
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            self.__submit_upload(
+                query.get("model", self.__default_model()), query.get("name", ""), query.get("preset"), query.get("format")
+            )
+
+    def log_message(self, format: str, *args) -> None:
+        self.server.output.info(f"{self.address_string()} - {format % args}")
+
+    def __submit_upload(self, model_name: str, name: str, preset: Optional[str], output_format: Optional[str]) -> None:
+        """Saves the request body as an audio file and queues it"""
+        if "Content-Length" not in self.headers:
+            self.__send_error(HTTPStatus.LENGTH_REQUIRED, "Uploads need a Content-Length")
+            return
+        size = self.__content_length()
+        if size is None:
+            return
+        if size > self.server.max_upload_bytes:
+            self.__send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Uploads can't be larger than {self.server.max_upload_bytes} bytes")
+            return
+        if not self.__check_request(model_name, Path(name), preset, output_format):
+            return
+
+        try:
+            upload = self.server.job_queue.save_upload(self.rfile, name, size)
+        except EOFError as e:
+            self.__send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+
+        try:
+            job_id = self.server.job_queue.submit(upload, model_name, **self.__job_options(preset, output_format))
+        except QueueFullError:
+            self.server.job_queue.release_upload(upload)
+            self.__send_busy()
+            return
+        self.__send_json(HTTPStatus.ACCEPTED, self.__describe(self.server.job_queue.status(job_id)))
+
+    def __submit_path(self) -> None:
+        """Queues a file that's already on the server, as long as it's within one of the allowed directories"""
+        size = self.__content_length()
+        if size is None:
+            return
+        try:
+            body = json.loads(self.rfile.read(size) or b"{}")
+            path = Path(body["path"]).resolve()
+        except (ValueError, KeyError, TypeError):
+            self.__send_error(
+                HTTPStatus.BAD_REQUEST, 'Expected a JSON body like {"path": ..., "model": ..., "preset": ..., "format": ...}'
+            )
+            return
+
+        model_name = body.get("model", self.__default_model())
+        preset = body.get("preset")
+        output_format = body.get("format")
+        if not any(path.is_relative_to(allowed) for allowed in self.server.allowed_dirs):
+            self.__send_error(HTTPStatus.FORBIDDEN, "Files may only be submitted by path from the server's allowed directories")
+            return
+        if not path.is_file():
+            self.__send_error(HTTPStatus.NOT_FOUND, f"{path} doesn't exist")
+            return
+        if not self.__check_request(model_name, path, preset, output_format):
+            return
+
+        try:
+            job_id = self.server.job_queue.submit(path, model_name, owned=False, **self.__job_options(preset, output_format))
+        except QueueFullError:
+            self.__send_busy()
+            return
+        self.__send_json(HTTPStatus.ACCEPTED, self.__describe(self.server.job_queue.status(job_id)))
+
+    def __content_length(self) -> Optional[int]:
+        """Reads the request's Content-Length, treating a missing one as an empty body and answering the request with
+        a 400 if it isn't a byte count"""
+        size = self.headers.get("Content-Length", "0").strip()
+        if not (size.isascii() and size.isdigit()):
+            self.__send_error(HTTPStatus.BAD_REQUEST, f"Content-Length should be a number of bytes, not {size!r}")
+            return None
+        return int(size)
+
+    def __check_request(self, model_name: str, path: Path, preset: Optional[str], output_format: Optional[str]) -> bool:
+        """Makes sure a submission is for a known model, preset and format and a supported file type, answering the
+        request if not"""
+        if model_name not in MODEL_CHOICES.values():
+            self.__send_error(HTTPStatus.BAD_REQUEST, f"Unknown model {model_name}. See /models for the options")
+            return False
+        if preset is not None and preset not in PRESETS:
+            self.__send_error(HTTPStatus.BAD_REQUEST, f"Unknown preset {preset}. See /models for the options")
+            return False
+        if output_format is not None and output_format not in OUTPUT_FORMATS:
+            self.__send_error(HTTPStatus.BAD_REQUEST, f"Unknown format {output_format}. See /models for the options")
+            return False
+        if not is_supported(path):
+            self.__send_error(HTTPStatus.UNSUPPORTED_MEDIA_TYPE, f"{path.name or 'The file'} doesn't have a supported extension")
+            return False
+        return True
+
+    def __get_job(self, job_id: str) -> Optional[QueuedJob]:
+        """Looks a job up, answering the request with a 404 if there's no such job"""
+        job = self.server.job_queue.status(job_id)
+        if not job:
+            self.__send_error(HTTPStatus.NOT_FOUND, "No such job. Finished jobs are only kept for a while")
+        return job
+
+    def __describe(self, job: QueuedJob) -> dict:
+        """Describes a job for a JSON response, leaving out where anything lives on the server"""
+        return {
+            "id": job.id,
+            "name": job.name,
+            "model": job.model_name,
+            "state": job.state,
+            "error": job.error,
+            "submitted": job.submitted,
+            "finished": job.finished or None,
+            "pending": self.server.job_queue.pending(),
+            "download": f"/jobs/{job.id}/download" if job.state == DONE else None,
+        }
+
+    def __job_options(self, preset: Optional[str], output_format: Optional[str]) -> dict:
+        """Turns a request's already checked preset and format names into JobQueue.submit's keyword arguments"""
+        return {
+            "settings": InferenceSettings.from_preset(preset, **self.server.overrides) if preset else None,
+            "output_format": OutputFormat.for_container(output_format) if output_format else None,
+        }
+
+    def __default_model(self) -> str:
+        """The model to use when a request doesn't ask for one"""
+        return self.server.job_queue.model_name
+
+    def __send_output(self, job: QueuedJob) -> None:
+        """Streams a finished job's output back to the client"""
+        if job.state != DONE:
+            self.__send_error(HTTPStatus.CONFLICT, f"The job is {job.state}, not done")
+            return
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", MIME_TYPES.get(job.output.suffix.lstrip("."), "application/octet-stream"))
+        self.send_header("Content-Length", str(job.output.stat().st_size))
+        self.send_header("Content-Disposition", f'attachment; filename="{Path(job.name).stem}{job.output.suffix}"')
+        self.end_headers()
+        with open(job.output, "rb") as fh:
+            shutil.copyfileobj(fh, self.wfile)
+
+    def __send_busy(self) -> None:
+        """Tells the client the queue is full and when to try again"""
+        self.close_connection = True
+        self.__send_json(
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            {"error": "The queue is full, try again later"},
+            {"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+
+    def __send_error(self, status: HTTPStatus, message: str) -> None:
+        # A rejected upload's body may not have been read, which would leave it to be mistaken for the next request
+        if self.command == "POST":
+            self.close_connection = True
+        self.__send_json(status, {"error": message})
+
+    def __send_json(self, status: HTTPStatus, body: dict, headers: Optional[dict] = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def __get_parser() -> ArgumentParser:
+    """Creates an arg parser for the server
+
+    Returns:
+        ArgumentParser: The created and configured arg parser.
+    """
+    parser = ArgumentParser(
+        prog="Drum Track Converter Server",
+        description="Serves drum track conversion over HTTP, keeping models loaded between requests",
+        formatter_class=RawTextHelpFormatter,
+    )
+
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8000, help="The port to listen on")
+    parser.add_argument(
+        "--preload",
+        nargs="*",
+        choices=list(MODEL_CHOICES.values()),
+        default=[list(MODEL_CHOICES.values())[0]],
+        help="Which models to load at startup rather than on first use. The first is used when a request doesn't ask for one",
+    )
+    parser.add_argument(
+        "--model-budget",
+        type=float,
+        default=DEFAULT_BUDGET_BYTES / 1024**2,
+        help="How much memory, in MB, each worker may keep loaded models in. The least recently used are dropped beyond it",
+    )
+    parser.add_argument("--backend", choices=BACKENDS, default="float32", help="How to run the models. See src.cli --help")
+    parser.add_argument("--preset", choices=list(PRESETS), default="balanced", help="The preset for jobs that don't ask for one. See src.cli --help")
+    parser.add_argument("--shifts", type=int, default=None, help="Overrides --preset's shifts")
+    parser.add_argument("--overlap", type=float, default=None, help="Overrides --preset's overlap")
+    parser.add_argument("--segment", type=float, default=None, help="Overrides --preset's segment length, in seconds")
+    parser.add_argument("--skip-drumless", action="store_true", help="Skip stretches without drums. See src.cli --help")
+    parser.add_argument("--keep-silence", action="store_true", help="Run the model over silent stretches too")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="mp3", help="The format for jobs that don't ask for one")
+    parser.add_argument("--bitrate", type=int, default=None, help="The bitrate for --format, in kbps. See src.cli --help")
+    parser.add_argument("--vbr", type=int, choices=range(10), default=None, metavar="QUALITY", help="See src.cli --help")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="How many worker processes to run in all, shared by every model. Each keeps as many models loaded as fit\n"
+        "in --model-budget",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=8,
+        help="The most unfinished jobs to hold at once. Submissions beyond it get a 503 with a Retry-After\n"
+        "rather than waiting in an ever-growing queue. 0 accepts everything",
+    )
+    parser.add_argument("--max-upload", type=float, default=500, help="The largest upload to accept, in MB")
+    parser.add_argument(
+        "--allow-dir",
+        nargs="*",
+        default=[],
+        help="Directories whose files may be submitted by path instead of uploaded. Submitting by path is off by default",
+    )
+    parser.add_argument("--scratch-dir", default=".dtc_server", help="Where to keep uploads and outputs until they're collected")
+    parser.add_argument("--keep-finished", type=float, default=60, help="How many minutes to keep a finished job's output for")
+
+    return parser
+
+
+if __name__ == "__main__":
+    logger = CliOutput()
+    args = __get_parser().parse_args()
+
+    # Applied to every job's preset, not just the default one
+    overrides = {
+        "shifts": args.shifts,
+        "overlap": args.overlap,
+        "segment": args.segment,
+        "skip_silence": False if args.keep_silence else None,
+        "skip_drumless": args.skip_drumless or None,
+    }
+    job_queue = JobQueue(
+        Path(args.scratch_dir),
+        args.workers,
+        args.keep_finished * 60,
+        max_pending=args.max_pending,
+        model_name=(args.preload or list(MODEL_CHOICES.values()))[0],
+        model_budget=int(args.model_budget * 1024**2),
+        backend=args.backend,
+        settings=InferenceSettings.from_preset(args.preset, **overrides),
+        output_format=OutputFormat.for_container(args.format, args.bitrate, args.vbr),
+    )
+    try:
+        with job_queue:
+            for model_name in args.preload:
+                logger.info(f"Loading model {model_name}..")
+                job_queue.preload(model_name)
+
+            server = SeparationServer(
+                (args.host, args.port),
+                job_queue,
+                logger,
+                [Path(path) for path in args.allow_dir],
+                int(args.max_upload * 1024**2),
+                overrides,
+            )
+            logger.info(f"Listening on http://{args.host}:{args.port}")
+            server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,76 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import os
+from pathlib import Path
+from uuid import uuid4
+
+import torch
+from demucs.pretrained import get_model
+
+
+class SharedWeights:
+    def __init__(self, directory: Path):
+        """A directory of models saved whole, as Demucs loads them, in files that can be memory-mapped. Every process
+            that loads a model from here maps the same file, so its weights are held once in the page cache and shared
+            between them rather than copied into each. The mappings are copy-on-write: nothing a process does to its
+            weights is seen by the others, or written back to the file
+
+        Args:
+            directory (Path): Where to keep the saved models. Best inside a run's scratch space, so they're removed with it
+        """
+        self.directory = Path(directory)
+
+    def path(self, model_name: str) -> Path:
+        """Gets where a model is (or would be) saved
+
+        Args:
+            model_name (str): The name of the Demucs model
+
+        Returns:
+            Path: The model's file
+        """
+        return self.directory.joinpath(f"{model_name}.pt")
+
+    def publish(self, model_name: str) -> Path:
+        """Loads a model from Demucs' checkpoints and saves it here, unless it's already been saved. Meant to be done
+            once in a parent process before its workers start, so they don't each load their own copy first
+
+        Args:
+            model_name (str): The name of the Demucs model to save
+
+        Returns:
+            Path: The model's file
+        """
+        path = self.path(model_name)
+        if path.exists():
+            return path
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Saved under a name of its own and renamed into place, so nothing ever maps a half-written file. Processes
+        # racing to save the same model just replace each other's identical copy
+        temp_path = self.directory.joinpath(f"{model_name}.{uuid4().hex}.tmp")
+        try:
+            torch.save(get_model(model_name), temp_path)
+            os.replace(temp_path, path)
+        except OSError:
+            # Windows won't replace a file another process has mapped, which means the model's already there
+            if not path.exists():
+                raise
+        finally:
+            temp_path.unlink(missing_ok=True)
+        return path
+
+    def load(self, model_name: str) -> torch.nn.Module:
+        """Maps a model's weights from here, saving the model first if nothing else has yet
+
+        Args:
+            model_name (str): The name of the Demucs model to load
+
+        Returns:
+            torch.nn.Module: The model (or bag of models), its weights backed by the shared file
+        """
+        # The file holds the whole model rather than just its weights, which only loads with weights_only off.
+        # It's one this program wrote itself moments ago, so that's safe
+        return torch.load(self.publish(model_name), map_location="cpu", mmap=True, weights_only=False)
@@ -0,0 +1,357 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import math
+import random
+from contextlib import nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from demucs.apply import BagOfModels
+from demucs.utils import center_trim
+
+from src.encoders import AudioEncoder
+from src.engine import SeparationEngine
+from src.tags import ContainerTags
+
+
+@dataclass
+class StreamStats:
+    """What a first pass over a file found out, which separating it a window at a time needs up-front"""
+
+    frames: int
+    mean: torch.Tensor
+    std: torch.Tensor
+
+
+@dataclass
+class SpilledStem:
+    """A separated stem written to scratch as raw interleaved float32 samples, waiting to be encoded"""
+
+    path: Path
+    frames: int
+    channels: int
+    peak: torch.Tensor
+
+
+class StreamBuffer:
+    def __init__(self, channels: int, frames: int):
+        """The normalized input audio that's been decoded but that some segment may still need
+
+        Args:
+            channels (int): How many channels the audio has
+            frames (int): How many samples (per channel) the whole file has
+        """
+        self.frames = frames
+        self.start = 0
+        self.audio = torch.zeros(channels, 0)
+        self.complete = False
+
+    @property
+    def end(self) -> int:
+        """The sample the buffered audio runs up to, or the end of the file once it's all been decoded"""
+        return self.frames if self.complete else self.start + self.audio.shape[-1]
+
+    def append(self, block: torch.Tensor) -> None:
+        """Adds the next decoded block, ignoring anything past where the first pass said the file ends"""
+        room = self.frames - (self.start + self.audio.shape[-1])
+        self.audio = torch.cat([self.audio, block[..., : max(0, room)]], dim=-1)
+
+    def trim(self, before: int) -> None:
+        """Drops the audio before the given sample, once no segment still to be run needs it"""
+        drop = min(max(0, before - self.start), self.audio.shape[-1])
+        self.audio = self.audio[..., drop:].clone()
+        self.start += drop
+
+    def window(self, start: int, end: int) -> torch.Tensor:
+        """Gets the audio from `start` to `end`, with zeros for anything outside of the file, which is exactly
+            what `TensorChunk.padded` produces for the same range of the whole waveform"""
+        correct_start = max(0, start)
+        correct_end = max(correct_start, min(self.frames, end))
+        if correct_start == correct_end:
+            return torch.zeros(self.audio.shape[0], end - start)
+
+        assert correct_start >= self.start, "Audio was trimmed before the last segment needing it ran"
+        audio = self.audio[..., correct_start - self.start : correct_end - self.start]
+        return F.pad(audio, (correct_start - start, end - correct_start - audio.shape[-1]))
+
+
+class SegmentLane:
+    def __init__(self, engine: SeparationEngine, model: torch.nn.Module, delay: int, frames: int):
+        """Overlap-adds one model's predictions across the stream, as one of `apply_model`'s split passes would.
+            With shifts, each random shift is its own lane delayed by that many samples of silence. The segments,
+            their padding and their weighting are the same as the whole-file path's; the lane just finalizes each
+            sample as soon as the last segment covering it has run, so only about a segment's worth is ever held
+
+        Args:
+            engine (SeparationEngine): The engine whose settings (segment, overlap, batching) to follow
+            model (torch.nn.Module): A single (non-bag) model
+            delay (int): How many samples of silence precede the audio in this lane
+            frames (int): How many samples (per channel) the whole file has
+        """
+        self.engine = engine
+        self.model = model
+        self.delay = delay
+        self.length = delay + frames
+
+        self.segment_length = int(model.samplerate * engine.segment_seconds(model))
+        self.stride = int((1 - engine.overlap) * self.segment_length)
+        weight = torch.cat(
+            [
+                torch.arange(1, self.segment_length // 2 + 1),
+                torch.arange(self.segment_length - self.segment_length // 2, 0, -1),
+            ]
+        )
+        self.weight = weight / weight.max()
+
+        self.next_offset = 0
+        # Running totals for the samples from `pending_start` on that some segment has contributed to
+        self.pending_start = 0
+        self.pending = torch.zeros(len(model.sources), engine.audio_channels, 0)
+        self.pending_weight = torch.zeros(0)
+        # Finalized predictions, lined up with the file's own samples, waiting for the other lanes to catch up
+        self.ready: List[torch.Tensor] = []
+
+    @property
+    def ready_frames(self) -> int:
+        return sum(out.shape[-1] for out in self.ready)
+
+    @property
+    def needs_from(self) -> int:
+        """The earliest sample of the file that a segment still to be run will read. Every segment but the tail
+            has the same padding, and the tail can be padded further back, so those are the two to check"""
+        if self.next_offset >= self.length:
+            return self.length
+        last_offset = (self.length - 1) // self.stride * self.stride
+        return min(self.__bounds(self.next_offset)[0], self.__bounds(last_offset)[0]) - self.delay
+
+    def run(self, buffer: StreamBuffer) -> None:
+        """Runs every remaining segment whose audio is fully buffered, finalizing whatever they complete
+
+        Args:
+            buffer (StreamBuffer): The buffered input audio
+        """
+        batch_size = self.engine.batch_segments or 1
+        while self.next_offset < self.length:
+            # Same-length segments stack, which is everything but (possibly) the tail
+            batch, valid_length = [], None
+            offset = self.next_offset
+            while offset < self.length and len(batch) < batch_size:
+                start, end, length = self.__bounds(offset)
+                if min(end - self.delay, buffer.frames) > buffer.end or valid_length not in (None, end - start):
+                    break
+                batch.append((offset, length, buffer.window(start - self.delay, end - self.delay)))
+                valid_length = end - start
+                offset += self.stride
+            if not batch:
+                return
+
+            padded = torch.stack([audio for _, _, audio in batch]).to(self.engine.device)
+            with torch.no_grad():
+                batch_out = self.model(padded).cpu()
+
+            for (offset, length, _), chunk_out in zip(batch, batch_out):
+                self.__accumulate(offset, length, center_trim(chunk_out, length))
+            self.next_offset = batch[-1][0] + self.stride
+            self.__finalize(min(self.next_offset, self.length))
+
+    def take(self, frames: int) -> torch.Tensor:
+        """Removes and returns the first `frames` finalized samples
+
+        Args:
+            frames (int): How many samples to take. Must be no more than `ready_frames`
+
+        Returns:
+            torch.Tensor: The predictions, shaped (sources, channels, frames)
+        """
+        ready = torch.cat(self.ready, dim=-1)
+        self.ready = [ready[..., frames:]]
+        return ready[..., :frames]
+
+    def __bounds(self, offset: int) -> Tuple[int, int, int]:
+        """Gets the padded range a segment reads, in this lane's samples, along with the segment's own length"""
+        length = min(self.segment_length, self.length - offset)
+        valid_length = self.engine.valid_length(self.model, length)
+        start = offset - (valid_length - length) // 2
+        return start, start + valid_length, length
+
+    def __accumulate(self, offset: int, length: int, chunk_out: torch.Tensor) -> None:
+        """Adds a segment's weighted prediction into the running totals, exactly as `apply_model` does"""
+        grow = offset + length - (self.pending_start + self.pending.shape[-1])
+        if grow > 0:
+            self.pending = torch.cat([self.pending, torch.zeros(*self.pending.shape[:-1], grow)], dim=-1)
+            self.pending_weight = torch.cat([self.pending_weight, torch.zeros(grow)])
+
+        idx = offset - self.pending_start
+        self.pending[..., idx : idx + length] += self.weight[:length] * chunk_out
+        self.pending_weight[idx : idx + length] += self.weight[:length]
+
+    def __finalize(self, upto: int) -> None:
+        """Moves the running totals before `upto`, which no later segment reaches back to, into the ready list"""
+        count = upto - self.pending_start
+        if count <= 0:
+            return
+
+        out = self.pending[..., :count] / self.pending_weight[:count]
+        # The silence a shift was delayed by is trimmed off, same as `apply_model` does
+        skip = max(0, self.delay - self.pending_start)
+        if skip < count:
+            self.ready.append(out[..., skip:])
+
+        self.pending = self.pending[..., count:].clone()
+        self.pending_weight = self.pending_weight[count:].clone()
+        self.pending_start = upto
+
+
+class StreamingSeparator:
+    def __init__(self, engine: SeparationEngine, window_seconds: float = 30):
+        """Separates and encodes files a window at a time, so that memory use depends on the window size rather
+            than on how long the track is. Meant for DJ mixes, live recordings and the like, where holding the
+            whole waveform plus every stem in memory would take gigabytes
+
+        Args:
+            engine (SeparationEngine): The loaded engine to separate with
+            window_seconds (float): How much audio to decode, and hold output for, at a time
+        """
+        self.engine = engine
+        self.block_frames = max(1, int(window_seconds * engine.samplerate))
+
+    def measure(self, path: Path) -> StreamStats:
+        """Makes a first pass over the file for its length and the statistics the model's input is normalized by.
+            Blocks are combined with Chan et al.'s parallel variance in double precision
+
+        Args:
+            path (Path): The file to measure
+
+        Raises:
+            RuntimeError: Thrown if the file has no audio in it
+
+        Returns:
+            StreamStats: The file's length, mean and standard deviation
+        """
+        frames, mean, m2 = 0, 0.0, 0.0
+        for block in self.engine.decoder.stream(path, self.block_frames):
+            ref = block.mean(0).double()
+            count = ref.shape[-1]
+            block_mean = float(ref.mean())
+            block_m2 = float(((ref - block_mean) ** 2).sum())
+
+            delta = block_mean - mean
+            total = frames + count
+            mean += delta * count / total
+            m2 += block_m2 + delta**2 * frames * count / total
+            frames = total
+
+        if frames < 2:
+            raise RuntimeError(f"{Path(path).name} has no audio to separate")
+
+        # Unbiased, to match torch's std
+        return StreamStats(frames, torch.tensor(mean, dtype=torch.float32), torch.tensor(math.sqrt(m2 / (frames - 1)), dtype=torch.float32))
+
+    def separate(self, path: Path, stats: StreamStats, out_dir: Path, keep_drums: bool = False) -> Tuple[SpilledStem, Optional[SpilledStem]]:
+        """Decodes and separates the file a window at a time, spilling the stems to raw files in `out_dir`.
+            Given the same statistics, the output matches separating the whole waveform at once to within float
+            rounding (around 1e-8), which can still be enough to change an encoded output's bytes
+
+        Args:
+            path (Path): The file to separate
+            stats (StreamStats): What `measure` found for the file
+            out_dir (Path): The job's scratch directory to spill to
+            keep_drums (bool): Also spill the drum stem
+
+        Returns:
+            Tuple[SpilledStem, Optional[SpilledStem]]: The drumless stem, and the drum stem if it was kept
+        """
+        model = self.engine.model
+        # A bag's sub-models are each run in full and then blended by their per-source weights, same as `apply_model`
+        if isinstance(model, BagOfModels):
+            sub_models = list(zip(model.models, model.weights))
+        else:
+            sub_models = [(model, [1.0] * len(model.sources))]
+
+        # Shifts are drawn in the same order as the whole-file path draws its offsets. The transformer models draw from
+        # `random` on every forward pass too, and there are more passes here, so a seeded run still shifts differently
+        lanes: List[Tuple[List[float], List[SegmentLane]]] = []
+        for sub_model, weights in sub_models:
+            max_shift = int(0.5 * sub_model.samplerate)
+            delays = [max_shift - random.randint(0, max_shift) for _ in range(self.engine.shifts)] or [0]
+            lanes.append((weights, [SegmentLane(self.engine, sub_model, delay, stats.frames) for delay in delays]))
+
+        no_drums = SpilledStem(out_dir.joinpath("no_drums.f32"), 0, self.engine.audio_channels, torch.tensor(0.0))
+        drums = SpilledStem(out_dir.joinpath("drums.f32"), 0, self.engine.audio_channels, torch.tensor(0.0)) if keep_drums else None
+
+        buffer = StreamBuffer(self.engine.audio_channels, stats.frames)
+        with open(no_drums.path, "wb") as no_drums_fh, open(drums.path, "wb") if drums else nullcontext() as drums_fh:
+            for block in self.engine.decoder.stream(path, self.block_frames):
+                buffer.append((block - stats.mean) / stats.std)
+                self.__advance(buffer, lanes, stats, (no_drums, no_drums_fh), (drums, drums_fh))
+
+            buffer.complete = True
+            self.__advance(buffer, lanes, stats, (no_drums, no_drums_fh), (drums, drums_fh))
+
+        return no_drums, drums
+
+    def encode(
+        self, stem: SpilledStem, path: Path, encoder: AudioEncoder, append: bool = False, tags: Optional[ContainerTags] = None
+    ) -> None:
+        """Encodes a spilled stem a window at a time, producing the same file as `AudioEncoder.encode` would for the
+            whole waveform. The spilled samples are removed afterwards
+
+        Args:
+            stem (SpilledStem): The stem to encode
+            path (Path): Where to write the output
+            encoder (AudioEncoder): The encoder for the chosen output format
+            append (bool): Write after whatever the file already holds (e.g. its tag) instead of replacing it
+            tags (Optional[ContainerTags]): The tags for formats the encoder tags itself. See `AudioEncoder.encode`
+        """
+        try:
+            encoder.encode_spilled(stem.path, stem.frames, float(stem.peak), path, append, tags)
+        finally:
+            stem.path.unlink()
+
+    def __advance(
+        self,
+        buffer: StreamBuffer,
+        lanes: List[Tuple[List[float], List[SegmentLane]]],
+        stats: StreamStats,
+        no_drums: Tuple[SpilledStem, BinaryIO],
+        drums: Tuple[Optional[SpilledStem], Optional[BinaryIO]],
+    ) -> None:
+        """Runs whatever segments the buffered audio allows, then spills whatever every lane has finalized"""
+        every_lane = [lane for _, sub_lanes in lanes for lane in sub_lanes]
+        for lane in every_lane:
+            lane.run(buffer)
+        buffer.trim(min(lane.needs_from for lane in every_lane))
+
+        frames = min(lane.ready_frames for lane in every_lane)
+        if not frames:
+            return
+
+        # Blended exactly as the whole-file path blends shifts, then sub-models
+        estimate = torch.zeros(len(self.engine.model.sources), self.engine.audio_channels, frames)
+        totals = [0.0] * len(self.engine.model.sources)
+        for weights, sub_lanes in lanes:
+            outs = [lane.take(frames) for lane in sub_lanes]
+            out = sum(outs) / self.engine.shifts if self.engine.shifts else outs[0]
+            for k, inst_weight in enumerate(weights):
+                estimate[k] += out[k] * inst_weight
+                totals[k] += inst_weight
+        for k, total in enumerate(totals):
+            estimate[k] /= total
+
+        sources = dict(zip(self.engine.model.sources, estimate * stats.std + stats.mean))
+        drum_stem, no_drum_stem = self.engine.two_stems(sources)
+        self.__spill(no_drums, no_drum_stem)
+        if drums[0]:
+            self.__spill(drums, drum_stem)
+
+    def __spill(self, stem: Tuple[SpilledStem, BinaryIO], wav: torch.Tensor) -> None:
+        """Appends a block of output to a spilled stem, keeping track of its peak for clipping prevention"""
+        spilled, fh = stem
+        fh.write(wav.t().contiguous().numpy().tobytes())
+        spilled.frames += wav.shape[-1]
+        spilled.peak = torch.maximum(spilled.peak, wav.abs().max())
@@ -0,0 +1,143 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+from eyed3.id3 import ID3_V2_4, Tag
+from eyed3.id3.frames import ImageFrame
+
+NO_DRUMS_SUFFIX = " (No Drums)"
+DRUMS_SUFFIX = " (Drums)"
+
+
+@dataclass
+class ContainerTags:
+    """An output's metadata for formats that ffmpeg tags as they're encoded, rather than with an ID3 tag written ahead"""
+
+    fields: Dict[str, str] = field(default_factory=dict)  # ffmpeg's metadata keys (title, album_artist, track, ...)
+    cover: Optional[bytes] = None
+    cover_mime_type: Optional[str] = None
+
+
+class AlbumArtCache:
+    def __init__(self, max_bytes: int = 64 * 1024**2):
+        """Cover art that's already been read, keyed by album. Every track of an album usually carries the same
+            cover, so it only has to be read out of the first track rather than again for each one.
+            The least recently used covers are dropped once they add up to more than max_bytes
+
+        Args:
+            max_bytes (int): The most cover art to hold in memory at once
+        """
+        self.max_bytes = max_bytes
+        self.covers: "OrderedDict[Tuple[str, str, str], Optional[Tuple[bytes, str]]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(
+        self, path: Path, album: Optional[str], album_artist: Optional[str], load: Callable[[], Optional[bytes]]
+    ) -> Optional[Tuple[bytes, str]]:
+        """Gets the cover for a track's album, loading it from the track if the album hasn't been seen yet
+
+        Args:
+            path (Path): The track. Only albums within the same directory are considered the same album
+            album (Optional[str]): The track's album
+            album_artist (Optional[str]): The track's album artist
+            load (Callable[[], Optional[bytes]]): Reads the cover out of the track
+
+        Returns:
+            Optional[Tuple[bytes, str]]: The cover and its mime type, or None if the album has no cover
+        """
+        key = (str(Path(path).parent), album or "", album_artist or "")
+        with self.lock:
+            if key in self.covers:
+                self.covers.move_to_end(key)
+                return self.covers[key]
+
+        image = load()
+        cover = (image, image_mime_type(image)) if image else None
+
+        with self.lock:
+            self.covers[key] = cover
+            while len(self.covers) > 1 and sum(len(entry[0]) for entry in self.covers.values() if entry) > self.max_bytes:
+                self.covers.popitem(last=False)
+        return cover
+
+
+def image_mime_type(image: bytes) -> str:
+    """Guesses an image's mime type from its magic number
+
+    Args:
+        image (bytes): The image's contents
+
+    Returns:
+        str: The mime type. JPEG if it's anything other than a PNG, since that's what covers almost always are
+    """
+    return "image/png" if image.startswith(b"\x89PNG") else "image/jpeg"
+
+
+def write_tag_header(tag: Tag, path: Path, title_suffix: str, fallback_title: str) -> int:
+    """Creates a file holding nothing but an ID3v2.4 tag, so the encoded audio can be appended straight after it.
+        Since the file doesn't exist yet, eyed3 just writes the tag out rather than parsing or rewriting any audio
+
+    Args:
+        tag (Tag): The tag to write. Left as it was found
+        path (Path): The file to create. Replaced if it already exists
+        title_suffix (str): What to append to the title so the output is distinguishable from the original
+        fallback_title (str): The title to use if the tag doesn't have one
+
+    Returns:
+        int: The size of the tag in bytes, i.e. where the audio will start
+    """
+    Path(path).unlink(missing_ok=True)
+
+    title = tag.title
+    tag.title = f"{title or fallback_title}{title_suffix}"
+    try:
+        tag.save(filename=str(path), version=ID3_V2_4)
+    finally:
+        tag.title = title
+
+    return Path(path).stat().st_size
+
+
+def container_tags(tag: Tag, title_suffix: str, fallback_title: str) -> ContainerTags:
+    """Translates an ID3 tag into the metadata ffmpeg writes into M4A and FLAC outputs, which become MP4 atoms
+        and Vorbis comments respectively. The front cover (or failing that, the first image) comes along too
+
+    Args:
+        tag (Tag): The tag to translate. Left as it was found
+        title_suffix (str): What to append to the title so the output is distinguishable from the original
+        fallback_title (str): The title to use if the tag doesn't have one
+
+    Returns:
+        ContainerTags: The translated tags
+    """
+    date = tag.getBestDate()
+    track, track_total = tag.track_num
+    disc, disc_total = tag.disc_num
+    fields = {
+        "title": f"{tag.title or fallback_title}{title_suffix}",
+        "artist": tag.artist,
+        "album": tag.album,
+        "album_artist": tag.album_artist,
+        "composer": tag.composer,
+        "genre": tag.genre.name if tag.genre else None,
+        "date": str(date) if date else None,
+        "track": (f"{track}/{track_total}" if track_total else str(track)) if track else None,
+        "disc": (f"{disc}/{disc_total}" if disc_total else str(disc)) if disc else None,
+    }
+
+    images = list(tag.images)
+    front = [image for image in images if image.picture_type == ImageFrame.FRONT_COVER]
+    image = (front or images or [None])[0]
+    cover = image.image_data if image else None
+
+    return ContainerTags(
+        {key: value for key, value in fields.items() if value},
+        cover,
+        (image.mime_type or image_mime_type(cover)) if cover else None,
+    )
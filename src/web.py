@@ -1,19 +1,32 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import time
 from pathlib import Path
-from typing import List
-from uuid import uuid4
-from os import makedirs
 
 import streamlit as st
 
-from common import SUPPORTED_EXTS, MODEL_CHOICES
-from music_file import MusicFile
-from dataclasses import dataclass
+from src.common import MODEL_CHOICES, SUPPORTED_EXTS
+from src.formats import OUTPUT_FORMATS, OutputFormat
+from src.presets import PRESETS
+from src.jobqueue import DONE, FAILED, JobQueue
+
+# How often the page checks back on jobs that haven't finished yet
+POLL_SECONDS = 2
+
 
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Starts the job queue that every session shares. Streamlit keeps it alive across reruns and sessions,
+        so the models its workers load stay warm for everyone
 
-@dataclass
-class ConvertedFile:
-    name: str
-    path: Path
+    Returns:
+        JobQueue: The shared job queue
+    """
+    queue = JobQueue(Path("./.tmp")).start()
+    queue.preload(next(iter(MODEL_CHOICES.values())))
+    return queue
 
 
 st.set_page_config(page_title="Drum Track Converter", page_icon="🥁", layout="centered")
@@ -21,29 +34,62 @@ st.set_page_config(page_title="Drum Track Converter", page_icon="🥁", layout="
 st.header("Drum Track Converter")
 st.subheader("Take any audio file and strip the drums out of it for drum practice!")
 
+job_queue = get_job_queue()
+
 model_name = st.selectbox("DEMUCS Model", MODEL_CHOICES)
+preset = st.radio(
+    "Quality",
+    list(PRESETS),
+    index=list(PRESETS).index("balanced"),
+    horizontal=True,
+    format_func=str.capitalize,
+    help="Fast makes a single pass over each track. Best averages several passes, taking several times as long",
+)
+output_format = st.radio(
+    "Format",
+    OUTPUT_FORMATS,
+    horizontal=True,
+    format_func=str.upper,
+    help="M4A plays on iPods and other Apple devices. FLAC is lossless, at several times the size",
+)
 files = st.file_uploader(
     type=SUPPORTED_EXTS,
     accept_multiple_files=True,
     label="Select your music files you'd like to convert",
 )
 
-converted_files: List[ConvertedFile] = []
+# Maps each upload (and the model, preset and format it's being split with) to its job, so reruns check on jobs rather than resubmitting
+if "jobs" not in st.session_state:
+    st.session_state.jobs = {}
 
 if files:
-    job_id = str(uuid4())
-    prog = st.progress(value=0, text="Working on it..")
-    for idx, file in enumerate(files):
-        makedirs(f"./.tmp/{job_id}")
-        file_name = Path(f"./.tmp/{job_id}/{file.name}").resolve()
-        with open(file_name, "wb") as fh:
-            fh.write(file.read())
-
-        music_file = MusicFile(file_name, MODEL_CHOICES[model_name])
-        converted_files.append(ConvertedFile(name=file.name, path=music_file.separate()))
-        prog.progress(idx + 1)
-
-    prog.empty()
-
-    for conv in converted_files:
-        st.download_button(conv.name, conv.path.read_bytes())
+    statuses = []
+    for file in files:
+        key = (file.file_id, MODEL_CHOICES[model_name], preset, output_format)
+        status = job_queue.status(st.session_state.jobs[key]) if key in st.session_state.jobs else None
+        if not status:
+            # New, or kept around for so long that the output was removed; either way it needs (re)converting
+            file.seek(0)
+            upload = job_queue.save_upload(file, file.name)
+            st.session_state.jobs[key] = job_queue.submit(
+                upload, MODEL_CHOICES[model_name], settings=PRESETS[preset], output_format=OutputFormat.for_container(output_format)
+            )
+            status = job_queue.status(st.session_state.jobs[key])
+        statuses.append(status)
+
+    finished = [status for status in statuses if status.state in (DONE, FAILED)]
+    if len(finished) < len(statuses):
+        st.progress(len(finished) / len(statuses), text=f"Working on it.. ({job_queue.pending()} file(s) in the queue)")
+
+    for status in statuses:
+        if status.state == DONE:
+            file_name = f"{Path(status.name).stem}{status.output.suffix}"
+            st.download_button(status.name, status.output.read_bytes(), file_name=file_name, key=status.id)
+        elif status.state == FAILED:
+            st.error(f"Failed to convert {status.name}: {status.error}")
+        else:
+            st.caption(f"{status.name}: {status.state}")
+
+    if len(finished) < len(statuses):
+        time.sleep(POLL_SECONDS)
+        st.rerun()
@@ -0,0 +1,310 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+QUEUE_NAME = ".dtc_queue.sqlite"
+
+# The states a queued file moves through. A file whose lease runs out, or whose attempt fails, goes back to PENDING
+# until it's used up its attempts, so it ends up either DONE or FAILED
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# How long a worker may go without renewing its leases before its files are handed to someone else
+DEFAULT_LEASE_SECONDS = 5 * 60
+
+# How many times a file is tried, whether it failed or its worker went missing, before it's given up on
+DEFAULT_MAX_ATTEMPTS = 3
+
+# How often a worker with nothing left to claim checks back for files whose leases ran out, while others are still working
+POLL_SECONDS = 5
+
+
+@dataclass
+class LeasedJob:
+    """A file claimed from the queue, which no other worker will take on while its lease is renewed"""
+
+    path: Path
+    duration: float  # In seconds, as planned by whoever published it
+    attempt: int  # 1 for the first worker to claim it
+
+
+@dataclass
+class QueueCounts:
+    """How many of a queue's files are in each state"""
+
+    pending: int = 0
+    leased: int = 0
+    done: int = 0
+    failed: int = 0
+
+
+def default_worker_name() -> str:
+    """Names this process among every worker on every machine
+
+    Returns:
+        str: The host name and process ID
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(
+        self,
+        path: Path,
+        variant: str,
+        worker: Optional[str] = None,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
+        """A queue of files to convert, kept in a SQLite database that any number of workers, on any number of
+            machines sharing the same volume, take files from. A worker leases each file it claims and renews the
+            lease while it works on it, so the files of a worker that crashes (or whose machine goes down) are
+            picked up by another once their leases run out. Workers only take files queued for their own variant,
+            so a worker started with different settings can't mix its outputs in with the rest. Like the manifest, it
+            relies on the volume's file locking, which network filesystems only provide reliably from NFSv4 on, and the
+            leases compare each machine's clock, so those should be kept in sync
+
+        Args:
+            path (Path): The queue's database. Created if it doesn't exist
+            variant (str): What the model, settings and format are known as. See `FolderProcessor.variant`
+            worker (Optional[str]): What this worker's leases are held under. Defaults to the host name and process ID
+            lease_seconds (float): How long a lease lasts without being renewed. Leases are renewed every third of this
+            max_attempts (int): How many times a file is tried before it's given up on
+        """
+        self.path = Path(path)
+        self.variant = variant
+        self.worker = worker or default_worker_name()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+
+        os.makedirs(self.path.parent, exist_ok=True)
+        # Transactions are begun by hand so that claiming takes the write lock up-front. Other workers' transactions
+        # are waited on, for as long as a slow network volume might hold them up
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat_thread: Optional[threading.Thread] = None
+        with self.__transaction() as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    input_path TEXT NOT NULL,
+                    variant TEXT NOT NULL,
+                    duration REAL NOT NULL,
+                    state TEXT NOT NULL,
+                    worker TEXT,
+                    lease_expires REAL NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT NOT NULL DEFAULT '',
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (input_path, variant)
+                )
+                """
+            )
+
+    def __enter__(self) -> "WorkQueue":
+        """Starts renewing this worker's leases in the background"""
+        self.stop_heartbeat.clear()
+        self.heartbeat_thread = threading.Thread(target=self.__heartbeat, name="work-queue-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        """Stops renewing leases and hands back whatever this worker still holds, unfinished, to the other workers"""
+        self.stop_heartbeat.set()
+        if self.heartbeat_thread:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+        self.release()
+
+    def publish(self, jobs: List[Tuple[Path, float]]) -> int:
+        """Queues files for this variant. Files that already finished (or failed) are queued again with a fresh set
+            of attempts, since they're only published if they still need converting. Files already waiting or being
+            worked on are left as they are
+
+        Args:
+            jobs (List[Tuple[Path, float]]): Each file to queue along with its duration in seconds
+
+        Returns:
+            int: How many of the files were newly queued
+        """
+        now = time.time()
+        with self.__transaction() as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO jobs (input_path, variant, duration, state, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (input_path, variant) DO UPDATE SET
+                    duration = excluded.duration, state = excluded.state, worker = NULL, attempts = 0, error = '', updated_at = excluded.updated_at
+                WHERE state IN (?, ?)
+                """,
+                [(self.__key(path), self.variant, duration, PENDING, now, DONE, FAILED) for path, duration in jobs],
+            )
+            return max(0, cursor.rowcount)
+
+    def claim(self) -> Optional[LeasedJob]:
+        """Leases the next waiting file, first putting back any files whose leases have run out
+
+        Returns:
+            Optional[LeasedJob]: The claimed file, or None if there's nothing waiting right now
+        """
+        now = time.time()
+        with self.__transaction() as cursor:
+            # A lapsed lease used up an attempt, just like a failure would've
+            cursor.execute(
+                """
+                UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                    error = 'The lease held by ' || worker || ' ran out', worker = NULL, updated_at = ?
+                WHERE variant = ? AND state = ? AND lease_expires < ?
+                """,
+                (self.max_attempts, FAILED, PENDING, now, self.variant, LEASED, now),
+            )
+            row = cursor.execute(
+                "SELECT rowid, input_path, duration, attempts FROM jobs WHERE variant = ? AND state = ? ORDER BY rowid LIMIT 1",
+                (self.variant, PENDING),
+            ).fetchone()
+            if not row:
+                return None
+
+            rowid, input_path, duration, attempts = row
+            cursor.execute(
+                "UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, attempts = ?, updated_at = ? WHERE rowid = ?",
+                (LEASED, self.worker, now + self.lease_seconds, attempts + 1, now, rowid),
+            )
+        return LeasedJob(Path(input_path), duration, attempts + 1)
+
+    def claims(self, stop: threading.Event) -> Iterator[LeasedJob]:
+        """Claims files one at a time, as they're asked for, until there are none left. While other workers still hold
+            leases it keeps checking back, so that it can take over any whose worker goes missing, as well as any of
+            its own that fail and are to be tried again
+
+        Args:
+            stop (threading.Event): Stops claiming any more once set
+
+        Yields:
+            LeasedJob: Each claimed file
+        """
+        while not stop.is_set():
+            job = self.claim()
+            if job:
+                yield job
+            elif self.counts().leased:
+                stop.wait(POLL_SECONDS)
+            else:
+                return
+
+    def complete(self, path: Path) -> None:
+        """Records that this worker finished converting a file it leased
+
+        Args:
+            path (Path): The file, as claimed
+        """
+        with self.__transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, error = '', updated_at = ? WHERE input_path = ? AND variant = ? AND worker = ?",
+                (DONE, time.time(), self.__key(path), self.variant, self.worker),
+            )
+
+    def fail(self, path: Path, error: str) -> bool:
+        """Records that this worker couldn't convert a file it leased, queueing it to be tried again if it has
+            attempts left
+
+        Args:
+            path (Path): The file, as claimed
+            error (str): What went wrong
+
+        Returns:
+            bool: True if the file will be tried again
+        """
+        with self.__transaction() as cursor:
+            cursor.execute(
+                """
+                UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, error = ?, updated_at = ?
+                WHERE input_path = ? AND variant = ? AND worker = ?
+                """,
+                (self.max_attempts, FAILED, PENDING, error, time.time(), self.__key(path), self.variant, self.worker),
+            )
+            row = cursor.execute("SELECT state FROM jobs WHERE input_path = ? AND variant = ?", (self.__key(path), self.variant)).fetchone()
+        return bool(row) and row[0] == PENDING
+
+    def release(self) -> int:
+        """Hands every file this worker holds back to the queue, without counting it as an attempt
+
+        Returns:
+            int: How many files were handed back
+        """
+        with self.__transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, attempts = attempts - 1, updated_at = ? WHERE worker = ? AND state = ?",
+                (PENDING, time.time(), self.worker, LEASED),
+            )
+            return cursor.rowcount
+
+    def counts(self, variant: Optional[str] = None) -> QueueCounts:
+        """Counts the queue's files in each state
+
+        Args:
+            variant (Optional[str]): The variant to count the files of. Defaults to this queue's
+
+        Returns:
+            QueueCounts: The counts
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT state, COUNT(*) FROM jobs WHERE variant = ? GROUP BY state", (variant or self.variant,)
+            ).fetchall()
+        return QueueCounts(**dict(rows))
+
+    def variants(self) -> List[str]:
+        """Lists every variant with files waiting or being worked on
+
+        Returns:
+            List[str]: The variants
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT DISTINCT variant FROM jobs WHERE state IN (?, ?)", (PENDING, LEASED)).fetchall()
+        return [variant for (variant,) in rows]
+
+    def close(self) -> None:
+        """Closes the underlying database connection"""
+        self.connection.close()
+
+    def __heartbeat(self) -> None:
+        """Renews this worker's leases every third of a lease until told to stop"""
+        while not self.stop_heartbeat.wait(self.lease_seconds / 3):
+            try:
+                with self.__transaction() as cursor:
+                    cursor.execute(
+                        "UPDATE jobs SET lease_expires = ? WHERE worker = ? AND state = ?",
+                        (time.time() + self.lease_seconds, self.worker, LEASED),
+                    )
+            except sqlite3.OperationalError:
+                continue  # Locked for longer than the timeout; there's time for another go before the leases run out
+
+    @contextmanager
+    def __transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Runs the enclosed statements as one transaction, holding the write lock from the start"""
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def __key(self, input_path: Path) -> str:
+        """Gets the key a given input file is stored under"""
+        return str(Path(input_path).resolve())
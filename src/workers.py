@@ -0,0 +1,162 @@
+"""
+@author: Jose Stovall | github.com/oitsjustjose | bsky||@oitsjustjose.com
+"""
+
+from contextlib import nullcontext
+from pathlib import Path
+from typing import List, Optional, Tuple
+from uuid import uuid4
+
+import torch
+
+from src.cache import SeparationCache
+from src.encoders import AudioEncoder
+from src.formats import OutputFormat
+from src.engine import SeparationEngine
+from src.presets import InferenceSettings
+from src.instrumentation import RunReport, StageTiming
+from src.messaging import NoPrintStatements
+from src.music_file import MusicFile
+from src.registry import DEFAULT_BUDGET_BYTES, ModelRegistry, RegistryStats
+from src.shared_weights import SharedWeights
+from src.tags import AlbumArtCache
+
+# Each worker process holds its own engines, so a model is loaded once per worker rather than once per file
+__registry: Optional[ModelRegistry] = None
+__model_name: str = ""
+__verbose: bool = False
+__keep_drums: bool = False
+__cache: Optional[SeparationCache] = None
+__scratch_dir: Optional[Path] = None
+__stream_window: float = 0
+__settings: Optional[InferenceSettings] = None
+__output_format: OutputFormat = OutputFormat()
+__art_cache: AlbumArtCache = AlbumArtCache()
+
+
+def init_worker(
+    model_name: str,
+    threads: int,
+    verbose: bool,
+    keep_drums: bool,
+    cache_dir: Optional[str],
+    cache_max_bytes: int,
+    batch_segments: int,
+    scratch_dir: Path,
+    stream_window: float,
+    model_budget: int = DEFAULT_BUDGET_BYTES,
+    backend: str = "float32",
+    settings: Optional[InferenceSettings] = None,
+    output_format: OutputFormat = OutputFormat(),
+    weights_dir: Optional[Path] = None,
+) -> None:
+    """Process pool initializer: pins this worker's share of torch threads and loads the default model
+
+    Args:
+        model_name (str): The name of the Demucs model to load up-front, and use for files that don't ask for another
+        threads (int): How many intra-op threads torch may use in this worker
+        verbose (bool): Whether or not to let Demucs print to stdout
+        keep_drums (bool): Whether or not to also encode the drum stem
+        cache_dir (Optional[str]): Where the shared separation cache lives, if one is in use
+        cache_max_bytes (int): The most the separation cache may hold on disk
+        batch_segments (int): How many segments of a track to run through the model per forward pass
+        scratch_dir (Path): The run's scratch directory to create each job's directory within. The parent process
+            owns it and removes it at the end of the run, so nothing a worker leaves behind outlives the run
+        stream_window (float): How many seconds at a time to separate the files that are streamed
+        model_budget (int): The most memory, in bytes, this worker's resident models' weights may take up
+            before the least recently used ones are dropped
+        backend (str): How to run the models, one of `backends.BACKENDS`
+        settings (Optional[InferenceSettings]): The shifts, overlap and segment length for files that don't ask for
+            their own. Defaults to the balanced preset
+        output_format (OutputFormat): What to encode the outputs to. Each worker encodes its own tracks
+        weights_dir (Optional[Path]): Where the workers share their models' weights from, through SharedWeights.
+            Models the parent hasn't saved there already are saved by whichever worker needs them first. If None,
+            each worker loads its own copy of every model
+    """
+    global __registry, __model_name, __verbose, __keep_drums, __cache, __scratch_dir, __stream_window, __settings, __output_format
+
+    torch.set_num_threads(threads)
+    __verbose = verbose
+    __keep_drums = keep_drums
+    __scratch_dir = scratch_dir
+    __stream_window = stream_window
+    __cache = SeparationCache(Path(cache_dir), cache_max_bytes) if cache_dir else None
+    __model_name = model_name
+    __settings = settings or InferenceSettings()
+    __output_format = output_format
+
+    # Threads are already pinned above, so Demucs shouldn't spin up its own pool on top of them
+    shared_weights = SharedWeights(weights_dir) if weights_dir else None
+    __registry = ModelRegistry(
+        model_budget,
+        lambda name: SeparationEngine(name, jobs=0, batch_segments=batch_segments, backend=backend, shared_weights=shared_weights),
+    )
+    with NoPrintStatements(verbose):
+        __registry.preload(model_name)
+
+
+def preload_in_worker(model_name: str) -> None:
+    """Loads a model in this worker ahead of the files that will need it
+
+    Args:
+        model_name (str): The name of the Demucs model to load
+    """
+    with NoPrintStatements(__verbose):
+        __registry.preload(model_name)
+
+
+def registry_stats_in_worker() -> RegistryStats:
+    """Gets this worker's model registry stats
+
+    Returns:
+        RegistryStats: How this worker's resident models have fared so far
+    """
+    return __registry.stats()
+
+
+def separate_in_worker(
+    path: Path,
+    stream: bool = False,
+    model_name: Optional[str] = None,
+    settings: Optional[InferenceSettings] = None,
+    output_format: Optional[OutputFormat] = None,
+) -> Tuple[Path, List[StageTiming]]:
+    """Splits the drums out of a single file using this worker's resident engine
+
+    Args:
+        path (Path): The path of the music file to split
+        stream (bool): Whether to separate the file a window at a time, for tracks too long to hold in memory
+        model_name (Optional[str]): The Demucs model to split it with, loading it if this worker doesn't have it
+            resident. Defaults to the model the worker was started with
+        settings (Optional[InferenceSettings]): The shifts, overlap and segment length to split it with. Defaults to
+            the settings the worker was started with
+        output_format (Optional[OutputFormat]): What to encode it to. Defaults to the format the worker was started with
+
+    Raises:
+        Exception: Thrown if the file's tag can't be read, in which case it isn't split at all
+
+    Returns:
+        Tuple[Path, List[StageTiming]]: The path to the drumless output, already tagged and unique to this job so
+            concurrent workers never collide, and how long each stage took in this worker
+    """
+    model_name = model_name or __model_name
+    music_file = MusicFile(path, model_name)
+    out_dir = __scratch_dir.joinpath(uuid4().hex)
+    report = RunReport(model_name)
+
+    # Only shows up in the report when switching models meant loading one
+    with report.measure(path, "load_model") if not __registry.is_resident(model_name) else nullcontext():
+        with NoPrintStatements(__verbose):
+            engine = __registry.get(model_name)
+    # Engines are shared between files that may each want different settings, and they're cheap to change
+    engine.configure(settings or __settings)
+
+    with report.measure(path, "read_tag"):
+        tag = music_file.get_tag(__art_cache)
+
+    with NoPrintStatements(__verbose):
+        stream_window = __stream_window if stream else None
+        encoder = AudioEncoder(engine.samplerate, engine.audio_channels, output_format or __output_format)
+        no_drums_path = music_file.separate(engine, out_dir, __keep_drums, __cache, report, stream_window, tag, encoder)
+
+    return no_drums_path, report.timings